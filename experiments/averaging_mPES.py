@@ -1,6 +1,8 @@
 import argparse
 from subprocess import run
 
+import matplotlib.pyplot as plt
+
 from memristor_nengo.extras import *
 
 parser = argparse.ArgumentParser()
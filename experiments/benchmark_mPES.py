@@ -0,0 +1,195 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument( "-N", "--neurons", nargs="*", default=[ 10, 100, 500, 1000, 2000 ], type=int,
+                     help="Number of pre and post neurons to benchmark" )
+parser.add_argument( "-D", "--dimensions", nargs="*", default=[ 1, 3, 6 ], type=int )
+parser.add_argument( "-l", "--learning_rules", nargs="*", default=[ "mPES", "PES" ], choices=[ "mPES", "PES" ] )
+parser.add_argument( "-b", "--backends", nargs="*", default=[ "nengo_core", "nengo_dl" ],
+                     choices=[ "nengo_core", "nengo_dl" ] )
+parser.add_argument( "-o", "--optimisations", nargs="*", default=[ "run", "build", "memory" ],
+                     choices=[ "run", "build", "memory" ] )
+parser.add_argument( "-S", "--simulation_time", default=1, type=float,
+                     help="Simulated seconds used to measure the steps per second.  Default is 1" )
+parser.add_argument( "-r", "--repeats", default=1, type=int )
+parser.add_argument( "-hf", "--history_file", default="../data/benchmarks/mPES.jsonl",
+                     help="JSON-lines file the results are appended to" )
+parser.add_argument( "--compare", nargs="*", default=None,
+                     help="Compare the results of two revisions in the history file (default the last two) "
+                          "instead of running the benchmarks" )
+parser.add_argument( "--single", default=None, help=argparse.SUPPRESS )
+args = parser.parse_args()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output( [ "git", "rev-parse", "--short", "HEAD" ],
+                                        cwd=os.path.dirname( os.path.abspath( __file__ ) ),
+                                        stderr=subprocess.DEVNULL ).decode().strip()
+    except:
+        return None
+
+
+def benchmark( config ):
+    # runs in a fresh process for every configuration so that the peak memory is not polluted by previous runs
+    import resource
+    
+    import nengo
+    import numpy as np
+    from nengo.learning_rules import PES
+    
+    from memristor_nengo.extras import Sines
+    from memristor_nengo.learning_rules import mPES
+    
+    neurons = config[ "neurons" ]
+    dimensions = config[ "dimensions" ]
+    timestep = 0.001
+    if config[ "optimisations" ] == "memory":
+        optimize = False
+        sample_every = timestep * 100
+    else:
+        optimize = config[ "optimisations" ] == "run"
+        sample_every = timestep
+    
+    model = nengo.Network( seed=0 )
+    with model:
+        input_node = nengo.Node( Sines( period=4 ), size_out=dimensions )
+        pre = nengo.Ensemble( neurons, dimensions=dimensions, seed=0 )
+        post = nengo.Ensemble( neurons, dimensions=dimensions, seed=0 )
+        error = nengo.Ensemble( neurons, dimensions=dimensions, radius=2, seed=0 )
+        
+        conn = nengo.Connection( pre.neurons, post.neurons, transform=np.zeros( (post.n_neurons, pre.n_neurons) ) )
+        # same device variability as the defaults of mPES.py
+        conn.learning_rule_type = mPES( noisy=[ 0.15 ] * 4, gain=1e4, seed=0 ) \
+            if config[ "learning_rule" ] == "mPES" else PES()
+        
+        nengo.Connection( error, conn.learning_rule )
+        nengo.Connection( post, error )
+        nengo.Connection( pre, error, transform=-1 )
+        nengo.Connection( input_node, pre )
+        
+        nengo.Probe( pre, synapse=0.01, sample_every=sample_every )
+        nengo.Probe( post, synapse=0.01, sample_every=sample_every )
+    
+    start_time = time.perf_counter()
+    if config[ "backend" ] == "nengo_core":
+        sim = nengo.Simulator( model, dt=timestep, optimize=optimize, progress_bar=False )
+    else:
+        import nengo_dl
+        
+        import memristor_nengo.learning_rules_dl
+        
+        sim = nengo_dl.Simulator( model, dt=timestep, progress_bar=False, device="/cpu:0" )
+    build_time = time.perf_counter() - start_time
+    
+    with sim:
+        # the first step of NengoDL also includes tracing the graph, so it is not timed
+        sim.run_steps( 1 )
+        steps = int( config[ "simulation_time" ] / timestep )
+        start_time = time.perf_counter()
+        sim.run_steps( steps )
+        run_time = time.perf_counter() - start_time
+    
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_memory = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    peak_memory *= 1 if platform.system() == "Darwin" else 1024
+    
+    return {
+            "build_time"       : build_time,
+            "steps_per_second" : steps / run_time,
+            "peak_memory_bytes": peak_memory,
+            }
+
+
+def compare( history_file, revisions ):
+    with open( history_file ) as f:
+        history = [ json.loads( line ) for line in f if line.strip() ]
+    
+    if not revisions:
+        revisions = [ ]
+        for entry in reversed( history ):
+            if entry[ "revision" ] not in revisions:
+                revisions.insert( 0, entry[ "revision" ] )
+            if len( revisions ) == 2:
+                break
+    if len( revisions ) != 2:
+        raise ValueError( "Need two revisions to compare" )
+    
+    # the latest result of every configuration for each revision
+    results = { revision: { } for revision in revisions }
+    for entry in history:
+        if entry[ "revision" ] in results:
+            results[ entry[ "revision" ] ][ json.dumps( entry[ "config" ], sort_keys=True ) ] = entry[ "results" ]
+    
+    old, new = revisions
+    print( f"{'configuration':<75} {'steps/s':>10} {'build':>8} {'memory':>8}" )
+    for key in sorted( set( results[ old ] ) & set( results[ new ] ) ):
+        config = json.loads( key )
+        name = f"{config[ 'learning_rule' ]} {config[ 'backend' ]} {config[ 'optimisations' ]} " \
+               f"N={config[ 'neurons' ]} D={config[ 'dimensions' ]}"
+        ratios = [ results[ new ][ key ][ metric ] / results[ old ][ key ][ metric ]
+                   for metric in ("steps_per_second", "build_time", "peak_memory_bytes") ]
+        print( f"{name:<75} {ratios[ 0 ]:>9.2f}x {ratios[ 1 ]:>7.2f}x {ratios[ 2 ]:>7.2f}x" )
+
+
+if args.single is not None:
+    print( json.dumps( benchmark( json.loads( args.single ) ) ) )
+    sys.exit()
+
+if args.compare is not None:
+    compare( args.history_file, args.compare )
+    sys.exit()
+
+os.makedirs( os.path.dirname( os.path.abspath( args.history_file ) ), exist_ok=True )
+revision = git_revision()
+timestamp = datetime.datetime.now().isoformat()
+failed = [ ]
+configs = itertools.product( args.learning_rules, args.backends, args.optimisations, args.neurons, args.dimensions )
+for learning_rule, backend, optimisations, neurons, dimensions in configs:
+    # NengoDL has no optimiser switch, so "build" would just repeat "run"
+    if backend == "nengo_dl" and optimisations == "build":
+        continue
+    config = {
+            "learning_rule"  : learning_rule,
+            "backend"        : backend,
+            "optimisations"  : optimisations,
+            "neurons"        : neurons,
+            "dimensions"     : dimensions,
+            "simulation_time": args.simulation_time,
+            }
+    for repeat in range( args.repeats ):
+        print( f"Benchmarking {config}, repeat {repeat + 1} of {args.repeats}" )
+        process = subprocess.run( [ sys.executable, os.path.abspath( __file__ ), "--single", json.dumps( config ) ],
+                                  capture_output=True, text=True,
+                                  cwd=os.path.dirname( os.path.abspath( __file__ ) ) )
+        if process.returncode != 0:
+            print( process.stderr )
+            failed.append( config )
+            continue
+        results = json.loads( process.stdout.strip().splitlines()[ -1 ] )
+        print( f"\tbuild {results[ 'build_time' ]:.2f} s, {results[ 'steps_per_second' ]:.1f} steps/s, "
+               f"peak memory {results[ 'peak_memory_bytes' ] / 2**20:.1f} MiB" )
+        
+        with open( args.history_file, "a" ) as f:
+            f.write( json.dumps( {
+                    "revision" : revision,
+                    "timestamp": timestamp,
+                    "host"     : platform.node(),
+                    "python"   : platform.python_version(),
+                    "config"   : config,
+                    "results"  : results,
+                    } ) + "\n" )
+
+if failed:
+    print( f"{len( failed )} benchmark runs failed:" )
+    for config in failed:
+        print( f"\t{config}" )
+    sys.exit( 1 )
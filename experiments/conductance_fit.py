@@ -4,6 +4,9 @@ from sklearn.metrics import mean_squared_error
 import matplotlib.pyplot as plt
 import csv
 
+from memristor_nengo.fitting import fit_power_law
+from memristor_nengo.trajectories import pulse_number, pulse_trajectory
+
 r_min = 1e2
 r_max = 2.5e8
 g_min = 1 / r_max
@@ -35,18 +38,12 @@ def conductance2resistance( G ):
     return 1.0 / g_unnorm
 
 
-n = [ ]
-r = [ 1e8 ]
-g = [ ]
-
-for i in range( iterations ):
-    n.append( ((r[ -1 ] - r_min) / r_max)**(1 / a) )
-    r.append( r_min + r_max * (n[ -1 ] + 1)**a )
-    g.append( resistance2conductance( r[ -1 ] ) )
+r_init = 1e8
 
-n = np.array( n )
-r = np.array( r )
-g = np.array( g )
+# pulse number before each pulse and resistance/conductance after it, in closed form
+n = pulse_number( r_init, r_min, r_max, a ) + np.arange( iterations )
+r = pulse_trajectory( r_init, iterations, r_min, r_max, a )
+g = resistance2conductance( r[ 1: ] )
 
 
 def fit_func_exp( x, a ):
@@ -104,3 +101,16 @@ with open( "../data/conductance_fit.csv", "w" ) as f:
 # print( mean_squared_error( g, test_g ) )
 # print( "Parameters:" )
 # print( params )
+
+# batched fit of a whole population of devices at once, here simulated devices with noisy parameters
+np.random.seed( 0 )
+devices = 1000
+true_r_min = np.random.normal( r_min, r_min * 0.15, devices )
+true_r_max = np.random.normal( r_max, r_max * 0.15, devices )
+true_exponent = np.random.normal( a, np.abs( a ) * 0.15, devices )
+R_devices = pulse_trajectory( true_r_max + true_r_min, 100, true_r_min, true_r_max, true_exponent ).T
+fitted = fit_power_law( R_devices )
+print( "Batched fit of", devices, "devices:" )
+print( "Mean relative error r_min:", np.mean( np.abs( fitted[ "r_min" ] - true_r_min ) / true_r_min ) )
+print( "Mean relative error r_max:", np.mean( np.abs( fitted[ "r_max" ] - true_r_max ) / true_r_max ) )
+print( "Mean relative error exponent:", np.mean( np.abs( fitted[ "exponent" ] - true_exponent ) / np.abs( true_exponent ) ) )
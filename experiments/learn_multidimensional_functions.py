@@ -1,103 +1,78 @@
 import argparse
 import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 
+import matplotlib.pyplot as plt
 import nengo_dl
 from nengo.dists import Gaussian
 from nengo.learning_rules import PES
-from nengo.processes import WhiteNoise, WhiteSignal
+from nengo.processes import PresentInput, WhiteNoise, WhiteSignal
 
 from memristor_nengo.extras import *
 from memristor_nengo.learning_rules import mPES
+import memristor_nengo.learning_rules_dl
 
-start_time = time.time()
+ARMS = [ "mPES", "PES", "NEF" ]
 
-setup()
 
-parser = argparse.ArgumentParser()
-parser.add_argument( "-E", "--experiment", choices=[ 1, 2, 3, 4, 5 ], type=int,
-                     help="1: Product 2: Combined product" )
-parser.add_argument( "-T", "--sim_time", default=None, type=float )
-parser.add_argument( "-I", "--iterations", default=10, type=int )
-parser.add_argument( "-g", "--gain", default=1e3, type=float )
-parser.add_argument( "-d", "--device", default="/cpu:0" )
-parser.add_argument( '--decoded', dest='decoded', action='store_true' )
-parser.add_argument( '--no-decoded', dest='decoded', action='store_false' )
-parser.set_defaults( decoded=True )
-args = parser.parse_args()
-
-experiment = args.experiment
-if experiment == 1:
-    exp_string = "PRODUCT experiment"
-    exp_name = "Multiplying two numbers"
-    function_to_learn = lambda x: x[ 0 ] * x[ 1 ]
-    # [ pre, post, ground_truth, error ]
-    neurons = [ 200, 200, 100, 100 ]
-    dimensions = [ 2, 1, 1, 1 ]
-    sim_time = 50
-if experiment == 2:
-    exp_string = "COMBINED PRODUCTS experiment"
-    exp_name = "Combining two products"
-    function_to_learn = lambda x: x[ 0 ] * x[ 1 ] + x[ 2 ] * x[ 3 ]
-    # [ pre, post, ground_truth, error ]
-    neurons = [ 400, 400, 100, 100 ]
-    dimensions = [ 4, 1, 1, 1 ]
-    sim_time = 100
-if experiment == 3:
-    exp_string = "SEPARATE PRODUCTS experiment"
-    exp_name = "Three separate products"
-    function_to_learn = lambda x: [ x[ 0 ] * x[ 1 ], x[ 0 ] * x[ 2 ], x[ 1 ] * x[ 2 ] ]
-    # [ pre, post, ground_truth, error ]
-    neurons = [ 300, 300, 300, 300 ]
-    dimensions = [ 3, 3, 3, 3 ]
-    sim_time = 100
-if experiment == 4:
-    exp_string = "2D CIRCULAR CONVOLUTIONS experiment"
-    exp_name = "Two-dimensional circular convolution"
-    # [ pre, post, ground_truth, error,conv ]
-    neurons = [ 400, 400, 200, 200, 200 ]
-    dimensions = [ 4, 2, 2, 2, 2 ]
-    function_to_learn = lambda x: np.fft.ifft(
-            np.fft.fft( x[ :int( dimensions[ 0 ] / 2 ) ] ) * np.fft.fft( x[ int( dimensions[ 0 ] / 2 ): ] )
-            )
-    sim_time = 200
-if experiment == 5:
-    exp_string = "3D CIRCULAR CONVOLUTIONS experiment"
-    exp_name = "Three-dimensional circular convolution"
-    # [ pre, post, ground_truth, error,conv ]
-    neurons = [ 600, 300, 300, 300, 300 ]
-    dimensions = [ 6, 3, 3, 3, 3 ]
-    function_to_learn = lambda x: np.fft.ifft(
-            np.fft.fft( x[ :int( dimensions[ 0 ] / 2 ) ] ) * np.fft.fft( x[ int( dimensions[ 0 ] / 2 ): ] )
-            )
-    sim_time = 400
-
-assert 'exp_name' in locals()
-
-if args.sim_time is not None:
-    sim_time = args.sim_time
-iterations = args.iterations
-gain = args.gain
-learn_block_time = 2.5
-# to have an extra testing block at t=[0,2.5]
-sim_time += learn_block_time
-device = args.device
-directory = "../data/"
-seed = 0
-convolve = False if experiment <= 3 else True
-decoded = args.decoded
-
-print( exp_string )
-dir_name, dir_images, dir_data = make_timestamped_dir(
-        root=directory + "trevor/" + exp_name + "/" )
-print( "Reserved folder", dir_name )
+def experiment_setup( experiment ):
+    if experiment == 1:
+        exp_string = "PRODUCT experiment"
+        exp_name = "Multiplying two numbers"
+        function_to_learn = lambda x: x[ 0 ] * x[ 1 ]
+        # [ pre, post, ground_truth, error ]
+        neurons = [ 200, 200, 100, 100 ]
+        dimensions = [ 2, 1, 1, 1 ]
+        sim_time = 50
+    if experiment == 2:
+        exp_string = "COMBINED PRODUCTS experiment"
+        exp_name = "Combining two products"
+        function_to_learn = lambda x: x[ 0 ] * x[ 1 ] + x[ 2 ] * x[ 3 ]
+        # [ pre, post, ground_truth, error ]
+        neurons = [ 400, 400, 100, 100 ]
+        dimensions = [ 4, 1, 1, 1 ]
+        sim_time = 100
+    if experiment == 3:
+        exp_string = "SEPARATE PRODUCTS experiment"
+        exp_name = "Three separate products"
+        function_to_learn = lambda x: [ x[ 0 ] * x[ 1 ], x[ 0 ] * x[ 2 ], x[ 1 ] * x[ 2 ] ]
+        # [ pre, post, ground_truth, error ]
+        neurons = [ 300, 300, 300, 300 ]
+        dimensions = [ 3, 3, 3, 3 ]
+        sim_time = 100
+    if experiment == 4:
+        exp_string = "2D CIRCULAR CONVOLUTIONS experiment"
+        exp_name = "Two-dimensional circular convolution"
+        # [ pre, post, ground_truth, error,conv ]
+        neurons = [ 400, 400, 200, 200, 200 ]
+        dimensions = [ 4, 2, 2, 2, 2 ]
+        function_to_learn = lambda x: np.fft.ifft(
+                np.fft.fft( x[ :int( dimensions[ 0 ] / 2 ) ] ) * np.fft.fft( x[ int( dimensions[ 0 ] / 2 ): ] )
+                )
+        sim_time = 200
+    if experiment == 5:
+        exp_string = "3D CIRCULAR CONVOLUTIONS experiment"
+        exp_name = "Three-dimensional circular convolution"
+        # [ pre, post, ground_truth, error,conv ]
+        neurons = [ 600, 300, 300, 300, 300 ]
+        dimensions = [ 6, 3, 3, 3, 3 ]
+        function_to_learn = lambda x: np.fft.ifft(
+                np.fft.fft( x[ :int( dimensions[ 0 ] / 2 ) ] ) * np.fft.fft( x[ int( dimensions[ 0 ] / 2 ): ] )
+                )
+        sim_time = 400
+    
+    assert 'exp_name' in locals()
+    
+    return exp_string, exp_name, function_to_learn, neurons, dimensions, sim_time
 
 
-def LearningModel( neurons, dimensions, learning_rule, function_to_learn, convolve, seed ):
-    global decoded
-    
+def LearningModel( neurons, dimensions, learning_rule, function_to_learn, convolve, seed, sim_time, learn_block_time,
+                   decoded, stateful=False ):
     with nengo.Network() as model:
         
-        nengo_dl.configure_settings( stateful=False )
+        # the state has to carry over between runs to be able to resume from checkpoints
+        nengo_dl.configure_settings( stateful=stateful )
         
         model.inp = nengo.Node(
                 # WhiteNoise( dist=Gaussian( 0, 0.05 ), seed=seed ),
@@ -148,23 +123,17 @@ def LearningModel( neurons, dimensions, learning_rule, function_to_learn, convol
             nengo.Connection( model.post, model.error )
             nengo.Connection( model.ground_truth, model.error, transform=-1 )
             
-            class cyclic_inhibit:
-                def __init__( self, cycle_time ):
-                    self.out_inhibit = 0.0
-                    self.cycle_time = cycle_time
-                
-                def step( self, t ):
-                    if t % self.cycle_time == 0:
-                        if self.out_inhibit == 0.0:
-                            self.out_inhibit = 2.0
-                        else:
-                            self.out_inhibit = 0.0
-                    
-                    return self.out_inhibit
-            
-            model.inhib = nengo.Node( cyclic_inhibit( learn_block_time ).step )
+            # inhibit the error during every other block, starting with the testing block at t=[0,learn_block_time],
+            # so that learning alternates with testing
+            model.inhib = nengo.Node( Schedule( [ (0, PresentInput( [ 2.0 ], learn_block_time )),
+                                                  (learn_block_time, PresentInput( [ 0.0 ], learn_block_time )) ],
+                                                period=2 * learn_block_time ),
+                                      size_out=1 )
             nengo.Connection( model.inhib, model.error.neurons,
                               transform=[ [ -1 ] ] * model.error.n_neurons )
+            if isinstance( learning_rule, mPES ):
+                # and switch mPES off during the testing blocks, instead of it only seeing a small error
+                learning_rule.stop_learning = model.inhib
         else:
             model.conn = nengo.Connection(
                     model.pre,
@@ -172,58 +141,49 @@ def LearningModel( neurons, dimensions, learning_rule, function_to_learn, convol
                     function=function_to_learn
                     )
         
-        # -- probes
-        model.pre_probe = nengo.Probe( model.pre, synapse=0.01 )
-        model.post_probe = nengo.Probe( model.post, synapse=0.01 )
-        model.ground_truth_probe = nengo.Probe( model.ground_truth, synapse=0.01 )
-        # function_learning_model.error_probe = nengo.Probe( function_learning_model.error, synapse=0.03 )
+        # -- per-block testing error, integrated during the simulation instead of probing post and ground_truth
+        model.block_error = BlockErrorAccumulator.setup( model.post, model.ground_truth, learn_block_time, sim_time )
     
     return model
 
 
-# trail runs for each model
-errors_iterations_mpes = [ ]
-errors_iterations_pes = [ ]
-errors_iterations_nef = [ ]
-for i in range( iterations ):
+def run_arm( arm, iteration, experiment, sim_time, learn_block_time, gain, decoded, device, seed, checkpoint_dir ):
+    _, _, function_to_learn, neurons, dimensions, _ = experiment_setup( experiment )
+    convolve = False if experiment <= 3 else True
     
-    learned_model_mpes = LearningModel( neurons, dimensions, mPES( gain=gain ), function_to_learn,
-                                        convolve=convolve, seed=seed + i )
-    control_model_pes = LearningModel( neurons, dimensions, PES(), function_to_learn,
-                                       convolve=convolve, seed=seed + i )
-    control_model_nef = LearningModel( neurons, dimensions, None, function_to_learn,
-                                       convolve=convolve, seed=seed + i )
+    if arm == "mPES":
+        learning_rule = mPES( gain=gain )
+    if arm == "PES":
+        learning_rule = PES()
+    if arm == "NEF":
+        learning_rule = None
     
-    print( "Iteration", i )
-    with nengo_dl.Simulator( learned_model_mpes, device=device ) as sim_mpes:
-        print( "Learning network (mPES)" )
-        sim_mpes.run( sim_time )
-    with nengo_dl.Simulator( control_model_pes, device=device ) as sim_pes:
-        print( "Control network (PES)" )
-        sim_pes.run( sim_time )
-    with nengo_dl.Simulator( control_model_nef, device=device ) as sim_nef:
-        print( "Control network (NEF)" )
-        sim_nef.run( sim_time )
+    model = LearningModel( neurons, dimensions, learning_rule, function_to_learn,
+                           convolve=convolve, seed=seed + iteration, sim_time=sim_time,
+                           learn_block_time=learn_block_time, decoded=decoded,
+                           stateful=checkpoint_dir is not None )
+    with nengo_dl.Simulator( model, device=device, progress_bar=False ) as sim:
+        print( f"Iteration {iteration}: {'Learning' if arm == 'mPES' else 'Control'} network ({arm})" )
+        if checkpoint_dir is not None:
+            from memristor_nengo.checkpoint import run_with_checkpoints
+            
+            run_with_checkpoints( sim, sim_time, os.path.join( checkpoint_dir, f"{arm}_{iteration}.npz" ),
+                                  checkpoint_every=50,
+                                  extra={ "block_errors": model.block_error.totals },
+                                  verbose=False )
+        else:
+            sim.run( sim_time )
     
-    # essential statistics
-    num_blocks = int( sim_time / learn_block_time )
-    num_testing_blocks = int( num_blocks / 2 )
-    for sim, mod, lst in zip( [ sim_mpes, sim_pes, sim_nef ],
-                              [ learned_model_mpes, control_model_pes, control_model_nef ],
-                              [ errors_iterations_mpes, errors_iterations_pes, errors_iterations_nef ] ):
-        # split probe data into the trial run blocks
-        ground_truth_data = np.array_split( sim.data[ mod.ground_truth_probe ], sim_time / learn_block_time )
-        post_data = np.array_split( sim.data[ mod.post_probe ], sim_time / learn_block_time )
-        # extract learning blocks
-        train_ground_truth_data = np.array( [ x for i, x in enumerate( ground_truth_data ) if i % 2 != 0 ] )
-        test_ground_truth_data = np.array( [ x for i, x in enumerate( ground_truth_data ) if i % 2 == 0 ] )
-        # extract testing blocks
-        train_post_data = np.array( [ x for i, x in enumerate( post_data ) if i % 2 != 0 ] )
-        test_post_data = np.array( [ x for i, x in enumerate( post_data ) if i % 2 == 0 ] )
-        
-        # compute testing error for learn network
-        total_error = np.sum( np.sum( np.abs( test_post_data - test_ground_truth_data ), axis=1 ), axis=1 )
-        lst.append( total_error )
+    return model.block_error.get_block_errors()
+
+
+def init_worker( threads ):
+    import tensorflow as tf
+    
+    setup()
+    # share the cores between the workers instead of letting each of them grab all of them
+    tf.config.threading.set_intra_op_parallelism_threads( threads )
+    tf.config.threading.set_inter_op_parallelism_threads( threads )
 
 
 # 95% confidence interval
@@ -237,54 +197,123 @@ def ci( data, confidence=0.95 ):
            np.mean( data, axis=0 ) - z * np.std( data, axis=0 ) / np.sqrt( len( data ) )
 
 
-# compute mean testing error and confidence intervals
-ci_mpes = ci( errors_iterations_mpes )
-ci_pes = ci( errors_iterations_pes )
-ci_nef = ci( errors_iterations_nef )
-
-# plot testing error
-fig, ax = plt.subplots()
-fig.set_size_inches( (14, 8) )
-plt.title( exp_name )
-x = (np.arange( num_testing_blocks + 1 ) * 2 * learn_block_time).astype( np.int )
-ax.set_ylabel( "Total error" )
-ax.set_xlabel( "Seconds" )
-
-ax.plot( x, ci_mpes[ 0 ], label="Learned (mPES)", c="g" )
-ax.plot( x, ci_mpes[ 1 ], linestyle="--", alpha=0.5, c="g" )
-ax.plot( x, ci_mpes[ 2 ], linestyle="--", alpha=0.5, c="g" )
-ax.plot( x, ci_pes[ 0 ], label="Control (PES)", c="b" )
-ax.plot( x, ci_pes[ 1 ], linestyle="--", alpha=0.5, c="b" )
-ax.plot( x, ci_pes[ 2 ], linestyle="--", alpha=0.5, c="b" )
-ax.plot( x, ci_nef[ 0 ], label="Control (NEF)", c="r" )
-ax.plot( x, ci_nef[ 1 ], linestyle="--", alpha=0.5, c="r" )
-ax.plot( x, ci_nef[ 2 ], linestyle="--", alpha=0.5, c="r" )
-ax.plot( x, ci_mpes[ 0 ], "-gX", markevery=[ 0 ] )
-ax.plot( x, ci_pes[ 0 ], "-bX", markevery=[ 0 ] )
-ax.plot( x, ci_nef[ 0 ], "-rX", markevery=[ 0 ] )
-ax.legend( loc="best" )
-fig.show()
-
-# noinspection PyTypeChecker
-np.savetxt( dir_data + "results.csv",
-            np.squeeze(
-                    np.stack(
-                            (ci_mpes[ 0 ], ci_mpes[ 1 ], ci_mpes[ 2 ],
-                             ci_pes[ 0 ], ci_pes[ 1 ], ci_pes[ 2 ],
-                             ci_nef[ 0 ], ci_nef[ 1 ], ci_nef[ 2 ],
-                             ),
-                            axis=1
-                            )
-                    ),
-            delimiter=",",
-            header="Mean mPES error,CI mPES +,CI mPES -,"
-                   "Mean PES error,CI PES +,CI PES -,"
-                   "Mean NEF error,CI NEF +,CI NEF -,",
-            comments="" )
-print( exp_string )
-print( f"Saved results in {dir_data}" )
-fig.savefig( dir_images + "product" + ".pdf" )
-print( f"Saved plots in {dir_images}" )
-
-end_time = time.time()
-print( f"Elapsed time: {datetime.timedelta( seconds=np.ceil( end_time - start_time ) )} (h:mm:ss)" )
+if __name__ == "__main__":
+    start_time = time.time()
+    
+    setup()
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "-E", "--experiment", choices=[ 1, 2, 3, 4, 5 ], type=int,
+                         help="1: Product 2: Combined product" )
+    parser.add_argument( "-T", "--sim_time", default=None, type=float )
+    parser.add_argument( "-I", "--iterations", default=10, type=int )
+    parser.add_argument( "-g", "--gain", default=1e3, type=float )
+    parser.add_argument( "-d", "--device", default="/cpu:0" )
+    parser.add_argument( "-p", "--processes", default=os.cpu_count(), type=int,
+                         help="Number of worker processes the runs are dispatched to.  Default is the number of cores" )
+    parser.add_argument( "-c", "--checkpoint", default=None,
+                         help="Directory where the runs are periodically checkpointed.  Rerunning the same command "
+                              "with the same directory resumes the unfinished runs" )
+    parser.add_argument( '--decoded', dest='decoded', action='store_true' )
+    parser.add_argument( '--no-decoded', dest='decoded', action='store_false' )
+    parser.set_defaults( decoded=True )
+    args = parser.parse_args()
+    
+    experiment = args.experiment
+    exp_string, exp_name, function_to_learn, neurons, dimensions, sim_time = experiment_setup( experiment )
+    
+    if args.sim_time is not None:
+        sim_time = args.sim_time
+    iterations = args.iterations
+    gain = args.gain
+    learn_block_time = 2.5
+    # to have an extra testing block at t=[0,2.5]
+    sim_time += learn_block_time
+    device = args.device
+    processes = args.processes
+    checkpoint_dir = args.checkpoint
+    if checkpoint_dir is not None:
+        os.makedirs( checkpoint_dir, exist_ok=True )
+    directory = "../data/"
+    seed = 0
+    decoded = args.decoded
+    
+    print( exp_string )
+    dir_name, dir_images, dir_data = make_timestamped_dir(
+            root=directory + "trevor/" + exp_name + "/" )
+    print( "Reserved folder", dir_name )
+    
+    # trail runs for each model
+    # every arm of every iteration is independent so they can all run at the same time
+    runs = [ (arm, i) for i in range( iterations ) for arm in ARMS ]
+    run_args = (experiment, sim_time, learn_block_time, gain, decoded, device, seed, checkpoint_dir)
+    if processes > 1:
+        # TensorFlow is not fork-safe so workers are spawned
+        with ProcessPoolExecutor( max_workers=processes,
+                                  mp_context=get_context( "spawn" ),
+                                  initializer=init_worker,
+                                  initargs=(max( 1, os.cpu_count() // processes ),) ) as executor:
+            futures = { r: executor.submit( run_arm, *r, *run_args ) for r in runs }
+            errors = { r: f.result() for r, f in futures.items() }
+    else:
+        errors = { r: run_arm( *r, *run_args ) for r in runs }
+    
+    errors_iterations_mpes = [ errors[ ("mPES", i) ] for i in range( iterations ) ]
+    errors_iterations_pes = [ errors[ ("PES", i) ] for i in range( iterations ) ]
+    errors_iterations_nef = [ errors[ ("NEF", i) ] for i in range( iterations ) ]
+    
+    # essential statistics
+    num_blocks = int( sim_time / learn_block_time )
+    num_testing_blocks = int( num_blocks / 2 )
+    
+    # compute mean testing error and confidence intervals
+    ci_mpes = ci( errors_iterations_mpes )
+    ci_pes = ci( errors_iterations_pes )
+    ci_nef = ci( errors_iterations_nef )
+    
+    # plot testing error
+    fig, ax = plt.subplots()
+    fig.set_size_inches( (14, 8) )
+    plt.title( exp_name )
+    x = (np.arange( num_testing_blocks + 1 ) * 2 * learn_block_time).astype( np.int )
+    ax.set_ylabel( "Total error" )
+    ax.set_xlabel( "Seconds" )
+    
+    ax.plot( x, ci_mpes[ 0 ], label="Learned (mPES)", c="g" )
+    ax.plot( x, ci_mpes[ 1 ], linestyle="--", alpha=0.5, c="g" )
+    ax.plot( x, ci_mpes[ 2 ], linestyle="--", alpha=0.5, c="g" )
+    ax.plot( x, ci_pes[ 0 ], label="Control (PES)", c="b" )
+    ax.plot( x, ci_pes[ 1 ], linestyle="--", alpha=0.5, c="b" )
+    ax.plot( x, ci_pes[ 2 ], linestyle="--", alpha=0.5, c="b" )
+    ax.plot( x, ci_nef[ 0 ], label="Control (NEF)", c="r" )
+    ax.plot( x, ci_nef[ 1 ], linestyle="--", alpha=0.5, c="r" )
+    ax.plot( x, ci_nef[ 2 ], linestyle="--", alpha=0.5, c="r" )
+    ax.plot( x, ci_mpes[ 0 ], "-gX", markevery=[ 0 ] )
+    ax.plot( x, ci_pes[ 0 ], "-bX", markevery=[ 0 ] )
+    ax.plot( x, ci_nef[ 0 ], "-rX", markevery=[ 0 ] )
+    ax.legend( loc="best" )
+    fig.show()
+    
+    # noinspection PyTypeChecker
+    np.savetxt( dir_data + "results.csv",
+                np.squeeze(
+                        np.stack(
+                                (ci_mpes[ 0 ], ci_mpes[ 1 ], ci_mpes[ 2 ],
+                                 ci_pes[ 0 ], ci_pes[ 1 ], ci_pes[ 2 ],
+                                 ci_nef[ 0 ], ci_nef[ 1 ], ci_nef[ 2 ],
+                                 ),
+                                axis=1
+                                )
+                        ),
+                delimiter=",",
+                header="Mean mPES error,CI mPES +,CI mPES -,"
+                       "Mean PES error,CI PES +,CI PES -,"
+                       "Mean NEF error,CI NEF +,CI NEF -,",
+                comments="" )
+    print( exp_string )
+    print( f"Saved results in {dir_data}" )
+    fig.savefig( dir_images + "product" + ".pdf" )
+    print( f"Saved plots in {dir_images}" )
+    
+    end_time = time.time()
+    print( f"Elapsed time: {datetime.timedelta( seconds=np.ceil( end_time - start_time ) )} (h:mm:ss)" )
@@ -1,7 +1,6 @@
 import argparse
 import time
 
-import nengo_dl
 from nengo.learning_rules import PES
 from nengo.params import Default
 from nengo.processes import WhiteSignal
@@ -38,6 +37,9 @@ parser.add_argument( "-o", "--optimisations", default="run", choices=[ "run", "b
 parser.add_argument( "-s", "--seed", default=None, type=int )
 parser.add_argument( "--plot", default=0, choices=[ 0, 1, 2, 3 ], type=int,
                      help="0: No visual output, 1: Show plots, 2: Save plots, 3: Save data" )
+parser.add_argument( "--render", default="inline", choices=[ "inline", "pool", "detached" ],
+                     help="How saved plots are drawn: in this process, in a pool of worker processes, or in a "
+                          "background process that keeps running after this one exits so a sweep can move on" )
 parser.add_argument( "--verbosity", default=2, choices=[ 0, 1, 2 ], type=int,
                      help="0: No textual output, 1: Only numbers, 2: Full output" )
 parser.add_argument( "-pd", "--plots_directory", default="../data/",
@@ -47,28 +49,56 @@ parser.add_argument( "-d", "--device", default="/cpu:0",
 parser.add_argument( "-lt", "--learn_time", default=3 / 4, type=float )
 parser.add_argument( '--probe', default=1, choices=[ 0, 1, 2 ], type=int,
                      help="0: probing disabled, 1: only probes to calculate statistics, 2: all probes active" )
+parser.add_argument( "-c", "--checkpoint", default=None,
+                     help="File where the simulation state is periodically saved.  If it exists the run resumes from it" )
+parser.add_argument( "-ce", "--checkpoint_every", default=10, type=float,
+                     help="Simulated seconds between checkpoints.  Default is 10" )
+parser.add_argument( "-pp", "--pulse_period", default=1, type=int,
+                     help="Timesteps between memristor pulses, PES updates in between are accumulated.  Default is 1" )
+parser.add_argument( "-cd", "--connection_density", default=None, type=float,
+                     help="Fraction of pre->post synapses that exist, with memristors only on those.  Default is all" )
+parser.add_argument( "-ts", "--tile_shape", default=None, nargs="*", type=int,
+                     help="Size of the crossbar tiles the connection is split in, one value for square tiles" )
+parser.add_argument( "-tw", "--tile_workers", default=None, type=int,
+                     help="Threads updating the crossbar tiles in parallel.  Default is sequential" )
+parser.add_argument( "-pl", "--pulse_levels", default=1, type=int,
+                     help="Pulses given for the largest PES update, smaller ones get proportionally fewer.  Default is 1" )
+parser.add_argument( "-mp", "--max_pulses", default=None, type=int,
+                     help="Store the memristors as integer pulse numbers saturating at this value, with conductances "
+                          "tabulated if all devices are the same.  Default is float resistances" )
+parser.add_argument( "--profile", action="store_true",
+                     help="Time the stages of the mPES update and report them after the run" )
+parser.add_argument( "--estimate", action="store_true",
+                     help="Print the estimated memory and mPES cost of the configuration and exit" )
+parser.add_argument( "--memory_budget", default=None, type=float,
+                     help="Refuse to run if the estimated memory, in GiB, exceeds this" )
+parser.add_argument( "-dp", "--device_parameters", default=None,
+                     help="File of fitted device parameters (see memristor_nengo.fitting) to use instead of noise" )
+parser.add_argument( "-ic", "--input_cache", default=None, nargs="?", const="../data/input_cache/",
+                     help="Directory where the sampled input signal is cached across runs (needs --seed)" )
 
 # TODO read parameters from conf file https://docs.python.org/3/library/configparser.html
 args = parser.parse_args()
 seed = args.seed
-tf.random.set_seed( seed )
 np.random.seed( seed )
 function_string = "lambda x: " + args.function
 function_to_learn = eval( function_string )
+if args.input_cache is not None and seed is None:
+    parser.error( "--input_cache needs a --seed, otherwise the cached signal would be reused by unseeded runs" )
 if len( args.inputs ) not in (1, 2):
     parser.error( 'Either give no values for action, or two, not {}.'.format( len( args.inputs ) ) )
 if len( args.inputs ) == 1:
     if args.inputs[ 0 ] == "sine":
-        input_function_train = input_function_test = Sines( period=4 )
+        input_function_train = input_function_test = Sines( period=4, tabulate=True )
     if args.inputs[ 0 ] == "white":
         input_function_train = input_function_test = WhiteSignal( period=60, high=5, seed=seed )
 if len( args.inputs ) == 2:
     if args.inputs[ 0 ] == "sine":
-        input_function_train = Sines( period=4 )
+        input_function_train = Sines( period=4, tabulate=True )
     if args.inputs[ 0 ] == "white":
         input_function_train = WhiteSignal( period=60, high=5, seed=seed )
     if args.inputs[ 1 ] == "sine":
-        input_function_test = Sines( period=4 )
+        input_function_test = Sines( period=4, tabulate=True )
     if args.inputs[ 1 ] == "white":
         input_function_test = WhiteSignal( period=60, high=5, seed=seed )
 timestep = args.timestep
@@ -107,6 +137,13 @@ if args.verbosity >= 2:
 plots_directory = args.plots_directory
 device = args.device
 probe = args.probe
+checkpoint = args.checkpoint
+checkpoint_every = args.checkpoint_every
+device_parameters = None
+if args.device_parameters is not None:
+    from memristor_nengo.fitting import load_parameters
+    
+    device_parameters = load_parameters( args.device_parameters )
 generate_plots = show_plots = save_plots = save_data = False
 if args.plot >= 1:
     generate_plots = True
@@ -123,6 +160,9 @@ if save_plots or save_data:
 
 learn_time = int( sim_time * args.learn_time )
 n_neurons = np.amax( [ pre_n_neurons, post_n_neurons ] )
+connectivity = None
+if args.connection_density is not None:
+    connectivity = sparse_connectivity( (post_n_neurons, pre_n_neurons), args.connection_density, seed=seed )
 if optimisations == "build":
     optimize = False
     sample_every = timestep
@@ -140,10 +180,18 @@ printlv2( f"Using {optimisations} optimisation" )
 model = nengo.Network( seed=seed )
 with model:
     # Create an input node
+    # seeded, so that the input is the same with and without --input_cache
+    input_process = SwitchInputs( input_function_train,
+                                  input_function_test,
+                                  switch_time=learn_time,
+                                  seed=seed )
+    if args.input_cache is not None:
+        from memristor_nengo.input_cache import cached
+        
+        input_process = cached( input_process, dimensions, sim_time, dt=timestep, seed=seed,
+                                cache_dir=args.input_cache )
     input_node = nengo.Node(
-            output=SwitchInputs( input_function_train,
-                                 input_function_test,
-                                 switch_time=learn_time ),
+            output=input_process,
             size_out=dimensions
             )
     
@@ -171,7 +219,16 @@ with model:
                 noisy=noise_percent,
                 gain=gain,
                 seed=seed,
-                exponent=exponent )
+                exponent=exponent,
+                device_parameters=device_parameters,
+                learn_time=learn_time,
+                pulse_period=args.pulse_period,
+                connectivity=connectivity,
+                tile_shape=args.tile_shape,
+                tile_workers=args.tile_workers,
+                pulse_levels=args.pulse_levels,
+                max_pulses=args.max_pulses,
+                profile=args.profile )
     if learning_rule == "PES":
         conn.learning_rule_type = PES()
     printlv2( "Simulating with", conn.learning_rule_type )
@@ -209,20 +266,69 @@ with model:
             neg_memr_probe = nengo.Probe( conn.learning_rule, "neg_memristors", synapse=None,
                                           sample_every=sample_every )
 
+if args.estimate or args.memory_budget is not None:
+    from memristor_nengo.estimate import calibrate, check_budget, estimate, print_report
+    
+    report = estimate( model, sim_time, dt=timestep, learn_time=learn_time,
+                       calibration=calibrate() if args.estimate else None )
+    if args.estimate:
+        print_report( report )
+        exit()
+    try:
+        check_budget( report, args.memory_budget * 2**30 )
+    except MemoryError as e:
+        print_report( report )
+        exit( e )
+
 # Create the Simulator and run it
 printlv2( f"Backend is {backend}, running on ", end="" )
 if backend == "nengo_core":
     printlv2( "CPU" )
     cm = nengo.Simulator( model, seed=seed, dt=timestep, optimize=optimize, progress_bar=progress_bar )
 if backend == "nengo_dl":
+    # only imported here, as TensorFlow takes seconds to load and is not needed on Nengo Core
+    import nengo_dl
+    import tensorflow as tf
+    
+    import memristor_nengo.learning_rules_dl
+    
+    tf.random.set_seed( seed )
     printlv2( device )
     cm = nengo_dl.Simulator( model, seed=seed, dt=timestep, progress_bar=progress_bar, device=device )
 start_time = time.time()
 with cm as sim:
-    for i in range( simulation_discretisation ):
-        printlv2( f"\nRunning discretised step {i + 1} of {simulation_discretisation}" )
-        sim.run( sim_time / simulation_discretisation )
+    if checkpoint is not None:
+        from memristor_nengo.checkpoint import run_with_checkpoints
+        
+        run_with_checkpoints( sim, sim_time, checkpoint, checkpoint_every, verbose=args.verbosity >= 2 )
+    else:
+        for i in range( simulation_discretisation ):
+            printlv2( f"\nRunning discretised step {i + 1} of {simulation_discretisation}" )
+            sim.run( sim_time / simulation_discretisation )
 printlv2( f"\nTotal time for simulation: {time.strftime( '%H:%M:%S', time.gmtime( time.time() - start_time ) )} s" )
+if args.profile and learning_rule == "mPES":
+    if backend == "nengo_core":
+        from memristor_nengo.profiling import print_profile
+        
+        print_profile( sim )
+    else:
+        print( "Stage timings on NengoDL are available through the TensorFlow profiler under the mPES_* scopes" )
+
+if probe > 1 and learning_rule == "mPES":
+    pos_memr = sim.data[ pos_memr_probe ]
+    neg_memr = sim.data[ neg_memr_probe ]
+    if args.max_pulses is not None:
+        from memristor_nengo.learning_rules import SimmPES
+        from memristor_nengo.trajectories import resistance
+        
+        # the probes hold the pulse number of each device, turn them into resistances with the device's parameters
+        op = next( op for op in sim.model.operators
+                   if isinstance( op, SimmPES ) and op.weights is sim.model.sig[ conn ][ "weights" ] )
+        pos_memr = resistance( pos_memr, op.r_min, op.r_max, op.exponent )
+        neg_memr = resistance( neg_memr, op.neg_r_min, op.neg_r_max, op.neg_exponent )
+    if connectivity is not None:
+        pos_memr = synapses_to_dense( pos_memr, connectivity )
+        neg_memr = synapses_to_dense( neg_memr, connectivity )
 
 if probe > 0:
     # essential statistics
@@ -255,56 +361,74 @@ if probe > 1:
 
 plots = { }
 if generate_plots and probe > 1:
-    plotter = Plotter( sim.trange( sample_every=sample_every ), post_n_neurons, pre_n_neurons, dimensions,
-                       learn_time,
-                       sample_every,
-                       plot_size=(13, 7),
-                       dpi=300,
-                       pre_alpha=0.3
-                       )
-    plots[ "results_smooth" ] = plotter.plot_results( sim.data[ input_node_probe ], sim.data[ pre_probe ],
-                                                      sim.data[ post_probe ],
-                                                      error=
-                                                      sim.data[ post_probe ] -
-                                                      function_to_learn( sim.data[ pre_probe ] ),
-                                                      smooth=True )
-    plots[ "results" ] = plotter.plot_results( sim.data[ input_node_probe ], sim.data[ pre_probe ],
-                                               sim.data[ post_probe ],
-                                               error=
-                                               sim.data[ post_probe ] -
-                                               function_to_learn( sim.data[ pre_probe ] ),
-                                               smooth=False )
-    plots[ "post_spikes" ] = plotter.plot_ensemble_spikes( "Post", sim.data[ post_spikes_probe ],
-                                                           sim.data[ post_probe ] )
-    plots[ "weights" ] = plotter.plot_weight_matrices_over_time( sim.data[ weight_probe ], sample_every=sample_every )
+    from memristor_nengo.figures import figure_names, make_figure, make_plotter
     
-    plots[ "testing_smooth" ] = plotter.plot_testing( function_to_learn( sim.data[ pre_probe ] ),
-                                                      sim.data[ post_probe ],
-                                                      smooth=True )
-    plots[ "testing" ] = plotter.plot_testing( function_to_learn( sim.data[ pre_probe ] ), sim.data[ post_probe ],
-                                               smooth=False )
-    if n_neurons <= 10 and learning_rule == "mPES":
-        plots[ "weights_mpes" ] = plotter.plot_weights_over_time( sim.data[ pos_memr_probe ],
-                                                                  sim.data[ neg_memr_probe ] )
-        plots[ "memristors" ] = plotter.plot_values_over_time( sim.data[ pos_memr_probe ], sim.data[ neg_memr_probe ],
-                                                               value="resistance" )
+    figure_data = {
+            "trange"     : sim.trange( sample_every=sample_every ),
+            "input"      : sim.data[ input_node_probe ],
+            "pre"        : sim.data[ pre_probe ],
+            "post"       : sim.data[ post_probe ],
+            "target"     : function_to_learn( sim.data[ pre_probe ] ),
+            "post_spikes": sim.data[ post_spikes_probe ],
+            "weights"    : sim.data[ weight_probe ],
+            }
+    figure_data[ "error" ] = figure_data[ "post" ] - figure_data[ "target" ]
+    if learning_rule == "mPES":
+        figure_data[ "pos_memristors" ] = pos_memr
+        figure_data[ "neg_memristors" ] = neg_memr
+    plotter_settings = {
+            "rows"         : post_n_neurons,
+            "cols"         : pre_n_neurons,
+            "dimensions"   : dimensions,
+            "learning_time": learn_time,
+            "sampling"     : sample_every,
+            "plot_size"    : (13, 7),
+            "dpi"          : 300,
+            "pre_alpha"    : 0.3,
+            }
+    figure_list = figure_names( learning_rule, n_neurons )
+    
+    if save_plots and args.render != "inline":
+        # draw from saved arrays in a pool started from a separate process, as spawned workers would re-run this script
+        from memristor_nengo.figures import render_detached, write_figure_data
+        
+        figure_dir = write_figure_data( dir_name + "figure_data/", figure_data, plotter_settings )
+        renderer = render_detached( figure_dir, dir_images, figure_list, cleanup=True )
+        if args.render == "pool":
+            renderer.wait()
+            print( f"Saved plots in {dir_images}" )
+        else:
+            print( f"Rendering plots in the background to {dir_images}" )
+    else:
+        plotter = make_plotter( figure_data[ "trange" ], plotter_settings )
+        for name in figure_list:
+            plots[ name ] = make_figure( name, plotter, figure_data )
 
 if save_plots:
     assert generate_plots and probe > 1
     
-    for fig in plots.values():
-        fig.savefig( dir_images + str( i ) + ".pdf" )
-        # fig.savefig( dir_images + str( i ) + ".png" )
-    
-    print( f"Saved plots in {dir_images}" )
+    if plots:
+        for name, fig in plots.items():
+            fig.savefig( dir_images + name + ".pdf" )
+            # fig.savefig( dir_images + name + ".png" )
+        
+        print( f"Saved plots in {dir_images}" )
 
 if save_data:
     save_weights( dir_data, sim.data[ weight_probe ] )
     print( f"Saved NumPy weights in {dir_data}" )
     
-    save_results_to_csv( dir_data, sim.data[ input_node_probe ], sim.data[ pre_probe ], sim.data[ post_probe ],
-                         sim.data[ post_probe ] - function_to_learn( sim.data[ pre_probe ] ) )
-    save_memristors_to_csv( dir_data, sim.data[ pos_memr_probe ], sim.data[ neg_memr_probe ] )
+    # compressed chunks instead of CSV, read back with memristor_nengo.results.ResultsReader
+    from memristor_nengo.results import ResultsWriter
+    
+    with ResultsWriter( dir_data, metadata=vars( args ) ) as results:
+        results.write( "input", sim.data[ input_node_probe ] )
+        results.write( "pre", sim.data[ pre_probe ] )
+        results.write( "post", sim.data[ post_probe ] )
+        results.write( "error", sim.data[ post_probe ] - function_to_learn( sim.data[ pre_probe ] ) )
+        results.write( "pos_resistances", pos_memr )
+        results.write( "neg_resistances", neg_memr )
+        results.write( "weights", 1 / pos_memr - 1 / neg_memr )
     print( f"Saved data in {dir_data}" )
 
 #     TODO save output txt with metrics
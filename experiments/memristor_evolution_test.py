@@ -1,6 +1,8 @@
 import numpy as np
 from sklearn.metrics import mean_squared_error as mse
 
+from memristor_nengo.trajectories import pulse_number, pulse_trajectory
+
 r_min = 1e2
 r_max = 2.5e8
 a = -0.128
@@ -27,13 +29,9 @@ print( r )
 print( r_delta )
 print( np.diff( r_delta ) )
 
-n_2 = [ ]
-r_2 = [ 1e8 ]
-r_delta_2 = [ ]
-
-for i in range( iterations ):
-    n_2.append( ((r_2[ -1 ] - r_min) / r_max)**(1 / a) )
-    r_2.append( r_min + r_max * (n_2[ -1 ] + 1)**a )
+# closed form of the direct method
+n_2 = pulse_number( 1e8, r_min, r_max, a ) + np.arange( iterations )
+r_2 = pulse_trajectory( 1e8, iterations, r_min, r_max, a )
 
 print( "Direct method:" )
 print( n_2 )
@@ -1,5 +1,8 @@
 import argparse
-from subprocess import run
+import time
+from subprocess import DEVNULL, Popen, run
+
+import matplotlib.pyplot as plt
 
 from memristor_nengo.extras import *
 
@@ -13,6 +16,10 @@ parser.add_argument( "-l", "--limits", nargs=2, type=float, required=True )
 parser.add_argument( "-n", "--number", type=int )
 parser.add_argument( "-a", "--averaging", type=int, required=True )
 parser.add_argument( "-d", "--directory", default="../data/" )
+parser.add_argument( "-q", "--queue", default=None,
+                     help="SQLite job queue to dispatch the runs to instead of running them one after the other" )
+parser.add_argument( "-w", "--workers", default=os.cpu_count(), type=int,
+                     help="Number of local workers to start on the queue.  Default is the number of cores" )
 args = parser.parse_args()
 # parameters to search
 function = args.function
@@ -25,6 +32,8 @@ end_par = args.limits[ 1 ]
 num_par = args.number if args.parameter in [ "exponent", "noise", "neurons" ] else end_par - start_par + 1
 num_averaging = args.averaging
 directory = args.directory
+queue_path = args.queue
+num_workers = args.workers
 
 dir_name, dir_images, dir_data = make_timestamped_dir( root=directory + "parameter_search/" + str( parameter ) + "/" )
 print( "Reserved folder", dir_name )
@@ -39,70 +48,91 @@ print( "Number of parameters:", num_parameters )
 print( "Averaging per parameter", num_averaging )
 print( "Total iterations", num_parameters * num_averaging )
 
-mse_list = [ ]
-pearson_list = [ ]
-spearman_list = [ ]
-kendall_list = [ ]
-counter = 0
-for k, par in enumerate( res_list ):
-    print( f"Parameter #{k} ({par})" )
-    it_res_mse = [ ]
-    it_res_pearson = [ ]
-    it_res_spearman = [ ]
-    it_res_kendall = [ ]
-    for avg in range( num_averaging ):
-        counter += 1
-        print( f"[{counter}/{num_parameters * num_averaging}] Averaging #{avg + 1}" )
-        if parameter == "exponent":
-            result = run(
-                    [ "python", "mPES.py", "-v", "-P", str( par ), "-N", str( neurons ), "-f",
-                      str( function ), "-D", str( dimensions ) ]
-                    + [ "-i" ] + inputs,
-                    capture_output=True,
-                    universal_newlines=True )
-        if parameter == "noise":
-            result = run(
-                    [ "python", "mPES.py", "-v", "-n", str( par ), "-N", str( neurons ), "-f", str( function ),
-                      "-D", str( dimensions ) ]
-                    + [ "-i" ] + inputs,
-                    capture_output=True,
-                    universal_newlines=True )
-        if parameter == "neurons":
-            rounded_neurons = str( np.rint( par ).astype( int ) )
-            result = run(
-                    [ "python", "mPES.py", "-v", "-N", str( 100 ), rounded_neurons, str( 100 ), "-N", str( neurons ),
-                      "-f", str( function ), "-D", str( dimensions ) ]
-                    + [ "-i" ] + inputs,
-                    capture_output=True,
-                    universal_newlines=True )
-        if parameter == "gain":
-            result = run(
-                    [ "python", "mPES.py", "-v", "-g", str( par ), "-f", str( function ), "-D", str( dimensions ) ]
-                    + [ "-i" ] + inputs,
-                    capture_output=True,
-                    universal_newlines=True )
-        # save statistics
-        try:
-            mse = np.mean( [ float( i ) for i in result.stdout.split( "\n" )[ 0 ][ 1:-1 ].split( "," ) ] )
-            print( "MSE", mse )
-            it_res_mse.append( mse )
-            pearson = np.mean( [ float( i ) for i in result.stdout.split( "\n" )[ 1 ][ 1:-1 ].split( "," ) ] )
-            print( "Pearson", pearson )
-            it_res_pearson.append( pearson )
-            spearman = np.mean( [ float( i ) for i in result.stdout.split( "\n" )[ 2 ][ 1:-1 ].split( "," ) ] )
-            print( "Spearman", spearman )
-            it_res_spearman.append( spearman )
-            kendall = np.mean( [ float( i ) for i in result.stdout.split( "\n" )[ 3 ][ 1:-1 ].split( "," ) ] )
-            print( "Kendall", kendall )
-            it_res_kendall.append( kendall )
-        except:
-            print( "Ret", result.returncode )
-            print( "Out", result.stdout )
-            print( "Err", result.stderr )
-    mse_list.append( it_res_mse )
-    pearson_list.append( it_res_pearson )
-    spearman_list.append( it_res_spearman )
-    kendall_list.append( it_res_kendall )
+def mpes_command( par ):
+    if parameter == "exponent":
+        return [ "python", "mPES.py", "-v", "-P", str( par ), "-N", str( neurons ), "-f",
+                 str( function ), "-D", str( dimensions ) ] \
+               + [ "-i" ] + inputs
+    if parameter == "noise":
+        return [ "python", "mPES.py", "-v", "-n", str( par ), "-N", str( neurons ), "-f", str( function ),
+                 "-D", str( dimensions ) ] \
+               + [ "-i" ] + inputs
+    if parameter == "neurons":
+        rounded_neurons = str( np.rint( par ).astype( int ) )
+        return [ "python", "mPES.py", "-v", "-N", str( 100 ), rounded_neurons, str( 100 ), "-N", str( neurons ),
+                 "-f", str( function ), "-D", str( dimensions ) ] \
+               + [ "-i" ] + inputs
+    if parameter == "gain":
+        return [ "python", "mPES.py", "-v", "-g", str( par ), "-f", str( function ), "-D", str( dimensions ) ] \
+               + [ "-i" ] + inputs
+
+
+jobs = [ (k, avg, mpes_command( par )) for k, par in enumerate( res_list ) for avg in range( num_averaging ) ]
+
+if queue_path is None:
+    results = [ ]
+    for counter, (k, avg, command) in enumerate( jobs ):
+        if avg == 0:
+            print( f"Parameter #{k} ({res_list[ k ]})" )
+        print( f"[{counter + 1}/{num_parameters * num_averaging}] Averaging #{avg + 1}" )
+        result = run( command, capture_output=True, universal_newlines=True )
+        results.append( (result.returncode, result.stdout, result.stderr) )
+else:
+    from memristor_nengo.job_queue import JobQueue
+    
+    batch = dir_name
+    queue = JobQueue( queue_path )
+    job_ids = queue.put_many( [ { "command": command, "cwd": os.getcwd() } for _, _, command in jobs ],
+                              batch=batch )
+    print( f"Enqueued {len( job_ids )} runs in {queue_path} as batch {batch}" )
+    
+    # local workers are optional, any worker started later or elsewhere on the same queue also helps
+    # they keep polling until the whole batch is finished, so that a job whose worker died is claimed again once its
+    # lease expires, and any of them that dies is replaced
+    def start_worker():
+        return Popen( [ "python", "sweep_worker.py", queue_path, "-b", batch ], stdout=DEVNULL )
+    
+    workers = [ start_worker() for _ in range( num_workers ) ]
+    while not queue.finished( batch ):
+        counts = queue.counts( batch )
+        print( f"[{counts[ 'done' ] + counts[ 'failed' ]}/{len( job_ids )}] runs finished, "
+               f"{counts[ 'running' ]} running" )
+        workers = [ w if w.poll() is None else start_worker() for w in workers ]
+        time.sleep( 10 )
+    for w in workers:
+        w.terminate()
+        w.wait()
+    
+    # jobs given up on after too many expired leases have no result
+    results = [ (result[ "returncode" ], result[ "stdout" ], result[ "stderr" ]) if result is not None
+                else (None, "", "Lease expired too many times")
+                for _, _, _, result in queue.results( batch ) ]
+    queue.close()
+
+mse_list = [ [ ] for _ in res_list ]
+pearson_list = [ [ ] for _ in res_list ]
+spearman_list = [ [ ] for _ in res_list ]
+kendall_list = [ [ ] for _ in res_list ]
+for (k, avg, _), (returncode, stdout, stderr) in zip( jobs, results ):
+    print( f"Parameter #{k} ({res_list[ k ]}), averaging #{avg + 1}" )
+    # save statistics
+    try:
+        mse = np.mean( [ float( i ) for i in stdout.split( "\n" )[ 0 ][ 1:-1 ].split( "," ) ] )
+        print( "MSE", mse )
+        mse_list[ k ].append( mse )
+        pearson = np.mean( [ float( i ) for i in stdout.split( "\n" )[ 1 ][ 1:-1 ].split( "," ) ] )
+        print( "Pearson", pearson )
+        pearson_list[ k ].append( pearson )
+        spearman = np.mean( [ float( i ) for i in stdout.split( "\n" )[ 2 ][ 1:-1 ].split( "," ) ] )
+        print( "Spearman", spearman )
+        spearman_list[ k ].append( spearman )
+        kendall = np.mean( [ float( i ) for i in stdout.split( "\n" )[ 3 ][ 1:-1 ].split( "," ) ] )
+        print( "Kendall", kendall )
+        kendall_list[ k ].append( kendall )
+    except:
+        print( "Ret", returncode )
+        print( "Out", stdout )
+        print( "Err", stderr )
 
 mse_means = np.mean( mse_list, axis=1 )
 pearson_means = np.mean( pearson_list, axis=1 )
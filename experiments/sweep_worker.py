@@ -0,0 +1,66 @@
+import argparse
+import subprocess
+import time
+
+from memristor_nengo.job_queue import JobQueue, default_worker_name
+
+parser = argparse.ArgumentParser()
+parser.add_argument( "queue", help="Path to the SQLite job queue shared with the sweep script" )
+parser.add_argument( "-b", "--batch", default=None,
+                     help="Only claim jobs from this batch.  Default is any batch" )
+parser.add_argument( "-L", "--lease", default=600, type=float,
+                     help="Seconds after which a job claimed by a silent worker is handed out again" )
+parser.add_argument( "-A", "--max_attempts", default=3, type=int,
+                     help="Mark a job as failed once its lease expired this many times.  Default is 3" )
+parser.add_argument( "--poll", default=5, type=float,
+                     help="Seconds to wait before asking again when the queue is empty" )
+parser.add_argument( "--exit_when_empty", action="store_true",
+                     help="Exit instead of waiting for new jobs when nothing is left to claim" )
+args = parser.parse_args()
+
+worker = default_worker_name()
+queue = JobQueue( args.queue, lease_time=args.lease, max_attempts=args.max_attempts )
+print( f"Worker {worker} serving {args.queue}" )
+
+while True:
+    job = queue.claim( worker=worker, batch=args.batch )
+    if job is None:
+        if args.exit_when_empty:
+            break
+        time.sleep( args.poll )
+        continue
+
+    job_id, payload = job
+    print( f"Job #{job_id}: {' '.join( payload[ 'command' ] )}" )
+    process = subprocess.Popen( payload[ "command" ],
+                                cwd=payload.get( "cwd" ),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True )
+    # keep the lease alive while the run is going, and give up on the job if it was handed to another worker
+    lost = False
+    while True:
+        try:
+            stdout, stderr = process.communicate( timeout=args.lease / 3 )
+            break
+        except subprocess.TimeoutExpired:
+            if not queue.renew( job_id, worker=worker ):
+                lost = True
+                process.kill()
+                process.communicate()
+                break
+    if lost:
+        print( f"Job #{job_id} abandoned, its lease was taken over by another worker" )
+        continue
+
+    result = { "returncode": process.returncode, "stdout": stdout, "stderr": stderr }
+    if process.returncode == 0:
+        stored = queue.complete( job_id, result, worker=worker )
+    else:
+        stored = queue.fail( job_id, result, worker=worker )
+    if stored:
+        print( f"Job #{job_id} finished with return code {process.returncode}" )
+    else:
+        print( f"Job #{job_id} finished after its lease was taken over by another worker, result discarded" )
+
+queue.close()
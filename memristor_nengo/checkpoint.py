@@ -0,0 +1,164 @@
+import importlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# major versions of each simulator whose private attributes (_n_steps, _time and NengoDL's _probe_data) are known to
+# work with checkpoints
+SUPPORTED_VERSIONS = { "nengo": (3,), "nengo_dl": (3,) }
+
+
+def is_nengo_dl( sim ):
+    return type( sim ).__module__.startswith( "nengo_dl" )
+
+
+def _check_version( sim ):
+    package = type( sim ).__module__.split( "." )[ 0 ]
+    version = importlib.import_module( package ).__version__
+    private = ("_n_steps", "_time") + (("_probe_data",) if is_nengo_dl( sim ) else ())
+    if int( version.split( "." )[ 0 ] ) not in SUPPORTED_VERSIONS.get( package, () ) \
+            or not all( hasattr( sim, name ) for name in private ):
+        raise RuntimeError( f"Checkpoints rely on private attributes of the {package} simulator and are only supported "
+                            f"with major versions {SUPPORTED_VERSIONS.get( package, () )}, found {version}" )
+
+
+def _core_signals( sim ):
+    # signals are identified by the order in which the (deterministically built) operators touch them,
+    # views share memory with their base and read-only signals are constants so neither is saved
+    signals = [ ]
+    seen = set()
+    for op in sim.model.operators:
+        for sig in op.all_signals:
+            base = sig.base
+            if base not in seen and not base.readonly:
+                seen.add( base )
+                signals.append( base )
+    
+    return signals
+
+
+def _save_core( sim, arrays, meta ):
+    signals = _core_signals( sim )
+    for i, sig in enumerate( signals ):
+        arrays[ f"signal_{i}" ] = sim.signals[ sig ]
+    meta[ "signals" ] = [ (sig.name, list( sig.shape )) for sig in signals ]
+    
+    for i, probe in enumerate( sim.model.probes ):
+        arrays[ f"probe_{i}" ] = np.array( sim.model.params[ probe ] )
+    
+    rng_state = sim.rng.get_state()
+    arrays[ "rng_keys" ] = rng_state[ 1 ]
+    meta[ "rng" ] = [ rng_state[ 0 ], int( rng_state[ 2 ] ), int( rng_state[ 3 ] ), float( rng_state[ 4 ] ) ]
+
+
+def _load_core( sim, arrays, meta ):
+    signals = _core_signals( sim )
+    if [ (sig.name, list( sig.shape )) for sig in signals ] != [ (n, list( s )) for n, s in meta[ "signals" ] ]:
+        raise ValueError( "Checkpoint was saved from a different model or with different build options" )
+    for i, sig in enumerate( signals ):
+        sim.signals[ sig ][ ... ] = arrays[ f"signal_{i}" ]
+    
+    for i, probe in enumerate( sim.model.probes ):
+        sim.model.params[ probe ][ : ] = list( arrays[ f"probe_{i}" ] )
+    
+    kind, pos, has_gauss, cached_gaussian = meta[ "rng" ]
+    sim.rng.set_state( (kind, arrays[ "rng_keys" ], pos, has_gauss, cached_gaussian) )
+
+
+def _save_dl( sim, path, arrays, meta ):
+    # parameters and internal state (memristors, weights, synapses, neurons) are handled by NengoDL itself, its file
+    # is then stored inside the checkpoint so that the two can never get out of step
+    with tempfile.TemporaryDirectory() as tmp:
+        sim.save_params( os.path.join( tmp, "dl" ), include_state=True )
+        with np.load( os.path.join( tmp, "dl.npz" ) ) as f:
+            for key in f.files:
+                arrays[ f"dl_{key}" ] = f[ key ]
+    
+    for i, probe in enumerate( sim.model.probes ):
+        data = sim._probe_data[ probe ]
+        if len( data ) > 0:
+            arrays[ f"probe_{i}" ] = np.concatenate( data, axis=1 )
+
+
+def _load_dl( sim, path, arrays, meta ):
+    with tempfile.TemporaryDirectory() as tmp:
+        np.savez( os.path.join( tmp, "dl.npz" ),
+                  **{ key[ len( "dl_" ): ]: value for key, value in arrays.items() if key.startswith( "dl_" ) } )
+        sim.load_params( os.path.join( tmp, "dl" ), include_state=True )
+    
+    for i, probe in enumerate( sim.model.probes ):
+        key = f"probe_{i}"
+        sim._probe_data[ probe ] = [ arrays[ key ] ] if key in arrays else [ ]
+
+
+def save_checkpoint( sim, path, extra=None ):
+    """Snapshot the state of a Nengo Core or NengoDL simulator, together with the probe data collected so far.
+    
+    ``extra`` is a dictionary of arrays kept outside the simulator (e.g. Python Node state) to be saved alongside.
+    """
+    _check_version( sim )
+    
+    arrays = { }
+    meta = { "n_steps": int( sim.n_steps ), "time": float( sim.time ), "backend": type( sim ).__module__ }
+    
+    if is_nengo_dl( sim ):
+        _save_dl( sim, path, arrays, meta )
+    else:
+        _save_core( sim, arrays, meta )
+    
+    if extra is not None:
+        for name, value in extra.items():
+            arrays[ f"extra_{name}" ] = value
+    arrays[ "meta" ] = np.array( json.dumps( meta ) )
+    
+    # write to the side and move into place so that a crash mid-save never leaves a broken checkpoint
+    tmp_path = path + ".tmp.npz"
+    np.savez( tmp_path, **arrays )
+    os.replace( tmp_path, path )
+
+
+def load_checkpoint( sim, path, extra=None ):
+    """Restore a simulator from a checkpoint written by ``save_checkpoint``.
+    
+    Arrays in ``extra`` are overwritten in place with the values saved with the checkpoint.
+    """
+    _check_version( sim )
+    
+    with np.load( path ) as f:
+        arrays = dict( f )
+    meta = json.loads( str( arrays[ "meta" ] ) )
+    if meta[ "backend" ] != type( sim ).__module__:
+        raise ValueError( f"Checkpoint was saved by {meta[ 'backend' ]}, cannot load it in {type( sim ).__module__}" )
+    
+    if is_nengo_dl( sim ):
+        _load_dl( sim, path, arrays, meta )
+    else:
+        _load_core( sim, arrays, meta )
+    
+    sim._n_steps = meta[ "n_steps" ]
+    sim._time = meta[ "time" ]
+    
+    if extra is not None:
+        for name, value in extra.items():
+            value[ ... ] = arrays[ f"extra_{name}" ]
+
+
+def run_with_checkpoints( sim, time_in_seconds, path, checkpoint_every, extra=None, verbose=True ):
+    """Run the simulator for ``time_in_seconds``, saving a checkpoint to ``path`` every ``checkpoint_every`` seconds.
+    
+    If ``path`` already exists the run is resumed from it, so the same call can simply be repeated after a crash.
+    """
+    if os.path.exists( path ):
+        load_checkpoint( sim, path, extra=extra )
+        if verbose:
+            print( f"Resumed from checkpoint {path} at t={sim.time:.3f} s" )
+    
+    total_steps = int( np.rint( time_in_seconds / sim.dt ) )
+    checkpoint_steps = max( 1, int( np.rint( checkpoint_every / sim.dt ) ) )
+    while sim.n_steps < total_steps:
+        sim.run_steps( min( checkpoint_steps, total_steps - sim.n_steps ) )
+        save_checkpoint( sim, path, extra=extra )
+        if verbose:
+            print( f"Saved checkpoint {path} at t={sim.time:.3f} s" )
@@ -0,0 +1,80 @@
+import numpy as np
+
+from memristor_nengo.trajectories import clip, pulse_number, resistance, resistance2conductance
+
+
+class DeviceModel:
+    """Physics of the simulated memristors, as vectorised kernels for NumPy (Nengo Core) and TensorFlow (NengoDL).
+    
+    Every kernel works elementwise on whole arrays of devices, each with its own ``r_min``, ``r_max`` and ``exponent``.
+    ``update`` takes resistances already brought inside ``[r_min, r_max]`` by ``clip`` and the number of pulses to
+    apply to each device.
+    """
+    
+    # whether devices can also be depressed with negative pulse counts, mPES then pulses both memristors of a pair in
+    # opposite directions instead of only the one on the side of the update
+    bidirectional = False
+    
+    def clip( self, R, r_min, r_max ):
+        return clip( R, r_min, r_max )
+    
+    def update( self, R, pulses, r_min, r_max, exponent ):
+        raise NotImplementedError
+    
+    def to_conductance( self, R, r_min, r_max, gain ):
+        return resistance2conductance( R, r_min, r_max, gain )
+    
+    def tf_clip( self, R, r_min, r_max ):
+        import tensorflow as tf
+        
+        return tf.maximum( tf.minimum( R, r_max ), r_min )
+    
+    def tf_update( self, R, pulses, r_min, r_max, exponent ):
+        raise NotImplementedError
+    
+    def tf_to_conductance( self, R, r_min, r_max, gain ):
+        g_min = 1.0 / r_max
+        g_max = 1.0 / r_min
+        g_norm = (1.0 / R - g_min) / (g_max - g_min)
+        
+        return g_norm * gain
+    
+    def __repr__( self ):
+        return f"{type( self ).__name__}()"
+
+
+class PowerLaw( DeviceModel ):
+    # R(n) = r_min + r_max * n**exponent, each pulse moves the device to the next n
+    
+    def update( self, R, pulses, r_min, r_max, exponent ):
+        n = pulse_number( R, r_min, r_max, exponent )
+        
+        return resistance( n + pulses, r_min, r_max, exponent )
+    
+    def tf_update( self, R, pulses, r_min, r_max, exponent ):
+        import tensorflow as tf
+        
+        n = tf.math.pow( (R - r_min) / r_max, 1 / exponent )
+        
+        return r_min + r_max * tf.math.pow( n + pulses, exponent )
+
+
+class BidirectionalPowerLaw( PowerLaw ):
+    # same curve as PowerLaw but negative pulses move the device back towards r_max, never past the pulse number
+    # that corresponds to r_max itself
+    
+    bidirectional = True
+    
+    def update( self, R, pulses, r_min, r_max, exponent ):
+        n = pulse_number( R, r_min, r_max, exponent )
+        n_first = pulse_number( r_max, r_min, r_max, exponent )
+        
+        return resistance( np.maximum( n + pulses, n_first ), r_min, r_max, exponent )
+    
+    def tf_update( self, R, pulses, r_min, r_max, exponent ):
+        import tensorflow as tf
+        
+        n = tf.math.pow( (R - r_min) / r_max, 1 / exponent )
+        n_first = tf.math.pow( (r_max - r_min) / r_max, 1 / exponent )
+        
+        return r_min + r_max * tf.math.pow( tf.maximum( n + pulses, n_first ), exponent )
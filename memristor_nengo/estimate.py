@@ -0,0 +1,199 @@
+import time
+import warnings
+
+import numpy as np
+
+# bytes that Nengo Core keeps for every probe sample on top of the data, as each one is stored as its own array
+PROBE_SAMPLE_OVERHEAD = 112
+
+
+def _mpes_connections( network ):
+    from memristor_nengo.learning_rules import mPES
+    
+    return [ conn for conn in network.all_connections if isinstance( conn.learning_rule_type, mPES ) ]
+
+
+def _synapses( conn ):
+    mpes = conn.learning_rule_type
+    if mpes.connectivity is not None:
+        from scipy.sparse import csr_matrix
+        
+        connectivity = csr_matrix( mpes.connectivity, dtype=bool )
+        connectivity.eliminate_zeros()
+        
+        return connectivity.nnz
+    
+    return conn.post_obj.size_in * conn.pre_obj.size_out
+
+
+def _state_signals( conn ):
+    # (name, shape, bytes per value) of everything build_mpes allocates for the connection
+    mpes = conn.learning_rule_type
+    synapses = _synapses( conn )
+    if mpes.max_pulses is None:
+        memristor_bytes = 8
+    else:
+        memristor_bytes = 2 if mpes.max_pulses <= np.iinfo( np.int16 ).max else 4
+    
+    signals = [
+            ("weights", (conn.post_obj.size_in, conn.pre_obj.size_out), 8),
+            ("pos_memristors", (synapses,), memristor_bytes),
+            ("neg_memristors", (synapses,), memristor_bytes),
+            ("r_min", (synapses,), 8),
+            ("r_max", (synapses,), 8),
+            ("exponent", (synapses,), 8),
+            ]
+    if mpes.device_parameters is not None and "neg_r_min" in mpes.device_parameters:
+        signals += [ ("neg_r_min", (synapses,), 8), ("neg_r_max", (synapses,), 8), ("neg_exponent", (synapses,), 8) ]
+    if mpes.pulse_period > 1:
+        signals.append( ("delta_sum", (synapses,), 8) )
+    if mpes.max_pulses is not None:
+        # a table only if every device is the same, otherwise conductances are computed from the pulse numbers
+        if not mpes.noise_percentage and mpes.device_parameters is None:
+            signals.append( ("lut", (mpes.max_pulses + 1,), 8) )
+    
+    return signals
+
+
+def _probe_size( probe ):
+    import nengo
+    
+    from memristor_nengo.learning_rules import mPES
+    
+    target = probe.target
+    if isinstance( target, nengo.Connection ) and probe.attr == "weights":
+        return target.post_obj.size_in * target.pre_obj.size_out
+    if isinstance( target, nengo.connection.LearningRule ) and isinstance( target.learning_rule_type, mPES ):
+        if probe.attr in ("pos_memristors", "neg_memristors"):
+            return _synapses( target.connection )
+        if probe.attr in ("pulsed", "skipped"):
+            return 1
+    
+    return probe.size_in
+
+
+def estimate( network, sim_time, dt=0.001, calibration=None, learn_time=None ):
+    """Memory footprint of the mPES state and of all probes, and projected cost of the mPES updates.
+    
+    ``network`` can be an unbuilt ``nengo.Network`` or a built simulator, in which case the sizes of the actual
+    signals are used.  ``calibration`` is the output of ``calibrate``; if given the report also contains the
+    projected seconds spent in the mPES operators, assuming every device is pulsed at every learning step.
+    """
+    report = { "signals": [ ], "probes": [ ], "devices": 0 }
+    
+    built = hasattr( network, "model" )
+    model = network.model if built else None
+    network = model.toplevel if built else network
+    
+    for conn in _mpes_connections( network ):
+        report[ "devices" ] += 2 * _synapses( conn )
+        if built:
+            sigs = dict( model.sig[ conn.learning_rule ] )
+            sigs[ "weights" ] = model.sig[ conn ][ "weights" ]
+            for name, sig in sigs.items():
+                if name in ("weights", "pos_memristors", "neg_memristors"):
+                    report[ "signals" ].append( (f"{conn}.{name}", sig.shape, sig.size * sig.dtype.itemsize) )
+            for op in model.operators:
+                if getattr( op, "weights", None ) is sigs[ "weights" ] and hasattr( op, "r_min" ):
+                    for name in ("r_min", "r_max", "exponent"):
+                        value = getattr( op, name )
+                        report[ "signals" ].append( (f"{conn}.{name}", value.shape, value.nbytes) )
+                        # separate parameters for the negative memristors only if the devices were fitted apart
+                        neg_value = getattr( op, f"neg_{name}" )
+                        if neg_value is not value:
+                            report[ "signals" ].append( (f"{conn}.neg_{name}", neg_value.shape, neg_value.nbytes) )
+                    if op.delta_sum is not None:
+                        report[ "signals" ].append( (f"{conn}.delta_sum", op.delta_sum.shape,
+                                                     op.delta_sum.size * op.delta_sum.dtype.itemsize) )
+                    if op.lut is not None:
+                        report[ "signals" ].append( (f"{conn}.lut", op.lut.shape, op.lut.nbytes) )
+        else:
+            for name, shape, value_bytes in _state_signals( conn ):
+                report[ "signals" ].append( (f"{conn}.{name}", shape, int( np.prod( shape ) ) * value_bytes) )
+    
+    for probe in network.all_probes:
+        sample_every = dt if probe.sample_every is None else probe.sample_every
+        samples = int( np.ceil( sim_time / sample_every ) )
+        size = model.sig[ probe ][ "in" ].size if built else _probe_size( probe )
+        report[ "probes" ].append( (str( probe ), (samples, size), samples * (size * 8 + PROBE_SAMPLE_OVERHEAD)) )
+    
+    report[ "signal_bytes" ] = sum( b for _, _, b in report[ "signals" ] )
+    report[ "probe_bytes" ] = sum( b for _, _, b in report[ "probes" ] )
+    report[ "total_bytes" ] = report[ "signal_bytes" ] + report[ "probe_bytes" ]
+    
+    if calibration is not None:
+        learning_steps = int( np.ceil( (sim_time if learn_time is None else min( learn_time, sim_time )) / dt ) )
+        synapses = report[ "devices" ] / 2
+        report[ "seconds_per_step" ] = synapses * (calibration[ "delta" ] + calibration[ "pulse" ])
+        report[ "seconds" ] = report[ "seconds_per_step" ] * learning_steps
+    
+    return report
+
+
+def calibrate( sizes=(100, 300, 1000), steps=20, device_model=None ):
+    """Time the mPES kernels on this machine and return the seconds per synapse per step of each stage."""
+    from memristor_nengo.device_models import PowerLaw
+    
+    device_model = PowerLaw() if device_model is None else device_model
+    rng = np.random.RandomState( 0 )
+    
+    timings = { "delta": [ ], "pulse": [ ] }
+    for n in sizes:
+        error = rng.normal( size=n )
+        activities = rng.randint( 0, 2, size=n ).astype( float )
+        memristors = rng.normal( 1e8, 1e7, size=(n, n) )
+        r_min = np.full( (n, n), 200. )
+        r_max = np.full( (n, n), 2.3e8 )
+        exponent = np.full( (n, n), -0.146 )
+        
+        start = time.perf_counter()
+        for _ in range( steps ):
+            pes_delta = np.outer( -error, activities )
+            pes_delta[ :, np.rint( activities ) == 0 ] = 0
+            mask = pes_delta > 0
+        timings[ "delta" ].append( (time.perf_counter() - start) / (steps * n * n) )
+        
+        start = time.perf_counter()
+        for _ in range( steps ):
+            # both memristors of every pair, as an upper bound
+            for _ in range( 2 ):
+                updated = device_model.update( device_model.clip( memristors[ mask ], r_min[ mask ], r_max[ mask ] ),
+                                               1, r_min[ mask ], r_max[ mask ], exponent[ mask ] )
+                device_model.to_conductance( updated, r_min[ mask ], r_max[ mask ], 1 )
+        timings[ "pulse" ].append( (time.perf_counter() - start) / (steps * np.count_nonzero( mask ) or 1) )
+    
+    # the largest size is the most representative of the networks whose cost matters
+    return { stage: values[ -1 ] for stage, values in timings.items() }
+
+
+def format_bytes( n ):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    
+    return f"{n:.1f} TiB"
+
+
+def print_report( report ):
+    print( "mPES state:" )
+    for name, shape, nbytes in report[ "signals" ]:
+        print( f"  {name:<60} {str( shape ):>20} {format_bytes( nbytes ):>12}" )
+    print( "Probes:" )
+    for name, shape, nbytes in report[ "probes" ]:
+        print( f"  {name:<60} {str( shape ):>20} {format_bytes( nbytes ):>12}" )
+    print( f"Total: {format_bytes( report[ 'total_bytes' ] )} ({format_bytes( report[ 'signal_bytes' ] )} state, "
+           f"{format_bytes( report[ 'probe_bytes' ] )} probes) for {report[ 'devices' ]} memristors" )
+    if "seconds" in report:
+        print( f"Projected mPES cost: {report[ 'seconds_per_step' ] * 1e3:.3f} ms per learning step, "
+               f"{report[ 'seconds' ]:.1f} s in total" )
+
+
+def check_budget( report, budget_bytes, warn_fraction=0.8 ):
+    # refuse configurations that do not fit, warn when they come close
+    if report[ "total_bytes" ] > budget_bytes:
+        raise MemoryError( f"Estimated {format_bytes( report[ 'total_bytes' ] )} exceeds the budget of "
+                           f"{format_bytes( budget_bytes )}" )
+    if report[ "total_bytes" ] > warn_fraction * budget_bytes:
+        warnings.warn( f"Estimated {format_bytes( report[ 'total_bytes' ] )} is over {warn_fraction:.0%} of the "
+                       f"budget of {format_bytes( budget_bytes )}" )
@@ -1,15 +1,13 @@
 import datetime
 import os
 
-import matplotlib.pyplot as plt
 import nengo
 import numpy as np
-import tensorflow as tf
-from nengo.processes import Process
-from nengo.utils.matplotlib import rasterplot
+from nengo.processes import PresentInput, Process, WhiteSignal
 
 
 def setup():
+    import logging
     import sys
     
     os.environ[ "CUDA_DEVICE_ORDER" ] = "PCI_BUS_ID"
@@ -20,50 +18,160 @@ def setup():
     # for rosa
     sys.path.append( ".." )
     
-    tf.compat.v1.logging.set_verbosity( tf.compat.v1.logging.ERROR )
+    # same as tf.compat.v1.logging.set_verbosity, without having to import TensorFlow
+    logging.getLogger( "tensorflow" ).setLevel( logging.ERROR )
 
 
 class Sines( Process ):
     
-    def __init__( self, period=4, **kwargs ):
+    def __init__( self, period=4, tabulate=False, **kwargs ):
         super().__init__( default_size_in=0, **kwargs )
         
         self.period = period
+        # precompute one period of the output and return rows of the table instead of evaluating the sines
+        self.tabulate = tabulate
+    
+    def _sines( self, shape_out, dt ):
+        # phase shifted sines, one per dimension, and one period of them if they are tabulated
+        omega = 2 * np.pi / self.period
+        phases = np.arange( shape_out[ 0 ] ) * (2 * np.pi) / shape_out[ 0 ]
+        
+        steps_per_period = self.period / dt
+        if self.tabulate and np.isclose( steps_per_period, np.rint( steps_per_period ) ):
+            table = np.sin( omega * dt * np.arange( int( np.rint( steps_per_period ) ) )[ :, None ] + phases )
+        else:
+            table = None
+        
+        return omega, phases, table
     
     def make_step( self, shape_in, shape_out, dt, rng, state ):
-        # iteratively build phase shifted sines
-        s = "lambda t: ("
-        phase_shift = (2 * np.pi) / shape_out[ 0 ]
-        for i in range( shape_out[ 0 ] ):
-            s += f"np.sin( 1 / {self.period} * 2 * np.pi * t + {i * phase_shift}),"
-        s += ")"
-        signal = eval( s )
+        omega, phases, table = self._sines( shape_out, dt )
         
-        def step_sines( t ):
-            return signal( t )
+        if table is not None:
+            def step_sines( t ):
+                return table[ int( np.rint( t / dt ) ) % len( table ) ]
+        else:
+            def step_sines( t ):
+                return np.sin( omega * t + phases )
         
         return step_sines
+    
+    def make_batch_step( self, shape_in, shape_out, dt, rng, state ):
+        # the outputs at a whole array of times in one call, see Schedule
+        omega, phases, table = self._sines( shape_out, dt )
+        
+        if table is not None:
+            def batch_step_sines( t ):
+                return table[ np.rint( t / dt ).astype( int ) % len( table ) ]
+        else:
+            def batch_step_sines( t ):
+                return np.sin( omega * t[ :, None ] + phases )
+        
+        return batch_step_sines
+
+
+def make_batch_step( process, shape_in, shape_out, dt, rng, state ):
+    """Step function of ``process`` that takes an array of times and returns the outputs at all of them at once.
+    
+    Processes can provide their own ``make_batch_step``; ``PresentInput`` is indexed directly and ``WhiteSignal``,
+    which repeats every ``period``, is tabulated over one period.  Any other process is evaluated one time at a time.
+    """
+    if hasattr( process, "make_batch_step" ):
+        return process.make_batch_step( shape_in, shape_out, dt, rng, state )
+    
+    if isinstance( process, PresentInput ):
+        inputs = process.inputs.reshape( len( process.inputs ), -1 )
+        presentation_time = float( process.presentation_time )
+        
+        def batch_step_presentinput( t ):
+            # same index as PresentInput.make_step
+            return inputs[ ((t - dt) / presentation_time + 1e-7).astype( int ) % len( inputs ) ]
+        
+        return batch_step_presentinput
+    
+    step = process.make_step( shape_in, shape_out, dt, rng, state )
+    
+    steps_per_period = process.period / dt if isinstance( process, WhiteSignal ) else None
+    if steps_per_period is not None and np.isclose( steps_per_period, np.rint( steps_per_period ) ):
+        table = np.array( [ step( i * dt ) for i in range( int( np.rint( steps_per_period ) ) ) ] )
+        
+        def batch_step_table( t ):
+            return table[ np.rint( t / dt ).astype( int ) % len( table ) ]
+        
+        return batch_step_table
+    
+    def batch_step( t ):
+        return np.array( [ step( t_k ) for t_k in t ] ).reshape( (len( t ),) + tuple( shape_out ) )
+    
+    return batch_step
+
+
+class Schedule( Process ):
+    """Output of a sequence of Processes, each active from its start time until the next phase begins.
+    
+    ``phases`` is a list of ``(start_time, Process)``; if ``period`` is given the schedule repeats every ``period``
+    seconds.  The active phase is looked up from a per-step table and the outputs are generated ``batch_steps`` at a
+    time, every phase with a single call to its ``make_batch_step`` function, so the sub-processes must not take any
+    input.  Sub-processes that cannot be evaluated on an array of times are still stepped one time at a time.
+    """
+    
+    def __init__( self, phases, period=None, batch_steps=1000, **kwargs ):
+        phases = sorted( phases, key=lambda phase: phase[ 0 ] )
+        assert all( issubclass( process.__class__, Process ) for _, process in phases ), \
+            f"Expected nengo Processes, got {[ process.__class__ for _, process in phases ]} instead"
+        assert phases[ 0 ][ 0 ] <= 0, "The first phase has to start at time 0"
+        
+        super().__init__( default_size_in=0, **kwargs )
+        
+        self.phases = phases
+        self.period = period
+        self.batch_steps = batch_steps
+    
+    def make_step( self, shape_in, shape_out, dt, rng, state ):
+        phase_steps = [ make_batch_step( process, shape_in, shape_out, dt, rng, state ) for _, process in self.phases ]
+        start_steps = np.rint( np.array( [ start for start, _ in self.phases ] ) / dt ).astype( int )
+        
+        if self.period is not None:
+            # the phase of every step in one period, so that lookups are just an index
+            period_steps = int( np.rint( self.period / dt ) )
+            table = np.searchsorted( start_steps, np.arange( period_steps ), side="right" ) - 1
+            
+            def phase_of( i ):
+                return table[ i % period_steps ]
+        else:
+            def phase_of( i ):
+                return np.searchsorted( start_steps, i, side="right" ) - 1
+        
+        batch = { "first": None, "output": np.zeros( (self.batch_steps,) + tuple( shape_out ) ) }
+        
+        def fill( first ):
+            i = first + np.arange( self.batch_steps )
+            phase = phase_of( i )
+            for p in np.unique( phase ):
+                in_phase = phase == p
+                batch[ "output" ][ in_phase ] = phase_steps[ p ]( i[ in_phase ] * dt )
+            batch[ "first" ] = first
+        
+        def step_schedule( t ):
+            i = int( np.rint( t / dt ) )
+            if batch[ "first" ] is None or not 0 <= i - batch[ "first" ] < self.batch_steps:
+                fill( i )
+            
+            return batch[ "output" ][ i - batch[ "first" ] ]
+        
+        return step_schedule
 
 
-class SwitchInputs( Process ):
+class SwitchInputs( Schedule ):
     def __init__( self, pre_switch, post_switch, switch_time, **kwargs ):
         assert issubclass( pre_switch.__class__, Process ) and issubclass( post_switch.__class__, Process ), \
             f"Expected two nengo Processes, got ({pre_switch.__class__},{post_switch.__class__}) instead"
         
-        super().__init__( default_size_in=0, **kwargs )
+        super().__init__( [ (0, pre_switch), (switch_time, post_switch) ], **kwargs )
         
         self.switch_time = switch_time
         self.preswitch_signal = pre_switch
         self.postswitch_signal = post_switch
-    
-    def make_step( self, shape_in, shape_out, dt, rng, state ):
-        preswitch_step = self.preswitch_signal.make_step( shape_in, shape_out, dt, rng, state )
-        postswitch_step = self.postswitch_signal.make_step( shape_in, shape_out, dt, rng, state )
-        
-        def step_switchinputs( t ):
-            return preswitch_step( t ) if t < self.switch_time else postswitch_step( t )
-        
-        return step_switchinputs
 
 
 class ConditionalProbe:
@@ -101,6 +209,73 @@ class ConditionalProbe:
         return np.array( self.probed_data ).T
 
 
+class BlockErrorAccumulator:
+    """Integrate the absolute error over the testing blocks while the simulation runs.
+    
+    Time is split into blocks of ``block_time`` seconds, alternating between testing (even blocks, starting at t=0)
+    and learning (odd blocks); only one total per testing block is kept instead of the full probed signals.
+    """
+    
+    def __init__( self, size_in, block_time, sim_time, dt=0.001 ):
+        self.size_in = size_in
+        self.dt = dt
+        self.steps_per_block = int( np.rint( block_time / dt ) )
+        num_blocks = int( sim_time / block_time )
+        self.totals = np.zeros( int( np.ceil( num_blocks / 2 ) ) )
+    
+    def __call__( self, t, x ):
+        if t > 0:
+            block = (int( np.rint( t / self.dt ) ) - 1) // self.steps_per_block
+            if block % 2 == 0 and block // 2 < len( self.totals ):
+                self.totals[ block // 2 ] += np.sum( np.abs( x ) )
+    
+    @classmethod
+    def setup( cls, obj, target, block_time, sim_time, dt=0.001, synapse=0.01 ):
+        accumulator = BlockErrorAccumulator( obj.size_out, block_time, sim_time, dt )
+        output = nengo.Node( accumulator, size_in=accumulator.size_in )
+        # error = obj - target, filtered like the probes it replaces
+        nengo.Connection( obj, output, synapse=synapse )
+        nengo.Connection( target, output, transform=-1, synapse=synapse )
+        
+        return accumulator
+    
+    def get_block_errors( self ):
+        return self.totals.copy()
+
+
+def _bin_mean( values, bins, axis ):
+    # average consecutive entries along axis into at most `bins` bins, ignoring NaNs (missing sparse synapses)
+    n = values.shape[ axis ]
+    if n <= bins:
+        return values
+    
+    edges = np.linspace( 0, n, bins + 1 ).astype( int )[ :-1 ]
+    finite = np.isfinite( values )
+    sums = np.add.reduceat( np.where( finite, values, 0 ), edges, axis=axis )
+    counts = np.add.reduceat( finite, edges, axis=axis )
+    with np.errstate( invalid="ignore", divide="ignore" ):
+        return sums / counts
+
+
+def _min_max_decimate( values, points ):
+    # keep the minimum and maximum of each bin of rows so that peaks survive the downsampling, each pair in the order
+    # they occur so that monotonic traces stay monotonic, returns the row indices of the kept samples of each column
+    # and their values
+    n = len( values )
+    if n <= points:
+        return np.broadcast_to( np.arange( n ).reshape( (n,) + (1,) * (values.ndim - 1) ), values.shape ), values
+    
+    edges = np.linspace( 0, n, points // 2 + 1 ).astype( int )
+    rows = np.empty( (2 * (len( edges ) - 1),) + values.shape[ 1: ], dtype=int )
+    for b, (start, stop) in enumerate( zip( edges[ :-1 ], edges[ 1: ] ) ):
+        lowest = np.argmin( values[ start:stop ], axis=0 ) + start
+        highest = np.argmax( values[ start:stop ], axis=0 ) + start
+        rows[ 2 * b ] = np.minimum( lowest, highest )
+        rows[ 2 * b + 1 ] = np.maximum( lowest, highest )
+    
+    return rows, np.take_along_axis( values, rows, axis=0 )
+
+
 class Plotter():
     def __init__( self, trange, rows, cols, dimensions, learning_time, sampling, plot_size=(12, 8), dpi=80, dt=0.001,
                   pre_alpha=0.3 ):
@@ -116,6 +291,8 @@ class Plotter():
         self.pre_alpha = pre_alpha
     
     def plot_testing( self, pre, post, smooth=False ):
+        import matplotlib.pyplot as plt
+        
         fig, axes = plt.subplots( 1, 1, sharex=True, sharey=True, squeeze=False )
         fig.set_size_inches( self.plot_sizes )
         
@@ -157,6 +334,8 @@ class Plotter():
         return fig
     
     def plot_results( self, input, pre, post, error, smooth=False ):
+        import matplotlib.pyplot as plt
+        
         fig, axes = plt.subplots( 3, 1, sharex=True, sharey=True, squeeze=False )
         fig.set_size_inches( self.plot_sizes )
         
@@ -225,6 +404,9 @@ class Plotter():
         return fig
     
     def plot_ensemble_spikes( self, name, spikes, decoded ):
+        import matplotlib.pyplot as plt
+        from nengo.utils.matplotlib import rasterplot
+        
         fig, ax1 = plt.subplots()
         fig.set_size_inches( self.plot_sizes )
         ax1 = plt.subplot( 1, 1, 1 )
@@ -243,6 +425,8 @@ class Plotter():
         return fig
     
     def plot_values_over_time( self, pos_memr, neg_memr, value="conductance" ):
+        import matplotlib.pyplot as plt
+        
         if value == "conductance":
             tit = "Conductances"
             pos_memr = 1 / pos_memr
@@ -270,6 +454,8 @@ class Plotter():
         return fig
     
     def plot_weights_over_time( self, pos_memr, neg_memr ):
+        import matplotlib.pyplot as plt
+        
         fig, axes = plt.subplots( self.n_rows, self.n_cols )
         fig.set_size_inches( self.plot_sizes )
         for i in range( axes.shape[ 0 ] ):
@@ -289,14 +475,18 @@ class Plotter():
         
         return fig
     
-    def plot_weight_matrices_over_time( self, weights, n_cols=5, sample_every=0.001 ):
+    def plot_weight_matrices_over_time( self, weights, n_cols=5, sample_every=0.001, max_size=200 ):
+        import matplotlib.pyplot as plt
+        
         n_rows = int( self.learning_time / n_cols ) + 1
         fig, axes = plt.subplots( n_rows, n_cols )
         fig.set_size_inches( self.plot_sizes )
         
         for t, ax in enumerate( axes.flatten() ):
             if t <= self.learning_time:
-                ax.matshow( weights[ int( (t / self.dt) / (sample_every / self.dt) ), ... ],
+                # larger matrices are average pooled, there are not enough pixels to show them anyway
+                matrix = weights[ int( (t / self.dt) / (sample_every / self.dt) ), ... ]
+                ax.matshow( _bin_mean( _bin_mean( matrix, max_size, 0 ), max_size, 1 ),
                             cmap=plt.cm.Blues )
                 ax.set_title( f"{t}" )
                 ax.set_yticklabels( [ ] )
@@ -311,6 +501,125 @@ class Plotter():
         # plt.tight_layout()
         
         return fig
+    
+    
+    # the renderers below draw every synapse into a single image or collection, so they scale to large connections
+    
+    def _learning_values( self, memr ):
+        # (time, synapse) values during learning
+        steps = int( self.learning_time / self.sampling )
+        
+        return memr[ :steps ].reshape( (min( steps, len( memr ) ), -1) )
+    
+    def _synapse_heatmap( self, fig, ax, values, max_time, max_synapses, **kwargs ):
+        image = _bin_mean( _bin_mean( values, max_time, 0 ), max_synapses, 1 ).T
+        extent = (self.time_vector[ 0 ], self.time_vector[ len( values ) - 1 ], 0, values.shape[ 1 ])
+        im = ax.imshow( image, aspect="auto", interpolation="nearest", origin="lower", extent=extent, **kwargs )
+        fig.colorbar( im, ax=ax )
+        ax.set_ylabel( "Synapse" )
+    
+    def plot_values_heatmap( self, pos_memr, neg_memr, value="conductance", max_time=2000, max_synapses=1000 ):
+        import matplotlib.pyplot as plt
+        
+        pos_memr = self._learning_values( pos_memr )
+        neg_memr = self._learning_values( neg_memr )
+        if value == "conductance":
+            tit = "Conductances"
+            pos_memr = 1 / pos_memr
+            neg_memr = 1 / neg_memr
+        if value == "resistance":
+            tit = "Resistances"
+        
+        fig, axes = plt.subplots( 2, 1, sharex=True )
+        fig.set_size_inches( self.plot_sizes )
+        for ax, memr, name in zip( axes, (pos_memr, neg_memr), ("Positive", "Negative") ):
+            self._synapse_heatmap( fig, ax, memr, max_time, max_synapses, cmap="viridis" )
+            ax.set_title( f"{name} memristors" )
+        axes[ -1 ].set_xlabel( "Time (s)" )
+        fig.get_axes()[ 0 ].annotate( f"{tit} over time", (0.5, 0.94),
+                                      xycoords='figure fraction', ha='center',
+                                      fontsize=20
+                                      )
+        
+        return fig
+    
+    def plot_weights_heatmap( self, pos_memr, neg_memr, max_time=2000, max_synapses=1000 ):
+        import matplotlib.pyplot as plt
+        
+        weights = 1 / self._learning_values( pos_memr ) - 1 / self._learning_values( neg_memr )
+        limit = np.nanmax( np.abs( weights ) )
+        
+        fig, ax = plt.subplots()
+        fig.set_size_inches( self.plot_sizes )
+        self._synapse_heatmap( fig, ax, weights, max_time, max_synapses, cmap="RdBu_r", vmin=-limit, vmax=limit )
+        ax.set_xlabel( "Time (s)" )
+        fig.get_axes()[ 0 ].annotate( "Weights over time", (0.5, 0.94),
+                                      xycoords='figure fraction', ha='center',
+                                      fontsize=20
+                                      )
+        
+        return fig
+    
+    def plot_values_decimated( self, pos_memr, neg_memr, value="conductance", max_points=2000, max_traces=1000 ):
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection
+        
+        pos_memr = self._learning_values( pos_memr )
+        neg_memr = self._learning_values( neg_memr )
+        if value == "conductance":
+            tit = "Conductances"
+            pos_memr = 1 / pos_memr
+            neg_memr = 1 / neg_memr
+        if value == "resistance":
+            tit = "Resistances"
+        
+        # evenly spaced subset of the existing synapses
+        synapses = np.flatnonzero( np.all( np.isfinite( pos_memr ), axis=0 ) )
+        if len( synapses ) > max_traces:
+            synapses = synapses[ np.linspace( 0, len( synapses ) - 1, max_traces ).astype( int ) ]
+        
+        fig, ax = plt.subplots()
+        fig.set_size_inches( self.plot_sizes )
+        for memr, colour in ((pos_memr, "r"), (neg_memr, "b")):
+            rows, values = _min_max_decimate( memr[ :, synapses ], max_points )
+            time = np.asarray( self.time_vector )[ rows ]
+            # one polyline per synapse, all drawn by a single artist
+            segments = np.stack( (time, values), axis=-1 ).transpose( 1, 0, 2 )
+            ax.add_collection( LineCollection( segments, colors=colour, linewidths=0.5,
+                                               alpha=max( 0.02, min( 1.0, 10 / len( synapses ) ) ) ) )
+        ax.autoscale()
+        ax.set_xlabel( "Time (s)" )
+        fig.get_axes()[ 0 ].annotate( f"{tit} over time ({len( synapses )} synapses)", (0.5, 0.94),
+                                      xycoords='figure fraction', ha='center',
+                                      fontsize=20
+                                      )
+        
+        return fig
+
+
+def sparse_connectivity( shape, density, seed=None ):
+    # random (post, pre) connectivity for mPES, each synapse exists with probability `density`
+    from scipy.sparse import random
+    
+    connectivity = random( shape[ 0 ], shape[ 1 ], density=density, format="csr", random_state=seed )
+    connectivity.data[ : ] = 1
+    
+    return connectivity.astype( bool )
+
+
+def synapses_to_dense( values, connectivity, fill=np.nan ):
+    # expand values probed from a sparse mPES connection, with shape (..., synapses), to (..., post, pre)
+    from scipy.sparse import csr_matrix
+    
+    connectivity = csr_matrix( connectivity, dtype=bool )
+    connectivity.eliminate_zeros()
+    connectivity.sort_indices()
+    rows = np.repeat( np.arange( connectivity.shape[ 0 ] ), np.diff( connectivity.indptr ) )
+    
+    dense = np.full( values.shape[ :-1 ] + connectivity.shape, fill )
+    dense[ ..., rows, connectivity.indices ] = values
+    
+    return dense
 
 
 def make_timestamped_dir( root=None ):
@@ -0,0 +1,153 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+
+# Renders the mPES.py figures from saved result arrays, so that they can be drawn in parallel worker processes or in a
+# detached process that keeps going while the next run of a sweep starts.
+
+def _results( plotter, data, smooth ):
+    return plotter.plot_results( data[ "input" ], data[ "pre" ], data[ "post" ], error=data[ "error" ], smooth=smooth )
+
+
+def _post_spikes( plotter, data ):
+    return plotter.plot_ensemble_spikes( "Post", data[ "post_spikes" ], data[ "post" ] )
+
+
+def _weights( plotter, data ):
+    return plotter.plot_weight_matrices_over_time( data[ "weights" ], sample_every=plotter.sampling )
+
+
+def _testing( plotter, data, smooth ):
+    return plotter.plot_testing( data[ "target" ], data[ "post" ], smooth=smooth )
+
+
+def _memristors( renderer, plotter, data, **kwargs ):
+    return getattr( plotter, renderer )( data[ "pos_memristors" ], data[ "neg_memristors" ], **kwargs )
+
+
+MEMRISTORS = ("pos_memristors", "neg_memristors")
+
+# name: (datasets needed, function drawing the figure from a Plotter and the datasets)
+FIGURES = {
+        "results_smooth"    : (("input", "pre", "post", "error"), partial( _results, smooth=True )),
+        "results"           : (("input", "pre", "post", "error"), partial( _results, smooth=False )),
+        "post_spikes"       : (("post_spikes", "post"), _post_spikes),
+        "weights"           : (("weights",), _weights),
+        "testing_smooth"    : (("target", "post"), partial( _testing, smooth=True )),
+        "testing"           : (("target", "post"), partial( _testing, smooth=False )),
+        "weights_mpes"      : (MEMRISTORS, partial( _memristors, "plot_weights_over_time" )),
+        "memristors"        : (MEMRISTORS, partial( _memristors, "plot_values_over_time", value="resistance" )),
+        "weights_heatmap"   : (MEMRISTORS, partial( _memristors, "plot_weights_heatmap" )),
+        "memristors_heatmap": (MEMRISTORS, partial( _memristors, "plot_values_heatmap", value="resistance" )),
+        }
+
+
+def figure_names( learning_rule, n_neurons ):
+    names = [ "results_smooth", "results", "post_spikes", "weights", "testing_smooth", "testing" ]
+    if learning_rule == "mPES":
+        # one subplot per synapse does not scale, draw all of them in a single image instead
+        names += [ "weights_mpes", "memristors" ] if n_neurons <= 10 else [ "weights_heatmap", "memristors_heatmap" ]
+    
+    return names
+
+
+def make_plotter( trange, settings ):
+    from memristor_nengo.extras import Plotter
+    
+    return Plotter( trange, **settings )
+
+
+def make_figure( name, plotter, data ):
+    return FIGURES[ name ][ 1 ]( plotter, data )
+
+
+def write_figure_data( dir, data, plotter_settings ):
+    from memristor_nengo.results import ResultsWriter
+    
+    with ResultsWriter( dir, compress=False, metadata={ "plotter": plotter_settings } ) as results:
+        for name, array in data.items():
+            results.write( name, array )
+    
+    return dir
+
+
+def render( data_dir, name, out_dir, format="pdf" ):
+    # runs in a worker, so it has to pick the non-interactive backend before pyplot is imported
+    import matplotlib
+    
+    matplotlib.use( "Agg" )
+    import matplotlib.pyplot as plt
+    
+    from memristor_nengo.results import ResultsReader
+    
+    results = ResultsReader( data_dir )
+    plotter = make_plotter( results[ "trange" ][ : ], results.metadata[ "plotter" ] )
+    data = { dataset: results[ dataset ][ : ] for dataset in FIGURES[ name ][ 0 ] }
+    
+    fig = make_figure( name, plotter, data )
+    path = os.path.join( out_dir, f"{name}.{format}" )
+    fig.savefig( path )
+    plt.close( fig )
+    
+    return path
+
+
+def render_all( data_dir, out_dir, names, workers=None, format="pdf" ):
+    """Render and save the figures in ``names`` in a pool of worker processes, returns the saved paths.
+    
+    The workers are spawned, so the calling script needs an ``if __name__ == "__main__"`` guard; otherwise use
+    ``render_detached``, which runs the pool from this module.
+    """
+    workers = min( len( names ), os.cpu_count() or 1 ) if workers is None else workers
+    with ProcessPoolExecutor( max_workers=workers, mp_context=get_context( "spawn" ) ) as executor:
+        futures = [ executor.submit( render, data_dir, name, out_dir, format ) for name in names ]
+        
+        return [ future.result() for future in futures ]
+
+
+def render_detached( data_dir, out_dir, names, workers=None, format="pdf", cleanup=False ):
+    """Start a separate process running ``render_all`` and return its ``Popen`` without waiting for it.
+    
+    The process outlives the caller, so a sweep can start its next run while the figures of the last one are drawn.
+    Its output goes to ``render.log`` in ``out_dir``.  With ``cleanup`` it deletes ``data_dir`` once the figures are
+    saved.
+    """
+    root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+    env = dict( os.environ )
+    env[ "PYTHONPATH" ] = os.pathsep.join( [ root ] + ([ env[ "PYTHONPATH" ] ] if env.get( "PYTHONPATH" ) else [ ]) )
+    command = [ sys.executable, "-m", "memristor_nengo.figures", data_dir, out_dir, "--names", *names,
+                "--format", format ]
+    if workers is not None:
+        command += [ "--workers", str( workers ) ]
+    if cleanup:
+        command += [ "--cleanup" ]
+    
+    with open( os.path.join( out_dir, "render.log" ), "w" ) as log:
+        return subprocess.Popen( command, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "data_dir", help="Directory written by write_figure_data" )
+    parser.add_argument( "out_dir" )
+    parser.add_argument( "--names", nargs="*", default=None, choices=list( FIGURES ) )
+    parser.add_argument( "-w", "--workers", default=None, type=int )
+    parser.add_argument( "--format", default="pdf" )
+    parser.add_argument( "--cleanup", action="store_true", help="Delete data_dir after rendering" )
+    args = parser.parse_args()
+    
+    names = args.names
+    if names is None:
+        from memristor_nengo.results import ResultsReader
+        
+        available = set( ResultsReader( args.data_dir ).names )
+        names = [ name for name, (datasets, _) in FIGURES.items() if available.issuperset( datasets ) ]
+    for path in render_all( args.data_dir, args.out_dir, names, workers=args.workers, format=args.format ):
+        print( f"Saved {path}" )
+    if args.cleanup:
+        shutil.rmtree( args.data_dir )
@@ -0,0 +1,118 @@
+import numpy as np
+
+
+# Batched estimation of the power-law parameters of measured devices.  Measurements are given as an array of
+# resistances with shape (*devices, n_pulses), where entry k is the resistance after k pulses; device i is modelled as
+#   R_i(k) = r_min_i + r_max_i * (k + pulse_offset)**exponent_i
+
+def _linear_fit( log_n, log_R_shifted ):
+    # least squares line through (log_n, log_R_shifted) for every device at once, log_n is shared by all devices
+    x = log_n - np.mean( log_n )
+    y_mean = np.mean( log_R_shifted, axis=-1, keepdims=True )
+    y = log_R_shifted - y_mean
+    slope = (y @ x) / (x @ x)
+    residuals = y - slope[ ..., None ] * x
+    
+    return slope, y_mean[ ..., 0 ] - slope * np.mean( log_n ), np.sum( residuals**2, axis=-1 )
+
+
+def _refine( R, n, r_min, r_max, exponent, iterations ):
+    # Levenberg-Marquardt on the relative error log(R_model) - log(R), run on all devices at once
+    log_R = np.log( R )
+    log_n = np.log( n )
+    theta = np.stack( (r_min, np.log( r_max ), exponent), axis=-1 )
+    damping = np.full( r_min.shape, 1e-3 )
+    r_min_bound = np.min( R, axis=-1 ) * (1 - 1e-9)
+    
+    def model( theta ):
+        g = np.exp( theta[ ..., 1, None ] + theta[ ..., 2, None ] * log_n )
+        
+        return theta[ ..., 0, None ] + g, g
+    
+    def cost( theta ):
+        f, _ = model( theta )
+        
+        return np.sum( (np.log( f ) - log_R)**2, axis=-1 )
+    
+    current_cost = cost( theta )
+    for _ in range( iterations ):
+        f, g = model( theta )
+        residuals = np.log( f ) - log_R
+        J = np.stack( (1 / f, g / f, g * log_n / f), axis=-1 )
+        JTJ = np.einsum( "...ki,...kj->...ij", J, J )
+        JTr = np.einsum( "...ki,...k->...i", J, residuals )
+        A = JTJ + damping[ ..., None, None ] * np.eye( 3 ) * JTJ
+        # pseudo-inverse instead of solve, so that a singular system only costs its own device a step, which then
+        # doesn't improve the cost and leaves that device at its grid estimate
+        A = np.where( np.isfinite( A ), A, 0 )
+        step = (np.linalg.pinv( A ) @ -JTr[ ..., None ])[ ..., 0 ]
+        
+        candidate = theta + step
+        candidate[ ..., 0 ] = np.clip( candidate[ ..., 0 ], 0, r_min_bound )
+        candidate_cost = cost( candidate )
+        # keep the step only for the devices it improved
+        better = candidate_cost < current_cost
+        theta = np.where( better[ ..., None ], candidate, theta )
+        current_cost = np.where( better, candidate_cost, current_cost )
+        damping = np.where( better, damping / 10, damping * 10 )
+    
+    return theta[ ..., 0 ], np.exp( theta[ ..., 1 ] ), theta[ ..., 2 ]
+
+
+def fit_power_law( R, pulse_offset=1, r_min_fractions=None, refine=True, iterations=20 ):
+    """Estimate ``r_min``, ``r_max`` and ``exponent`` for every measured device.
+    
+    For a grid of candidate ``r_min`` (as fractions of each device's lowest resistance) the problem is linear in log
+    space and all devices are solved at once; the best candidate per device is then optionally refined with a batched
+    nonlinear least-squares fit.
+    """
+    R = np.asarray( R, dtype=float )
+    if r_min_fractions is None:
+        r_min_fractions = np.linspace( 0, 0.99, 100 )
+    
+    n = np.arange( R.shape[ -1 ] ) + pulse_offset
+    log_n = np.log( n )
+    R_lowest = np.min( R, axis=-1 )
+    
+    best_cost = np.full( R.shape[ :-1 ], np.inf )
+    r_min = np.zeros( R.shape[ :-1 ] )
+    log_r_max = np.zeros( R.shape[ :-1 ] )
+    exponent = np.zeros( R.shape[ :-1 ] )
+    for fraction in r_min_fractions:
+        candidate_r_min = fraction * R_lowest
+        slope, intercept, cost = _linear_fit( log_n, np.log( R - candidate_r_min[ ..., None ] ) )
+        better = cost < best_cost
+        best_cost = np.where( better, cost, best_cost )
+        r_min = np.where( better, candidate_r_min, r_min )
+        log_r_max = np.where( better, intercept, log_r_max )
+        exponent = np.where( better, slope, exponent )
+    r_max = np.exp( log_r_max )
+    
+    if refine:
+        r_min, r_max, exponent = _refine( R, n, r_min, r_max, exponent, iterations )
+    
+    return { "r_min": r_min, "r_max": r_max, "exponent": exponent, "r_init": R[ ..., 0 ] }
+
+
+def to_mpes_parameters( pos_fit, neg_fit, shape ):
+    # arrange fitted positive and negative devices into the (post, pre) matrices that mPES(device_parameters=...) uses,
+    # the positive memristors get the parameters of the positive devices and the negative ones those of the negative
+    return {
+            "r_min"       : np.reshape( pos_fit[ "r_min" ], shape ),
+            "r_max"       : np.reshape( pos_fit[ "r_max" ], shape ),
+            "exponent"    : np.reshape( pos_fit[ "exponent" ], shape ),
+            "neg_r_min"   : np.reshape( neg_fit[ "r_min" ], shape ),
+            "neg_r_max"   : np.reshape( neg_fit[ "r_max" ], shape ),
+            "neg_exponent": np.reshape( neg_fit[ "exponent" ], shape ),
+            "pos_init"    : np.reshape( pos_fit[ "r_init" ], shape ),
+            "neg_init"    : np.reshape( neg_fit[ "r_init" ], shape ),
+            }
+
+
+def save_parameters( path, parameters ):
+    np.savez( path, **parameters )
+
+
+def load_parameters( path ):
+    with np.load( path ) as f:
+        return dict( f )
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+from nengo.processes import Process
+
+# Sampled input signals stored as .npy files, so that runs that use the same input only pay for generating it once.
+# Files are keyed by the process type and parameters, dt, duration, size and seed and are read back memory-mapped.
+
+DEFAULT_CACHE_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "..", "data", "input_cache" )
+
+
+def _describe( value ):
+    # stable description of a process and its parameters, nested processes included
+    if isinstance( value, Process ):
+        names = set( getattr( value, "params", () ) )
+        names.update( name for name in vars( value ) if not name.startswith( "_" ) )
+        
+        return f"{type( value ).__module__}.{type( value ).__qualname__}(" + \
+            ", ".join( f"{name}={_describe( getattr( value, name ) )}" for name in sorted( names ) ) + ")"
+    if isinstance( value, np.ndarray ):
+        return f"array({value.dtype},{value.shape},{hashlib.sha1( value.tobytes() ).hexdigest()})"
+    if isinstance( value, (list, tuple) ):
+        return "[" + ", ".join( _describe( v ) for v in value ) + "]"
+    if isinstance( value, dict ):
+        return "{" + ", ".join( f"{k}: {_describe( value[ k ] )}" for k in sorted( value ) ) + "}"
+    
+    return repr( value )
+
+
+def cache_key( process, size_out, duration, dt, seed ):
+    description = f"{_describe( process )}|size_out={size_out}|duration={duration}|dt={dt}|seed={seed}"
+    
+    return f"{type( process ).__name__}-{hashlib.sha1( description.encode() ).hexdigest()}"
+
+
+def generate( process, size_out, n_steps, dt, seed=None ):
+    # the output at t = dt, 2 dt, ..., as a Node would see it
+    shape_in, shape_out = (0,), (size_out,)
+    # the same as the simulator does: the process's own seed if it has one, otherwise a draw from a seeded generator
+    rng = process.get_rng( np.random.RandomState( seed ) )
+    state = process.make_state( shape_in, shape_out, dt )
+    step = process.make_step( shape_in, shape_out, dt, rng, state )
+    
+    signal = np.zeros( (n_steps, size_out) )
+    for i in range( n_steps ):
+        signal[ i ] = step( (i + 1) * dt )
+    
+    return signal
+
+
+def cached( process, size_out, duration, dt=0.001, seed=None, cache_dir=None ):
+    """Return a ``CachedSignal`` replaying ``process`` for ``duration`` seconds, generating it only if it is not
+    already in ``cache_dir``.
+    
+    The generator given to ``process`` is derived like Nengo does, from ``process.seed`` if it is set and otherwise
+    from a generator seeded with ``seed``.  Only processes with their own seed are guaranteed to give the same signal
+    as without the cache, as the simulator draws the seeds of unseeded processes in build order.
+    """
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    path = os.path.join( cache_dir, cache_key( process, size_out, duration, dt, seed ) + ".npy" )
+    
+    if not os.path.exists( path ):
+        os.makedirs( cache_dir, exist_ok=True )
+        signal = generate( process, size_out, int( np.ceil( np.round( duration / dt, 6 ) ) ), dt, seed )
+        # write to a temporary file first so that concurrent runs never read a partial array
+        fd, temporary = tempfile.mkstemp( dir=cache_dir, suffix=".npy" )
+        with os.fdopen( fd, "wb" ) as f:
+            np.save( f, signal )
+        os.replace( temporary, path )
+    
+    return CachedSignal( path, dt )
+
+
+class CachedSignal( Process ):
+    """Replay a signal stored in a .npy file, one row per timestep starting at t = dt."""
+    
+    def __init__( self, path, dt, **kwargs ):
+        self.path = path
+        self.signal_dt = dt
+        signal = np.load( path, mmap_mode="r" )
+        
+        super().__init__( default_size_in=0, default_size_out=signal.shape[ 1 ], **kwargs )
+    
+    def _load( self, shape_out, dt ):
+        assert np.isclose( dt, self.signal_dt ), f"Signal was sampled with dt={self.signal_dt}, not {dt}"
+        signal = np.load( self.path, mmap_mode="r" )
+        assert signal.shape[ 1: ] == tuple( shape_out ), \
+            f"Signal has shape {signal.shape[ 1: ]}, expected {tuple( shape_out )}"
+        
+        return signal
+    
+    def make_step( self, shape_in, shape_out, dt, rng, state ):
+        signal = self._load( shape_out, dt )
+        
+        def step_cachedsignal( t ):
+            i = int( np.rint( t / dt ) ) - 1
+            if i >= len( signal ):
+                raise IndexError( f"Cached signal {self.path} ends at t={len( signal ) * dt}" )
+            
+            return signal[ i ]
+        
+        return step_cachedsignal
+    
+    def make_batch_step( self, shape_in, shape_out, dt, rng, state ):
+        # the rows at a whole array of times in one read, see extras.Schedule
+        signal = self._load( shape_out, dt )
+        
+        def batch_step_cachedsignal( t ):
+            i = np.rint( t / dt ).astype( int ) - 1
+            if np.any( i >= len( signal ) ):
+                raise IndexError( f"Cached signal {self.path} ends at t={len( signal ) * dt}" )
+            
+            return signal[ i ]
+        
+        return batch_step_cachedsignal
@@ -0,0 +1,154 @@
+import json
+import os
+import socket
+import sqlite3
+import time
+
+
+class JobQueue:
+    """SQLite-backed queue of run configurations shared by any number of worker processes.
+
+    Jobs are claimed with a lease; a job whose worker dies is handed out again once its lease expires, unless it was
+    already claimed ``max_attempts`` times, in which case it is marked as failed with no result.
+    """
+
+    def __init__( self, path, lease_time=3600, timeout=60, max_attempts=None ):
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+
+        os.makedirs( os.path.dirname( os.path.abspath( path ) ), exist_ok=True )
+        # autocommit mode, transactions are opened explicitly where atomicity matters
+        self.connection = sqlite3.connect( path, timeout=timeout, isolation_level=None )
+        self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "batch TEXT, "
+                "payload TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', "
+                "worker TEXT, "
+                "lease_expires REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "result TEXT)"
+                )
+        self.connection.execute( "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)" )
+
+    def close( self ):
+        self.connection.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.close()
+
+    def put( self, payload, batch=None ):
+        cursor = self.connection.execute( "INSERT INTO jobs (batch, payload) VALUES (?, ?)",
+                                          (batch, json.dumps( payload )) )
+
+        return cursor.lastrowid
+
+    def put_many( self, payloads, batch=None ):
+        self.connection.execute( "BEGIN IMMEDIATE" )
+        try:
+            ids = [ self.connection.execute( "INSERT INTO jobs (batch, payload) VALUES (?, ?)",
+                                             (batch, json.dumps( p )) ).lastrowid
+                    for p in payloads ]
+            self.connection.execute( "COMMIT" )
+        except:
+            self.connection.execute( "ROLLBACK" )
+            raise
+
+        return ids
+
+    def claim( self, worker=None, batch=None ):
+        if worker is None:
+            worker = default_worker_name()
+
+        now = time.time()
+        # take the write lock before looking so that two workers cannot claim the same job
+        self.connection.execute( "BEGIN IMMEDIATE" )
+        try:
+            if self.max_attempts is not None:
+                # give up on jobs that keep taking their workers down with them instead of handing them out forever
+                self.connection.execute(
+                        "UPDATE jobs SET status = 'failed', lease_expires = NULL "
+                        "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                        (now, self.max_attempts) )
+            row = self.connection.execute(
+                    "SELECT id, payload FROM jobs "
+                    "WHERE (status = 'pending' OR (status = 'running' AND lease_expires < ?)) "
+                    "AND (? IS NULL OR batch = ?) "
+                    "ORDER BY id LIMIT 1",
+                    (now, batch, batch) ).fetchone()
+            if row is not None:
+                self.connection.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (worker, now + self.lease_time, row[ 0 ]) )
+            self.connection.execute( "COMMIT" )
+        except:
+            self.connection.execute( "ROLLBACK" )
+            raise
+
+        if row is None:
+            return None
+
+        return row[ 0 ], json.loads( row[ 1 ] )
+
+    def renew( self, job_id, worker=None ):
+        if worker is None:
+            worker = default_worker_name()
+
+        cursor = self.connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_time, job_id, worker) )
+
+        # False if the lease was lost to another worker in the meantime
+        return cursor.rowcount == 1
+
+    def _finish( self, job_id, status, result, worker ):
+        if worker is None:
+            worker = default_worker_name()
+
+        # only the worker still holding the lease may store a result, so a worker whose lease expired cannot
+        # overwrite the result of the one that claimed the job after it
+        cursor = self.connection.execute(
+                "UPDATE jobs SET status = ?, lease_expires = NULL, result = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (status, json.dumps( result ), job_id, worker) )
+
+        # False if the lease was lost to another worker in the meantime
+        return cursor.rowcount == 1
+
+    def complete( self, job_id, result, worker=None ):
+        return self._finish( job_id, "done", result, worker )
+
+    def fail( self, job_id, result, worker=None ):
+        return self._finish( job_id, "failed", result, worker )
+
+    def counts( self, batch=None ):
+        rows = self.connection.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE (? IS NULL OR batch = ?) GROUP BY status",
+                (batch, batch) ).fetchall()
+        counts = { "pending": 0, "running": 0, "done": 0, "failed": 0 }
+        counts.update( dict( rows ) )
+
+        return counts
+
+    def finished( self, batch=None ):
+        counts = self.counts( batch )
+
+        return counts[ "pending" ] == 0 and counts[ "running" ] == 0
+
+    def results( self, batch=None ):
+        rows = self.connection.execute(
+                "SELECT id, payload, status, result FROM jobs WHERE (? IS NULL OR batch = ?) ORDER BY id",
+                (batch, batch) ).fetchall()
+
+        return [ (job_id, json.loads( payload ), status, None if result is None else json.loads( result ))
+                 for job_id, payload, status, result in rows ]
+
+
+def default_worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
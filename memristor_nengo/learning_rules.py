@@ -1,15 +1,20 @@
+import sys
+
 import numpy as np
 
 from nengo.builder import Operator
 from nengo.builder.learning_rules import build_or_passthrough, get_post_ens
+from nengo.exceptions import BuildError
 from nengo.learning_rules import LearningRuleType
 from nengo.params import Default, NumberParam
 from nengo.synapses import Lowpass, SynapseParam
 
+from memristor_nengo.device_models import PowerLaw
+
 
 class mPES( LearningRuleType ):
     modifies = "weights"
-    probeable = ("error", "activities", "delta", "pos_memristors", "neg_memristors")
+    probeable = ("error", "activities", "delta", "pos_memristors", "neg_memristors", "pulsed", "skipped")
     
     pre_synapse = SynapseParam( "pre_synapse", default=Lowpass( tau=0.005 ), readonly=True )
     r_max = NumberParam( "r_max", readonly=True, default=2.3e8 )
@@ -24,7 +29,18 @@ class mPES( LearningRuleType ):
                   exponent=Default,
                   noisy=False,
                   gain=Default,
-                  seed=None ):
+                  seed=None,
+                  device_model=None,
+                  device_parameters=None,
+                  learn_time=None,
+                  stop_learning=None,
+                  pulse_period=1,
+                  connectivity=None,
+                  tile_shape=None,
+                  tile_workers=None,
+                  pulse_levels=1,
+                  max_pulses=None,
+                  profile=False ):
         super().__init__( size_in="post_state" )
         
         self.pre_synapse = pre_synapse
@@ -34,6 +50,29 @@ class mPES( LearningRuleType ):
         self.noise_percentage = 0 if not noisy else noisy
         self.gain = gain
         self.seed = seed
+        self.device_model = PowerLaw() if device_model is None else device_model
+        self.device_parameters = device_parameters
+        # simulation time after which the rule is switched off and stops costing anything, None to always learn
+        self.learn_time = learn_time
+        # nengo.Node that switches the rule off while its output is positive, e.g. the node inhibiting the error
+        # population, so that learning can be stopped and resumed by the phase of the experiment
+        self.stop_learning = stop_learning
+        # number of timesteps between pulses, the PES deltas in between are summed and applied as a single pulse
+        self.pulse_period = pulse_period
+        # (post, pre) mask or scipy.sparse matrix of the synapses that exist, only these get memristors
+        self.connectivity = connectivity
+        # split the crossbar in (rows, columns) tiles that are processed one at a time, optionally by a thread pool
+        self.tile_shape = tile_shape
+        self.tile_workers = tile_workers
+        # number of pulse levels, the largest PES delta gets this many pulses and the others proportionally fewer
+        self.pulse_levels = pulse_levels
+        # devices hold an integer pulse number saturating at max_pulses instead of a resistance, and their
+        # conductances are read from a table precomputed at build time if all devices are the same, or computed from
+        # the pulse number otherwise
+        self.max_pulses = max_pulses
+        # time the stages of the update and count pulsed devices and skipped steps, see memristor_nengo.profiling, the
+        # pulsed and skipped probes are running totals
+        self.profile = profile
     
     @property
     def _argdefaults( self ):
@@ -60,7 +99,26 @@ class SimmPES( Operator ):
             r_min,
             r_max,
             exponent,
+            device_model,
+            time,
+            learn_time,
+            step,
+            pulse_period,
+            delta_sum=None,
+            indptr=None,
+            indices=None,
+            tile_shape=None,
+            tile_workers=None,
+            pulse_levels=1,
+            lut=None,
+            max_pulses=None,
+            pulsed=None,
+            skipped=None,
             states=None,
+            neg_r_min=None,
+            neg_r_max=None,
+            neg_exponent=None,
+            stop_learning=None,
             tag=None
             ):
         super( SimmPES, self ).__init__( tag=tag )
@@ -72,11 +130,33 @@ class SimmPES( Operator ):
         self.r_min = r_min
         self.r_max = r_max
         self.exponent = exponent
+        # parameters of the negative memristors, the same arrays as the positive ones unless the devices were measured
+        self.neg_r_min = r_min if neg_r_min is None else neg_r_min
+        self.neg_r_max = r_max if neg_r_max is None else neg_r_max
+        self.neg_exponent = exponent if neg_exponent is None else neg_exponent
+        self.device_model = device_model
+        self.learn_time = np.inf if learn_time is None else learn_time
+        self.pulse_period = pulse_period
+        # CSR layout of sparse connectivity, the memristor and parameter arrays then only hold the existing synapses
+        # in row-major order
+        self.indptr = indptr
+        self.indices = indices
+        self.tile_shape = tile_shape
+        self.tile_workers = tile_workers
+        self._pool = None
+        self.pulse_levels = pulse_levels
+        self.lut = lut
+        self.max_pulses = max_pulses
+        self.profile = pulsed is not None
+        self.timings = { }
+        self.counts = { }
         
         self.sets = [ ] + ([ ] if states is None else [ states ])
         self.incs = [ ]
-        self.reads = [ pre_filtered, error ]
-        self.updates = [ weights, pos_memristors, neg_memristors ]
+        self.reads = [ pre_filtered, error, time, step ] + ([ ] if stop_learning is None else [ stop_learning ])
+        self.updates = [ weights, pos_memristors, neg_memristors ] \
+                       + ([ ] if delta_sum is None else [ delta_sum ]) \
+                       + ([ ] if pulsed is None else [ pulsed, skipped ])
     
     @property
     def pre_filtered( self ):
@@ -86,6 +166,18 @@ class SimmPES( Operator ):
     def error( self ):
         return self.reads[ 1 ]
     
+    @property
+    def time( self ):
+        return self.reads[ 2 ]
+    
+    @property
+    def step( self ):
+        return self.reads[ 3 ]
+    
+    @property
+    def stop_learning( self ):
+        return self.reads[ 4 ] if len( self.reads ) > 4 else None
+    
     @property
     def weights( self ):
         return self.updates[ 0 ]
@@ -98,111 +190,280 @@ class SimmPES( Operator ):
     def neg_memristors( self ):
         return self.updates[ 2 ]
     
+    @property
+    def delta_sum( self ):
+        return self.updates[ 3 ] if self.pulse_period > 1 else None
+    
+    @property
+    def pulsed( self ):
+        return self.updates[ -2 ] if self.profile else None
+    
+    @property
+    def skipped( self ):
+        return self.updates[ -1 ] if self.profile else None
+    
     def _descstr( self ):
         return "pre=%s, error=%s -> %s" % (self.pre_filtered, self.error, self.weights)
     
+    def _tile_pool( self ):
+        # a single pool for the operator, shared by every simulator built from it and shut down with the operator
+        if self._pool is None:
+            import weakref
+            from concurrent.futures import ThreadPoolExecutor
+            
+            self._pool = ThreadPoolExecutor( self.tile_workers )
+            weakref.finalize( self, self._pool.shutdown, wait=False )
+        
+        return self._pool
+    
     def make_step( self, signals, dt, rng ):
         pre_filtered = signals[ self.pre_filtered ]
         local_error = signals[ self.error ]
+        time = signals[ self.time ]
+        step = signals[ self.step ]
+        stop_learning = signals[ self.stop_learning ] if self.stop_learning is not None else None
         
         pos_memristors = signals[ self.pos_memristors ]
         neg_memristors = signals[ self.neg_memristors ]
         weights = signals[ self.weights ]
+        delta_sum = signals[ self.delta_sum ] if self.delta_sum is not None else None
+        pulsed = signals[ self.pulsed ] if self.profile else None
+        skipped = signals[ self.skipped ] if self.profile else None
         
         gain = self.gain
         error_threshold = self.error_threshold
-        r_min = self.r_min
-        r_max = self.r_max
-        exponent = self.exponent
+        learn_time = self.learn_time
+        pulse_period = self.pulse_period
+        pulse_levels = self.pulse_levels
+        lut = self.lut
+        max_pulses = self.max_pulses
         
-        def step_simmpes():
-            def resistance2conductance( R, r_min, r_max ):
-                g_min = 1.0 / r_max
-                g_max = 1.0 / r_min
-                g_curr = 1.0 / R
-                
-                g_norm = (g_curr - g_min) / (g_max - g_min)
-                
-                return g_norm * gain
+        device_model = self.device_model
+        
+        sparse = self.indptr is not None
+        if sparse:
+            rows = np.repeat( np.arange( len( self.indptr ) - 1 ), np.diff( self.indptr ) )
+            cols = self.indices
+        
+        pos_parameters = (self.r_min, self.r_max, self.exponent)
+        neg_parameters = (self.neg_r_min, self.neg_r_max, self.neg_exponent)
+        shared_parameters = all( n is p for n, p in zip( neg_parameters, pos_parameters ) )
+        
+        # each tile is a view on the crossbar together with its own contiguous copy of the device parameters, so that
+        # the working set of a tile stays in cache
+        if sparse or self.tile_shape is None:
+            tiles = [ ((slice( None ),) * self.r_min.ndim, pos_parameters, neg_parameters) ]
+        else:
+            tile_rows, tile_cols = self.tile_shape
+            tiles = [ ]
+            for i in range( 0, weights.shape[ 0 ], tile_rows ):
+                for j in range( 0, weights.shape[ 1 ], tile_cols ):
+                    idx = (slice( i, i + tile_rows ), slice( j, j + tile_cols ))
+                    pos_tile = tuple( np.ascontiguousarray( p[ idx ] ) for p in pos_parameters )
+                    neg_tile = pos_tile if shared_parameters \
+                        else tuple( np.ascontiguousarray( p[ idx ] ) for p in neg_parameters )
+                    tiles.append( (idx, pos_tile, neg_tile) )
+        
+        pool = self._tile_pool() if self.tile_workers is not None and len( tiles ) > 1 else None
+        
+        clip = device_model.clip
+        update = device_model.update
+        if max_pulses is not None:
+            from memristor_nengo.trajectories import resistance
+        
+        def pulse( memristors, mask, pulses, r_min, r_max, exponent ):
+            # clip values outside [R_0,R_1] and apply all the pulses in one jump
+            r_min_masked = r_min[ mask ]
+            r_max_masked = r_max[ mask ]
+            memristors[ mask ] = update(
+                    clip( memristors[ mask ], r_min_masked, r_max_masked ),
+                    pulses if np.isscalar( pulses ) else pulses[ mask ],
+                    r_min_masked,
+                    r_max_masked,
+                    exponent[ mask ] )
+        
+        def pulse_quantised( memristors, mask, pulses ):
+            # add saturating at the first and last level, widened first so that the narrow state cannot wrap around
+            memristors[ mask ] = np.clip( memristors[ mask ].astype( np.int64 )
+                                          + (pulses if np.isscalar( pulses ) else pulses[ mask ]),
+                                          1, max_pulses )
+        
+        def quantised_conductance( memristors, updated, r_min, r_max, exponent ):
+            # shared table, or the closed form for devices that all differ
+            if lut is not None:
+                return lut[ memristors[ updated ] ]
+            r_min_updated = r_min[ updated ]
+            r_max_updated = r_max[ updated ]
             
-            def find_spikes( input_activities, shape, output_activities=None, invert=False ):
-                output_size = shape[ 0 ]
-                input_size = shape[ 1 ]
-                spiked_pre = np.tile(
-                        np.array( np.rint( input_activities ), dtype=bool ), (output_size, 1)
-                        )
-                spiked_post = np.tile(
-                        np.expand_dims(
-                                np.array( np.rint( output_activities ), dtype=bool ), axis=1 ), (1, input_size)
-                        ) \
-                    if output_activities is not None \
-                    else np.ones( (1, input_size) )
+            return device_model.to_conductance( resistance( memristors[ updated ], r_min_updated, r_max_updated,
+                                                            exponent[ updated ] ),
+                                                r_min_updated, r_max_updated, gain )
+        
+        def local_delta( idx ):
+            # calculate the magnitude of the update based on PES learning rule
+            # local_error = -np.dot( encoders, error )
+            # I can use NengoDL build function like this, as dot(encoders, error) has been done there already
+            # i.e., error already contains the PES local error
+            if sparse:
+                # only the existing synapses
+                pre_synapses = pre_filtered[ cols ]
+                pes_delta = -local_error[ rows ] * pre_synapses
+                pes_delta[ np.rint( pre_synapses ) == 0 ] = 0
+            else:
+                rows_idx, cols_idx = idx
+                pes_delta = np.outer( -local_error[ rows_idx ], pre_filtered[ cols_idx ] )
                 
-                out = np.logical_and( spiked_pre, spiked_post )
-                return out if not invert else np.logical_not( out )
+                # some memristors are adjusted erroneously if we don't filter
+                pes_delta[ :, np.rint( pre_filtered[ cols_idx ] ) == 0 ] = 0
+            
+            return pes_delta
+        
+        def apply_delta( pes_delta, tile, scale ):
+            idx, pos_parameters, neg_parameters = tile
+            
+            # set update direction and magnitude (unused with powerlaw memristor equations)
+            V = np.sign( pes_delta ) * 1e-1
+            
+            # quantise the magnitude of the update to a number of pulses
+            if pulse_levels > 1 and scale > 0:
+                pulses = np.ceil( pulse_levels * np.absolute( pes_delta ) / scale )
+            else:
+                pulses = 1
+            
+            if device_model.bidirectional:
+                # potentiate one memristor of each pair and depress the other
+                pos_mask = neg_mask = V != 0
+                pos_pulses = np.sign( V ) * pulses
+                neg_pulses = -pos_pulses
+            else:
+                # update the two memristor pairs separately
+                pos_mask = V > 0
+                neg_mask = V < 0
+                pos_pulses = neg_pulses = pulses
+            pos = pos_memristors[ idx ]
+            neg = neg_memristors[ idx ]
+            if max_pulses is None:
+                pulse( pos, pos_mask, pos_pulses, *pos_parameters )
+                pulse( neg, neg_mask, neg_pulses, *neg_parameters )
+            else:
+                pulse_quantised( pos, pos_mask, pos_pulses )
+                pulse_quantised( neg, neg_mask, neg_pulses )
+            
+            # update network weights
+            updated = np.logical_or( pos_mask, neg_mask )
+            refresh_weights( idx, pos, neg, updated, pos_parameters, neg_parameters )
+            
+            if pulsed is not None:
+                with lock:
+                    pulsed[ ... ] += np.count_nonzero( updated )
+        
+        def conductance( memristors, updated, r_min, r_max, exponent ):
+            return device_model.to_conductance( memristors[ updated ], r_min[ updated ], r_max[ updated ], gain )
+        
+        def refresh_weights( idx, pos, neg, updated, pos_parameters, neg_parameters ):
+            to_conductance = conductance if max_pulses is None else quantised_conductance
+            new_weights = to_conductance( pos, updated, *pos_parameters ) \
+                          - to_conductance( neg, updated, *neg_parameters )
+            if sparse:
+                weights[ rows[ updated ], cols[ updated ] ] = new_weights
+            else:
+                weights[ idx ][ updated ] = new_weights
+        
+        def learn( tile, scale ):
+            apply_delta( local_delta( tile[ 0 ] ), tile, scale )
+        
+        def accumulate( tile, scale ):
+            delta_sum[ tile[ 0 ] ] += local_delta( tile[ 0 ] )
+        
+        def consolidate( tile, scale ):
+            # consolidate the deltas since the last tick into a single update per device
+            apply_delta( delta_sum[ tile[ 0 ] ], tile, scale )
+            delta_sum[ tile[ 0 ] ] = 0
+        
+        def for_each_tile( function, scale=None ):
+            if pool is None:
+                for tile in tiles:
+                    function( tile, scale )
+            else:
+                # tiles are disjoint so they can be updated concurrently, NumPy releases the GIL on large arrays
+                list( pool.map( lambda tile: function( tile, scale ), tiles ) )
+        
+        def step_simmpes():
+            # learning phase is over or switched off, leave the memristors and weights as they are
+            if time >= learn_time or (stop_learning is not None and stop_learning[ 0 ] > 0):
+                return
             
             # set update to zero if error is small or adjustments go on for ever
             # if error is small return zero delta
-            if np.any( np.absolute( local_error ) > error_threshold ):
-                # calculate the magnitude of the update based on PES learning rule
-                # local_error = -np.dot( encoders, error )
-                # I can use NengoDL build function like this, as dot(encoders, error) has been done there already
-                # i.e., error already contains the PES local error
-                pes_delta = np.outer( -local_error, pre_filtered )
-                
-                # some memristors are adjusted erroneously if we don't filter
-                spiked_map = find_spikes( pre_filtered, weights.shape, invert=True )
-                pes_delta[ spiked_map ] = 0
-                
-                # set update direction and magnitude (unused with powerlaw memristor equations)
-                V = np.sign( pes_delta ) * 1e-1
-                
-                # clip values outside [R_0,R_1]
-                pos_memristors[ V > 0 ] = np.where( pos_memristors[ V > 0 ] > r_max[ V > 0 ],
-                                                    r_max[ V > 0 ],
-                                                    pos_memristors[ V > 0 ] )
-                pos_memristors[ V > 0 ] = np.where( pos_memristors[ V > 0 ] < r_min[ V > 0 ],
-                                                    r_min[ V > 0 ],
-                                                    pos_memristors[ V > 0 ] )
-                neg_memristors[ V < 0 ] = np.where( neg_memristors[ V < 0 ] > r_max[ V < 0 ],
-                                                    r_max[ V < 0 ],
-                                                    neg_memristors[ V < 0 ] )
-                neg_memristors[ V < 0 ] = np.where( neg_memristors[ V < 0 ] < r_min[ V < 0 ],
-                                                    r_min[ V < 0 ],
-                                                    neg_memristors[ V < 0 ] )
-                
-                # update the two memristor pairs separately
-                pos_n = np.power( (pos_memristors[ V > 0 ] - r_min[ V > 0 ]) / r_max[ V > 0 ],
-                                  1 / exponent[ V > 0 ] )
-                pos_memristors[ V > 0 ] = r_min[ V > 0 ] + r_max[ V > 0 ] * np.power( pos_n + 1, exponent[ V > 0 ] )
-                
-                neg_n = np.power( (neg_memristors[ V < 0 ] - r_min[ V < 0 ]) / r_max[ V < 0 ], 1 / exponent[ V < 0 ] )
-                neg_memristors[ V < 0 ] = r_min[ V < 0 ] + r_max[ V < 0 ] * np.power( neg_n + 1, exponent[ V < 0 ] )
+            error_above_threshold = np.any( np.absolute( local_error ) > error_threshold )
+            if pulsed is not None:
+                if not error_above_threshold:
+                    skipped[ ... ] += 1
+            
+            # the largest delta on the whole crossbar, shared by all tiles, gets the highest pulse level
+            if delta_sum is None:
+                if error_above_threshold:
+                    scale = None
+                    if pulse_levels > 1:
+                        spiked = np.rint( pre_filtered ) != 0
+                        scale = np.max( np.absolute( local_error ) ) \
+                                * np.max( np.absolute( pre_filtered[ spiked ] ), initial=0 )
+                    for_each_tile( learn, scale )
+            else:
+                if error_above_threshold:
+                    for_each_tile( accumulate )
+                # on pulse ticks apply what was accumulated
+                if step % pulse_period == 0:
+                    scale = np.max( np.absolute( delta_sum ) ) if pulse_levels > 1 else None
+                    for_each_tile( consolidate, scale )
+        
+        if self.profile:
+            import threading
+            from collections import defaultdict
+            from time import perf_counter
+            
+            lock = threading.Lock()
+            self.timings = timings = defaultdict( float )
+            self.counts = counts = defaultdict( int )
+            
+            def timed( stage, function ):
+                # time spent in the stage summed over all calls (and over all threads when tiles run in parallel)
+                def timed_function( *args ):
+                    start = perf_counter()
+                    out = function( *args )
+                    elapsed = perf_counter() - start
+                    with lock:
+                        timings[ stage ] += elapsed
+                    
+                    return out
                 
-                # update network weights
-                weights[ V > 0 ] = resistance2conductance( pos_memristors[ V > 0 ], r_min[ V > 0 ],
-                                                           r_max[ V > 0 ] ) \
-                                   - resistance2conductance( neg_memristors[ V > 0 ], r_min[ V > 0 ],
-                                                             r_max[ V > 0 ] )
-                weights[ V < 0 ] = resistance2conductance( pos_memristors[ V < 0 ], r_min[ V < 0 ],
-                                                           r_max[ V < 0 ] ) \
-                                   - resistance2conductance( neg_memristors[ V < 0 ], r_min[ V < 0 ],
-                                                             r_max[ V < 0 ] )
+                return timed_function
+            
+            local_delta = timed( "spikes", local_delta )
+            clip = timed( "clip", clip )
+            update = timed( "update", update )
+            pulse_quantised = timed( "update", pulse_quantised )
+            refresh_weights = timed( "weights", refresh_weights )
+            
+            step_learning = timed( "total", step_simmpes )
+            
+            def step_simmpes():
+                step_learning()
+                counts[ "steps" ] += 1
+                counts[ "pulsed" ] = int( pulsed[ 0 ] )
+                counts[ "skipped" ] = int( skipped[ 0 ] )
         
         return step_simmpes
 
 
-################ NENGO DL #####################
+################ NENGO CORE #####################
 
-import tensorflow as tf
 from nengo.builder import Signal
 from nengo.builder.operator import Reset, DotInc, Copy
 
-from nengo_dl.builder import Builder, OpBuilder, NengoBuilder
 from nengo.builder import Builder as NengoCoreBuilder
 
 
-@NengoBuilder.register( mPES )
 @NengoCoreBuilder.register( mPES )
 def build_mpes( model, mpes, rule ):
     conn = rule.connection
@@ -220,39 +481,149 @@ def build_mpes( model, mpes, rule ):
     out_size = encoders.shape[ 0 ]
     in_size = acts.shape[ 0 ]
     
-    from scipy.stats import truncnorm
-    def get_truncated_normal( mean, sd, low, upp ):
-        try:
-            return truncnorm( (low - mean) / sd, (upp - mean) / sd, loc=mean, scale=sd ) \
-                .rvs( out_size * in_size ) \
-                .reshape( (out_size, in_size) )
-        except ZeroDivisionError:
-            return np.full( (out_size, in_size), mean )
-    
-    np.random.seed( mpes.seed )
-    r_min_noisy = get_truncated_normal( mpes.r_min, mpes.r_min * mpes.noise_percentage[ 0 ],
-                                        0, np.inf )
-    np.random.seed( mpes.seed )
-    r_max_noisy = get_truncated_normal( mpes.r_max, mpes.r_max * mpes.noise_percentage[ 1 ],
-                                        np.max( r_min_noisy ), np.inf )
-    np.random.seed( mpes.seed )
-    exponent_noisy = np.random.normal( mpes.exponent, np.abs( mpes.exponent ) * mpes.noise_percentage[ 2 ],
-                                       (out_size, in_size) )
-    np.random.seed( mpes.seed )
-    pos_mem_initial = np.random.normal( 1e8, 1e8 * mpes.noise_percentage[ 3 ],
-                                        (out_size, in_size) )
-    np.random.seed( mpes.seed + 1 )
-    neg_mem_initial = np.random.normal( 1e8, 1e8 * mpes.noise_percentage[ 3 ],
-                                        (out_size, in_size) )
-    
-    pos_memristors = Signal( shape=(out_size, in_size), name="mPES:pos_memristors",
+    # NengoDL builds with its own builder class, refuse what its operator builder cannot do before anything is built
+    if type( model.builder ).__module__.startswith( "nengo_dl" ):
+        if mpes.connectivity is not None:
+            raise BuildError( "Sparse mPES connectivity is only supported on the Nengo Core backend" )
+        if mpes.max_pulses is not None:
+            raise BuildError( "Integer mPES pulse states are only supported on the Nengo Core backend" )
+    
+    if mpes.connectivity is not None:
+        from scipy.sparse import csr_matrix
+        
+        if mpes.tile_shape is not None:
+            raise ValueError( "Tiling is only supported for dense mPES connections" )
+        
+        connectivity = csr_matrix( mpes.connectivity, dtype=bool )
+        if connectivity.shape != (out_size, in_size):
+            raise ValueError( f"Connectivity has shape {connectivity.shape}, expected {(out_size, in_size)}" )
+        connectivity.eliminate_zeros()
+        connectivity.sort_indices()
+        # the weight matrix stays dense and only the existing synapses are ever written, so the others have to start
+        # at zero and stay there
+        initial_weights = model.sig[ conn ][ "weights" ].initial_value
+        if initial_weights.shape != (out_size, in_size) or np.any( initial_weights[ ~connectivity.toarray() ] ):
+            raise ValueError( "Sparse mPES needs a full transform that is zero outside the connectivity" )
+        indptr = connectivity.indptr
+        indices = connectivity.indices
+        rows = np.repeat( np.arange( out_size ), np.diff( indptr ) )
+        shape = (connectivity.nnz,)
+    else:
+        indptr = indices = None
+        shape = (out_size, in_size)
+    
+    if mpes.device_parameters is not None:
+        # measured devices, e.g. from memristor_nengo.fitting
+        device_parameters = { }
+        for name in ("r_min", "r_max", "exponent", "pos_init", "neg_init", "neg_r_min", "neg_r_max", "neg_exponent"):
+            # the negative memristors share the parameters of the positive ones unless they were fitted apart
+            if name in ("neg_r_min", "neg_r_max", "neg_exponent") and name not in mpes.device_parameters:
+                continue
+            value = np.array( mpes.device_parameters[ name ], dtype=float )
+            if indptr is not None and value.shape == (out_size, in_size):
+                value = value[ rows, indices ]
+            if value.shape != shape:
+                raise ValueError( f"Device parameter '{name}' has shape {value.shape}, expected {shape}" )
+            device_parameters[ name ] = value
+        r_min_noisy = device_parameters[ "r_min" ]
+        r_max_noisy = device_parameters[ "r_max" ]
+        exponent_noisy = device_parameters[ "exponent" ]
+        pos_mem_initial = device_parameters[ "pos_init" ]
+        neg_mem_initial = device_parameters[ "neg_init" ]
+        neg_r_min_noisy = device_parameters.get( "neg_r_min", r_min_noisy )
+        neg_r_max_noisy = device_parameters.get( "neg_r_max", r_max_noisy )
+        neg_exponent_noisy = device_parameters.get( "neg_exponent", exponent_noisy )
+    else:
+        from scipy.stats import truncnorm
+        
+        # every connection gets its own independent streams, derived from the seed given to mPES and the position of
+        # the connection in the network or, failing that, from the seed Nengo assigned to the connection, so that
+        # builds don't touch the global NumPy state and connections sharing a seed still get different devices
+        if mpes.seed is not None:
+            entropy = [ mpes.seed, model.toplevel.all_connections.index( conn ) ]
+        else:
+            entropy = [ model.seeds[ conn ] ]
+        r_min_rng, r_max_rng, exponent_rng, pos_rng, neg_rng = \
+            [ np.random.default_rng( s ) for s in np.random.SeedSequence( entropy ).spawn( 5 ) ]
+        noise_percentage = mpes.noise_percentage if mpes.noise_percentage else [ 0 ] * 4
+        
+        def get_truncated_normal( mean, sd, low, upp, rng ):
+            try:
+                return truncnorm( (low - mean) / sd, (upp - mean) / sd, loc=mean, scale=sd ) \
+                    .rvs( int( np.prod( shape ) ), random_state=rng ) \
+                    .reshape( shape )
+            except ZeroDivisionError:
+                return np.full( shape, mean )
+        
+        r_min_noisy = get_truncated_normal( mpes.r_min, mpes.r_min * noise_percentage[ 0 ],
+                                            0, np.inf, r_min_rng )
+        r_max_noisy = get_truncated_normal( mpes.r_max, mpes.r_max * noise_percentage[ 1 ],
+                                            np.max( r_min_noisy ), np.inf, r_max_rng )
+        exponent_noisy = exponent_rng.normal( mpes.exponent, np.abs( mpes.exponent ) * noise_percentage[ 2 ],
+                                              shape )
+        pos_mem_initial = pos_rng.normal( 1e8, 1e8 * noise_percentage[ 3 ],
+                                          shape )
+        neg_mem_initial = neg_rng.normal( 1e8, 1e8 * noise_percentage[ 3 ],
+                                          shape )
+        neg_r_min_noisy, neg_r_max_noisy, neg_exponent_noisy = r_min_noisy, r_max_noisy, exponent_noisy
+    
+    lut = None
+    if mpes.max_pulses is not None:
+        # pulse numbers are added and read back with the closed form of the plain power law, other device models
+        # would silently be simulated as one
+        if type( mpes.device_model ) is not PowerLaw:
+            raise ValueError( f"Integer mPES pulse states only support the PowerLaw device model, "
+                              f"not {mpes.device_model}" )
+        
+        from memristor_nengo.trajectories import clip, pulse_number, resistance
+        
+        # the state of each device is the number of pulses it has received, starting from the one closest to its
+        # initial resistance, pulse numbers start from 1 as the power law diverges at 0
+        dtype = np.int16 if mpes.max_pulses <= np.iinfo( np.int16 ).max else np.int32
+        pos_mem_initial = np.clip( np.rint( pulse_number( clip( pos_mem_initial, r_min_noisy, r_max_noisy ),
+                                                          r_min_noisy, r_max_noisy, exponent_noisy ) ),
+                                   1, mpes.max_pulses ).astype( dtype )
+        neg_mem_initial = np.clip( np.rint( pulse_number( clip( neg_mem_initial, neg_r_min_noisy, neg_r_max_noisy ),
+                                                          neg_r_min_noisy, neg_r_max_noisy, neg_exponent_noisy ) ),
+                                   1, mpes.max_pulses ).astype( dtype )
+        
+        # a single table if all devices are the same, otherwise the conductances are computed from the pulse
+        # numbers, as a table per device would take more memory than the float resistances it replaces
+        if all( np.all( p == n ) and np.all( p == p.flat[ 0 ] )
+                for p, n in ((r_min_noisy, neg_r_min_noisy),
+                             (r_max_noisy, neg_r_max_noisy),
+                             (exponent_noisy, neg_exponent_noisy)) ):
+            n = np.maximum( np.arange( mpes.max_pulses + 1 ), 1 )
+            r_min_lut, r_max_lut, exponent_lut = r_min_noisy.flat[ 0 ], r_max_noisy.flat[ 0 ], exponent_noisy.flat[ 0 ]
+            lut = mpes.device_model.to_conductance( resistance( n, r_min_lut, r_max_lut, exponent_lut ),
+                                                    r_min_lut, r_max_lut, mpes.gain )
+    
+    if mpes.stop_learning is not None:
+        # the node is built before the connections of its network, so its output signal already exists
+        stop_learning = model.sig[ mpes.stop_learning ][ "out" ]
+    else:
+        stop_learning = None
+    
+    if mpes.profile:
+        pulsed = Signal( shape=(1,), name="mPES:pulsed" )
+        skipped = Signal( shape=(1,), name="mPES:skipped" )
+    else:
+        pulsed = skipped = None
+    
+    pos_memristors = Signal( shape=shape, name="mPES:pos_memristors",
                              initial_value=pos_mem_initial )
-    neg_memristors = Signal( shape=(out_size, in_size), name="mPES:neg_memristors",
+    neg_memristors = Signal( shape=shape, name="mPES:neg_memristors",
                              initial_value=neg_mem_initial )
     
     model.sig[ conn ][ "pos_memristors" ] = pos_memristors
     model.sig[ conn ][ "neg_memristors" ] = neg_memristors
     
+    if mpes.pulse_period > 1:
+        delta_sum = Signal( shape=shape, name="mPES:delta_sum" )
+        model.sig[ conn ][ "delta_sum" ] = delta_sum
+    else:
+        delta_sum = None
+    
     if conn.post_obj is not conn.post:
         # in order to avoid slicing encoders along an axis > 0, we pad
         # `error` out to the full base dimensionality and then do the
@@ -279,7 +650,26 @@ def build_mpes( model, mpes, rule ):
                      mpes.gain,
                      r_min_noisy,
                      r_max_noisy,
-                     exponent_noisy )
+                     exponent_noisy,
+                     mpes.device_model,
+                     model.time,
+                     mpes.learn_time,
+                     model.step,
+                     mpes.pulse_period,
+                     delta_sum,
+                     indptr,
+                     indices,
+                     tuple( np.broadcast_to( mpes.tile_shape, (2,) ) ) if mpes.tile_shape is not None else None,
+                     mpes.tile_workers,
+                     mpes.pulse_levels,
+                     lut,
+                     mpes.max_pulses,
+                     pulsed,
+                     skipped,
+                     neg_r_min=neg_r_min_noisy,
+                     neg_r_max=neg_r_max_noisy,
+                     neg_exponent=neg_exponent_noisy,
+                     stop_learning=stop_learning )
             )
     
     # expose these for probes
@@ -287,208 +677,12 @@ def build_mpes( model, mpes, rule ):
     model.sig[ rule ][ "activities" ] = acts
     model.sig[ rule ][ "pos_memristors" ] = pos_memristors
     model.sig[ rule ][ "neg_memristors" ] = neg_memristors
+    if mpes.profile:
+        model.sig[ rule ][ "pulsed" ] = pulsed
+        model.sig[ rule ][ "skipped" ] = skipped
 
 
-@Builder.register( SimmPES )
-class SimmPESBuilder( OpBuilder ):
-    """Build exponent group of `~nengo.builder.learning_rules.SimmPES` operators."""
-    
-    def build_pre( self, signals, config ):
-        super().build_pre( signals, config )
-        
-        self.output_size = self.ops[ 0 ].weights.shape[ 0 ]
-        self.input_size = self.ops[ 0 ].weights.shape[ 1 ]
-        
-        self.error_data = signals.combine( [ op.error for op in self.ops ] )
-        self.error_data = self.error_data.reshape( (len( self.ops ), self.ops[ 0 ].error.shape[ 0 ], 1) )
-        
-        self.pre_data = signals.combine( [ op.pre_filtered for op in self.ops ] )
-        self.pre_data = self.pre_data.reshape( (len( self.ops ), 1, self.ops[ 0 ].pre_filtered.shape[ 0 ]) )
-        
-        self.pos_memristors = signals.combine( [ op.pos_memristors for op in self.ops ] )
-        self.pos_memristors = self.pos_memristors.reshape(
-                (len( self.ops ), self.ops[ 0 ].pos_memristors.shape[ 0 ], self.ops[ 0 ].pos_memristors.shape[ 1 ])
-                )
-        
-        self.neg_memristors = signals.combine( [ op.neg_memristors for op in self.ops ] )
-        self.neg_memristors = self.neg_memristors.reshape(
-                (len( self.ops ), self.ops[ 0 ].neg_memristors.shape[ 0 ], self.ops[ 0 ].neg_memristors.shape[ 1 ])
-                )
-        # self.r_min = signals.combine( [ op.r_min for op in self.ops ] )
-        # self.r_min = self.r_min.reshape(
-        #         (len( self.ops ), self.ops[ 0 ].r_min.shape[ 0 ], self.ops[ 0 ].r_min.shape[ 1 ])
-        #         )
-        
-        self.output_data = signals.combine( [ op.weights for op in self.ops ] )
-        
-        self.gain = signals.op_constant( self.ops,
-                                         [ 1 for _ in self.ops ],
-                                         "gain",
-                                         signals.dtype,
-                                         shape=(1, -1, 1, 1) )
-        self.r_min = signals.op_constant( self.ops,
-                                          [ 1 for _ in self.ops ],
-                                          "r_min",
-                                          signals.dtype,
-                                          shape=(1, -1, 1, 1) )
-        self.r_min = tf.reshape( self.r_min,
-                                 (1,
-                                  len( self.ops ),
-                                  self.ops[ 0 ].r_min.shape[ 0 ],
-                                  self.ops[ 0 ].r_min.shape[ 1 ])
-                                 )
-        self.r_max = signals.op_constant( self.ops,
-                                          [ 1 for _ in self.ops ],
-                                          "r_max",
-                                          signals.dtype,
-                                          shape=(1, -1, 1, 1) )
-        self.r_max = tf.reshape( self.r_max,
-                                 (1,
-                                  len( self.ops ),
-                                  self.ops[ 0 ].r_max.shape[ 0 ],
-                                  self.ops[ 0 ].r_max.shape[ 1 ])
-                                 )
-        self.exponent = signals.op_constant( self.ops,
-                                             [ 1 for _ in self.ops ],
-                                             "exponent",
-                                             signals.dtype,
-                                             shape=(1, -1, 1, 1) )
-        self.exponent = tf.reshape( self.exponent,
-                                    (1,
-                                     len( self.ops ),
-                                     self.ops[ 0 ].exponent.shape[ 0 ],
-                                     self.ops[ 0 ].exponent.shape[ 1 ])
-        
-                                    )
-        self.error_threshold = signals.op_constant( self.ops,
-                                                    [ 1 for _ in self.ops ],
-                                                    "error_threshold",
-                                                    signals.dtype,
-                                                    shape=(1, -1, 1, 1) )
-        self.g_min = 1.0 / self.r_max
-        self.g_max = 1.0 / self.r_min
-    
-    def build_step( self, signals ):
-        pre_filtered = signals.gather( self.pre_data )
-        local_error = signals.gather( self.error_data )
-        pos_memristors = signals.gather( self.pos_memristors )
-        neg_memristors = signals.gather( self.neg_memristors )
-        
-        r_min = self.r_min
-        r_max = self.r_max
-        exponent = self.exponent
-        
-        def resistance2conductance( R ):
-            g_curr = 1.0 / R
-            g_norm = (g_curr - self.g_min) / (self.g_max - self.g_min)
-            
-            return g_norm * self.gain
-        
-        def find_spikes( input_activities, output_size, invert=False ):
-            spiked_pre = tf.cast(
-                    tf.tile( tf.math.rint( input_activities ), [ 1, 1, output_size, 1 ] ),
-                    tf.bool )
-            
-            out = spiked_pre
-            if invert:
-                out = tf.math.logical_not( out )
-            
-            return tf.cast( out, tf.float32 )
-        
-        # @tf.function
-        def update_resistances( pos_memristors, neg_memristors ):
-            pos_mask = tf.greater( V, 0 )
-            pos_indices = tf.where( pos_mask )
-            neg_mask = tf.less( V, 0 )
-            neg_indices = tf.where( neg_mask )
-            
-            # clip values outside [R_0,R_1]
-            pos_memristors = tf.tensor_scatter_nd_update( pos_memristors,
-                                                          pos_indices,
-                                                          tf.where(
-                                                                  tf.greater(
-                                                                          tf.boolean_mask( pos_memristors, pos_mask ),
-                                                                          tf.boolean_mask( r_max, pos_mask ) ),
-                                                                  tf.boolean_mask( r_max, pos_mask ),
-                                                                  tf.boolean_mask( pos_memristors, pos_mask ) ) )
-            pos_memristors = tf.tensor_scatter_nd_update( pos_memristors,
-                                                          pos_indices,
-                                                          tf.where(
-                                                                  tf.less( tf.boolean_mask( pos_memristors, pos_mask ),
-                                                                           tf.boolean_mask( r_min, pos_mask ) ),
-                                                                  tf.boolean_mask( r_min, pos_mask ),
-                                                                  tf.boolean_mask( pos_memristors, pos_mask ) ) )
-            neg_memristors = tf.tensor_scatter_nd_update( neg_memristors,
-                                                          neg_indices,
-                                                          tf.where(
-                                                                  tf.greater(
-                                                                          tf.boolean_mask( neg_memristors, neg_mask ),
-                                                                          tf.boolean_mask( r_max, neg_mask ) ),
-                                                                  tf.boolean_mask( r_max, neg_mask ),
-                                                                  tf.boolean_mask( neg_memristors, neg_mask ) ) )
-            neg_memristors = tf.tensor_scatter_nd_update( neg_memristors,
-                                                          neg_indices,
-                                                          tf.where(
-                                                                  tf.less( tf.boolean_mask( neg_memristors, neg_mask ),
-                                                                           tf.boolean_mask( r_min, neg_mask ) ),
-                                                                  tf.boolean_mask( r_min, neg_mask ),
-                                                                  tf.boolean_mask( neg_memristors, neg_mask ) ) )
-            
-            # positive memristors update
-            pos_n = tf.math.pow( (tf.boolean_mask( pos_memristors, pos_mask ) - tf.boolean_mask( r_min, pos_mask ))
-                                 / tf.boolean_mask( r_max, pos_mask ),
-                                 1 / tf.boolean_mask( exponent, pos_mask ) )
-            pos_update = tf.boolean_mask( r_min, pos_mask ) + tf.boolean_mask( r_max, pos_mask ) * \
-                         tf.math.pow( pos_n + 1, tf.boolean_mask( exponent, pos_mask ) )
-            pos_memristors = tf.tensor_scatter_nd_update( pos_memristors, pos_indices, pos_update )
-            
-            # negative memristors update
-            neg_n = tf.math.pow( (tf.boolean_mask( neg_memristors, neg_mask ) - tf.boolean_mask( r_min, neg_mask ))
-                                 / tf.boolean_mask( r_max, neg_mask ),
-                                 1 / tf.boolean_mask( exponent, neg_mask ) )
-            neg_update = tf.boolean_mask( r_min, neg_mask ) + tf.boolean_mask( r_max, neg_mask ) * \
-                         tf.math.pow( neg_n + 1, tf.boolean_mask( exponent, neg_mask ) )
-            neg_memristors = tf.tensor_scatter_nd_update( neg_memristors, neg_indices, neg_update )
-            
-            return pos_memristors, neg_memristors
-        
-        pes_delta = -local_error * pre_filtered
-        
-        spiked_map = find_spikes( pre_filtered, self.output_size )
-        pes_delta = pes_delta * spiked_map
-        
-        V = tf.sign( pes_delta ) * 1e-1
-        
-        # FIRST thing, check if the error is greater than the threshold
-        # if any errors is above threshold then pass decision to next tf.cond()
-        # if all errors are below threshold then do nothing
-        pos_memristors, neg_memristors = tf.cond(
-                tf.reduce_any( tf.greater( tf.abs( local_error ), self.error_threshold ) ),
-                true_fn=lambda: update_resistances( pos_memristors,
-                                                    neg_memristors ),
-                false_fn=lambda: (
-                        tf.identity( pos_memristors ),
-                        tf.identity( neg_memristors ))
-                )
-        
-        # update the memristor values
-        signals.scatter(
-                self.pos_memristors.reshape( (self.pos_memristors.shape[ -2 ], self.pos_memristors.shape[ -1 ]) ),
-                pos_memristors )
-        signals.scatter(
-                self.neg_memristors.reshape( (self.neg_memristors.shape[ -2 ], self.neg_memristors.shape[ -1 ]) ),
-                neg_memristors )
-        
-        new_weights = resistance2conductance( pos_memristors ) - resistance2conductance( neg_memristors )
-        
-        signals.scatter( self.output_data, new_weights )
-    
-    @staticmethod
-    def mergeable( x, y ):
-        # pre inputs must have the same dimensionality so that we can broadcast
-        # them when computing the outer product.
-        # the error signals also have to have the same shape.
-        return (
-                x.pre_filtered.shape[ 0 ] == y.pre_filtered.shape[ 0 ]
-                and x.local_error.shape[ 0 ] == y.local_error.shape[ 0 ]
-        )
+# the NengoDL builder needs TensorFlow, which takes seconds to import, so it only comes with this module if NengoDL
+# is already loaded; otherwise import memristor_nengo.learning_rules_dl before building a nengo_dl.Simulator
+if "nengo_dl" in sys.modules:
+    import memristor_nengo.learning_rules_dl
@@ -0,0 +1,276 @@
+import tensorflow as tf
+from nengo.exceptions import BuildError
+from nengo_dl.builder import Builder, OpBuilder, NengoBuilder
+
+from memristor_nengo.learning_rules import SimmPES, build_mpes, mPES
+
+################ NENGO DL #####################
+
+# importing this module registers mPES with NengoDL
+
+NengoBuilder.register( mPES )( build_mpes )
+
+
+@Builder.register( SimmPES )
+class SimmPESBuilder( OpBuilder ):
+    """Build exponent group of `~nengo.builder.learning_rules.SimmPES` operators."""
+    
+    def build_pre( self, signals, config ):
+        super().build_pre( signals, config )
+        
+        if any( op.indptr is not None for op in self.ops ):
+            raise BuildError( "Sparse mPES connectivity is only supported on the Nengo Core backend" )
+        if any( op.max_pulses is not None for op in self.ops ):
+            raise BuildError( "Integer mPES pulse states are only supported on the Nengo Core backend" )
+        
+        self.output_size = self.ops[ 0 ].weights.shape[ 0 ]
+        self.input_size = self.ops[ 0 ].weights.shape[ 1 ]
+        
+        self.error_data = signals.combine( [ op.error for op in self.ops ] )
+        self.error_data = self.error_data.reshape( (len( self.ops ), self.ops[ 0 ].error.shape[ 0 ], 1) )
+        
+        self.pre_data = signals.combine( [ op.pre_filtered for op in self.ops ] )
+        self.pre_data = self.pre_data.reshape( (len( self.ops ), 1, self.ops[ 0 ].pre_filtered.shape[ 0 ]) )
+        
+        self.pos_memristors = signals.combine( [ op.pos_memristors for op in self.ops ] )
+        self.pos_memristors = self.pos_memristors.reshape(
+                (len( self.ops ), self.ops[ 0 ].pos_memristors.shape[ 0 ], self.ops[ 0 ].pos_memristors.shape[ 1 ])
+                )
+        
+        self.neg_memristors = signals.combine( [ op.neg_memristors for op in self.ops ] )
+        self.neg_memristors = self.neg_memristors.reshape(
+                (len( self.ops ), self.ops[ 0 ].neg_memristors.shape[ 0 ], self.ops[ 0 ].neg_memristors.shape[ 1 ])
+                )
+        # self.r_min = signals.combine( [ op.r_min for op in self.ops ] )
+        # self.r_min = self.r_min.reshape(
+        #         (len( self.ops ), self.ops[ 0 ].r_min.shape[ 0 ], self.ops[ 0 ].r_min.shape[ 1 ])
+        #         )
+        
+        self.output_data = signals.combine( [ op.weights for op in self.ops ] )
+        
+        # all ops read the same simulation time
+        self.time_data = signals.combine( [ self.ops[ 0 ].time ] )
+        # as does the node switching learning off, if any
+        self.stop_learning_data = signals.combine( [ self.ops[ 0 ].stop_learning ] ) \
+            if self.ops[ 0 ].stop_learning is not None else None
+        self.step_data = signals.combine( [ self.ops[ 0 ].step ] )
+        
+        self.pulse_period = self.ops[ 0 ].pulse_period
+        self.pulse_levels = self.ops[ 0 ].pulse_levels
+        
+        self.profile = self.ops[ 0 ].profile
+        if self.profile:
+            self.pulsed = signals.combine( [ op.pulsed for op in self.ops ] )
+            self.skipped = signals.combine( [ op.skipped for op in self.ops ] )
+        if self.pulse_period > 1:
+            self.delta_sum = signals.combine( [ op.delta_sum for op in self.ops ] )
+            self.delta_sum = self.delta_sum.reshape(
+                    (len( self.ops ), self.ops[ 0 ].delta_sum.shape[ 0 ], self.ops[ 0 ].delta_sum.shape[ 1 ])
+                    )
+        
+        self.gain = signals.op_constant( self.ops,
+                                         [ 1 for _ in self.ops ],
+                                         "gain",
+                                         signals.dtype,
+                                         shape=(1, -1, 1, 1) )
+        
+        def device_constant( name ):
+            value = signals.op_constant( self.ops,
+                                         [ 1 for _ in self.ops ],
+                                         name,
+                                         signals.dtype,
+                                         shape=(1, -1, 1, 1) )
+            
+            return tf.reshape( value,
+                               (1,
+                                len( self.ops ),
+                                getattr( self.ops[ 0 ], name ).shape[ 0 ],
+                                getattr( self.ops[ 0 ], name ).shape[ 1 ])
+                               )
+        
+        self.r_min = device_constant( "r_min" )
+        self.r_max = device_constant( "r_max" )
+        self.exponent = device_constant( "exponent" )
+        # measured devices can have different parameters for the negative memristors
+        if all( op.neg_r_min is op.r_min and op.neg_r_max is op.r_max and op.neg_exponent is op.exponent
+                for op in self.ops ):
+            self.neg_r_min, self.neg_r_max, self.neg_exponent = self.r_min, self.r_max, self.exponent
+        else:
+            self.neg_r_min = device_constant( "neg_r_min" )
+            self.neg_r_max = device_constant( "neg_r_max" )
+            self.neg_exponent = device_constant( "neg_exponent" )
+        
+        self.error_threshold = signals.op_constant( self.ops,
+                                                    [ 1 for _ in self.ops ],
+                                                    "error_threshold",
+                                                    signals.dtype,
+                                                    shape=(1, -1, 1, 1) )
+        self.g_min = 1.0 / self.r_max
+        self.g_max = 1.0 / self.r_min
+    
+    def build_step( self, signals ):
+        pre_filtered = signals.gather( self.pre_data )
+        local_error = signals.gather( self.error_data )
+        pos_memristors = signals.gather( self.pos_memristors )
+        neg_memristors = signals.gather( self.neg_memristors )
+        weights = signals.gather( self.output_data )
+        time = tf.reduce_max( signals.gather( self.time_data ) )
+        step = tf.reduce_max( signals.gather( self.step_data ) )
+        
+        r_min = self.r_min
+        r_max = self.r_max
+        exponent = self.exponent
+        neg_r_min = self.neg_r_min
+        neg_r_max = self.neg_r_max
+        neg_exponent = self.neg_exponent
+        
+        def find_spikes( input_activities, output_size, invert=False ):
+            spiked_pre = tf.cast(
+                    tf.tile( tf.math.rint( input_activities ), [ 1, 1, output_size, 1 ] ),
+                    tf.bool )
+            
+            out = spiked_pre
+            if invert:
+                out = tf.math.logical_not( out )
+            
+            return tf.cast( out, input_activities.dtype )
+        
+        device_model = self.ops[ 0 ].device_model
+        
+        def compute_delta():
+            with tf.name_scope( "mPES_spikes" ):
+                pes_delta = -local_error * pre_filtered
+                
+                spiked_map = find_spikes( pre_filtered, self.output_size )
+                
+                return pes_delta * spiked_map
+        
+        # @tf.function
+        def update_resistances( pes_delta, pos_memristors, neg_memristors ):
+            V = tf.sign( pes_delta ) * 1e-1
+            
+            # quantise the magnitude of the update to a number of pulses, relative to the largest delta of each op
+            if self.pulse_levels > 1:
+                scale = tf.reduce_max( tf.abs( pes_delta ), axis=[ -2, -1 ], keepdims=True )
+                pulses = tf.math.ceil( self.pulse_levels * tf.math.divide_no_nan( tf.abs( pes_delta ), scale ) )
+            else:
+                pulses = 1.0
+            
+            if device_model.bidirectional:
+                # potentiate one memristor of each pair and depress the other
+                pos_mask = neg_mask = tf.not_equal( V, 0 )
+                pos_pulses = tf.sign( V ) * pulses
+                neg_pulses = -pos_pulses
+            else:
+                pos_mask = tf.greater( V, 0 )
+                neg_mask = tf.less( V, 0 )
+                pos_pulses = neg_pulses = pulses
+            
+            # clip values outside [R_0,R_1] and pulse the selected memristors, all devices are computed at once and
+            # the untouched ones are then kept as they were
+            with tf.name_scope( "mPES_clip" ):
+                pos_clipped = device_model.tf_clip( pos_memristors, r_min, r_max )
+                neg_clipped = device_model.tf_clip( neg_memristors, neg_r_min, neg_r_max )
+            with tf.name_scope( "mPES_update" ):
+                pos_update = device_model.tf_update( pos_clipped, pos_pulses, r_min, r_max, exponent )
+                pos_memristors = tf.where( pos_mask, pos_update, pos_memristors )
+                neg_update = device_model.tf_update( neg_clipped, neg_pulses, neg_r_min, neg_r_max, neg_exponent )
+                neg_memristors = tf.where( neg_mask, neg_update, neg_memristors )
+            
+            with tf.name_scope( "mPES_weights" ):
+                new_weights = device_model.tf_to_conductance( pos_memristors, r_min, r_max, self.gain ) \
+                              - device_model.tf_to_conductance( neg_memristors, neg_r_min, neg_r_max, self.gain )
+            
+            # devices selected for a pulse in each op, as counted on Nengo Core
+            selected = tf.reduce_sum( tf.cast( tf.logical_or( pos_mask, neg_mask ), pos_memristors.dtype ),
+                                      axis=[ -2, -1 ] )
+            
+            return pos_memristors, neg_memristors, new_weights, selected
+        
+        learning = tf.less( time, self.ops[ 0 ].learn_time )
+        if self.stop_learning_data is not None:
+            learning = tf.logical_and(
+                    learning,
+                    tf.logical_not( tf.reduce_any( tf.greater( signals.gather( self.stop_learning_data ), 0 ) ) ) )
+        error_above_threshold = tf.reduce_any( tf.greater( tf.abs( local_error ), self.error_threshold ) )
+        
+        if self.pulse_period == 1:
+            # FIRST thing, check that we are still learning and that the error is greater than the threshold
+            # if so then update the memristors and weights
+            # otherwise do nothing
+            pos_memristors, neg_memristors, new_weights, selected = tf.cond(
+                    tf.logical_and( learning, error_above_threshold ),
+                    true_fn=lambda: update_resistances( compute_delta(),
+                                                        pos_memristors,
+                                                        neg_memristors ),
+                    false_fn=lambda: (
+                            tf.identity( pos_memristors ),
+                            tf.identity( neg_memristors ),
+                            tf.identity( weights ),
+                            tf.zeros_like( pos_memristors[ ..., 0, 0 ] ))
+                    )
+        else:
+            # sum the deltas every timestep but only pulse the devices on ticks of the pulse clock
+            delta_sum = signals.gather( self.delta_sum )
+            delta_sum = tf.cond(
+                    tf.logical_and( learning, error_above_threshold ),
+                    true_fn=lambda: delta_sum + compute_delta(),
+                    false_fn=lambda: tf.identity( delta_sum )
+                    )
+            tick = tf.logical_and( learning, tf.equal( tf.math.floormod( step, self.pulse_period ), 0 ) )
+            pos_memristors, neg_memristors, new_weights, selected = tf.cond(
+                    tick,
+                    true_fn=lambda: update_resistances( delta_sum,
+                                                        pos_memristors,
+                                                        neg_memristors ),
+                    false_fn=lambda: (
+                            tf.identity( pos_memristors ),
+                            tf.identity( neg_memristors ),
+                            tf.identity( weights ),
+                            tf.zeros_like( pos_memristors[ ..., 0, 0 ] ))
+                    )
+            delta_sum = tf.where( tick, tf.zeros_like( delta_sum ), delta_sum )
+            signals.scatter(
+                    self.delta_sum.reshape( (self.delta_sum.shape[ -2 ], self.delta_sum.shape[ -1 ]) ),
+                    delta_sum )
+        
+        # update the memristor values
+        signals.scatter(
+                self.pos_memristors.reshape( (self.pos_memristors.shape[ -2 ], self.pos_memristors.shape[ -1 ]) ),
+                pos_memristors )
+        signals.scatter(
+                self.neg_memristors.reshape( (self.neg_memristors.shape[ -2 ], self.neg_memristors.shape[ -1 ]) ),
+                neg_memristors )
+        
+        signals.scatter( self.output_data, new_weights )
+        
+        if self.profile:
+            # running totals for each op, as on Nengo Core, stage timings come from the TensorFlow profiler under the
+            # mPES_* name scopes
+            pulsed = signals.gather( self.pulsed )
+            skipped = signals.gather( self.skipped )
+            op_error_below_threshold = tf.logical_not(
+                    tf.reduce_any( tf.greater( tf.abs( local_error ), self.error_threshold ), axis=[ -2, -1 ] ) )
+            signals.scatter( self.pulsed,
+                             pulsed + tf.reshape( tf.cast( selected, pulsed.dtype ), tf.shape( pulsed ) ) )
+            signals.scatter( self.skipped,
+                             skipped + tf.reshape( tf.cast( tf.logical_and( learning, op_error_below_threshold ),
+                                                            skipped.dtype ),
+                                                   tf.shape( skipped ) ) )
+    
+    @staticmethod
+    def mergeable( x, y ):
+        # pre inputs must have the same dimensionality so that we can broadcast
+        # them when computing the outer product.
+        # the error signals also have to have the same shape.
+        # the device kernels, the learning phase and the pulse clock and levels are shared by the whole group
+        return (
+                x.pre_filtered.shape[ 0 ] == y.pre_filtered.shape[ 0 ]
+                and x.error.shape[ 0 ] == y.error.shape[ 0 ]
+                and type( x.device_model ) is type( y.device_model )
+                and x.learn_time == y.learn_time
+                and x.stop_learning is y.stop_learning
+                and x.pulse_period == y.pulse_period
+                and x.pulse_levels == y.pulse_levels
+                and x.profile == y.profile
+        )
@@ -0,0 +1,32 @@
+from memristor_nengo.learning_rules import SimmPES
+
+
+def mpes_profile( sim ):
+    """Collect the timings and counters of every ``mPES(profile=True)`` operator in a Nengo Core simulator.
+    
+    Timings are the seconds spent in each stage over the whole run, counters are the steps taken, the devices
+    pulsed and the steps skipped because the error was below threshold.
+    """
+    profile = [ ]
+    for op in sim.model.operators:
+        if isinstance( op, SimmPES ) and op.profile:
+            profile.append( { "op": str( op ), "timings": dict( op.timings ), "counts": dict( op.counts ) } )
+    
+    return profile
+
+
+def print_profile( sim ):
+    for entry in mpes_profile( sim ):
+        timings = entry[ "timings" ]
+        counts = entry[ "counts" ]
+        steps = max( counts.get( "steps", 0 ), 1 )
+        total = max( timings.get( "total", 0 ), 1e-12 )
+        
+        print( entry[ "op" ] )
+        for stage in ("spikes", "clip", "update", "weights", "total"):
+            seconds = timings.get( stage, 0 )
+            print( f"  {stage:<8} {seconds:10.4f} s  {seconds / steps * 1e6:10.2f} us/step  "
+                   f"{seconds / total * 100:6.2f} %" )
+        print( f"  steps {counts.get( 'steps', 0 )}, devices pulsed {counts.get( 'pulsed', 0 )} "
+               f"({counts.get( 'pulsed', 0 ) / steps:.2f}/step), "
+               f"below error threshold {counts.get( 'skipped', 0 )}" )
@@ -0,0 +1,163 @@
+import datetime
+import json
+import os
+
+import numpy as np
+
+# Simulation results stored as named datasets, each split along its first axis into compressed .npz chunks, with a
+# manifest.json describing the datasets and the run.  Readers only load the chunks covering the requested rows.
+
+MANIFEST = "manifest.json"
+
+
+class ResultsWriter:
+    def __init__( self, dir, chunk_rows=10000, compress=True, metadata=None ):
+        self.dir = dir
+        self.chunk_rows = chunk_rows
+        self.compress = compress
+        self.manifest = {
+                "created" : datetime.datetime.now().isoformat(),
+                "metadata": { } if metadata is None else dict( metadata ),
+                "datasets": { },
+                }
+        self.buffers = { }
+        
+        os.makedirs( dir, exist_ok=True )
+    
+    def __enter__( self ):
+        return self
+    
+    def __exit__( self, *args ):
+        self.close()
+    
+    def _write_chunk( self, name, chunk ):
+        dataset = self.manifest[ "datasets" ][ name ]
+        path = os.path.join( self.dir, name, f"{dataset[ 'chunks' ]:05d}.npz" )
+        (np.savez_compressed if self.compress else np.savez)( path, data=chunk )
+        dataset[ "chunks" ] += 1
+        dataset[ "shape" ][ 0 ] += len( chunk )
+    
+    def _create( self, name, array, columns ):
+        if name in self.manifest[ "datasets" ]:
+            raise ValueError( f"Dataset {name} already exists" )
+        os.makedirs( os.path.join( self.dir, name ), exist_ok=True )
+        self.manifest[ "datasets" ][ name ] = {
+                "shape"     : [ 0 ] + list( array.shape[ 1: ] ),
+                "dtype"     : array.dtype.str,
+                "chunk_rows": self.chunk_rows,
+                "chunks"    : 0,
+                "columns"   : None if columns is None else list( columns ),
+                }
+        self.buffers[ name ] = [ ]
+    
+    def write( self, name, array, columns=None ):
+        """Store a whole array as dataset ``name``; ``columns`` optionally names the entries of its second axis."""
+        array = np.asarray( array )
+        self._create( name, array, columns )
+        for start in range( 0, len( array ), self.chunk_rows ):
+            self._write_chunk( name, array[ start:start + self.chunk_rows ] )
+    
+    def append( self, name, rows, columns=None ):
+        """Add rows to dataset ``name``, creating it if needed; rows are written out a chunk at a time."""
+        rows = np.asarray( rows )
+        if name not in self.manifest[ "datasets" ]:
+            self._create( name, rows, columns )
+        
+        buffer = self.buffers[ name ]
+        buffer.append( rows )
+        buffered = sum( len( b ) for b in buffer )
+        if buffered >= self.chunk_rows:
+            data = np.concatenate( buffer )
+            full = len( data ) - len( data ) % self.chunk_rows
+            for start in range( 0, full, self.chunk_rows ):
+                self._write_chunk( name, data[ start:start + self.chunk_rows ] )
+            self.buffers[ name ] = [ data[ full: ] ] if full < len( data ) else [ ]
+    
+    def close( self ):
+        for name, buffer in self.buffers.items():
+            if buffer:
+                self._write_chunk( name, np.concatenate( buffer ) )
+        self.buffers = { name: [ ] for name in self.buffers }
+        
+        with open( os.path.join( self.dir, MANIFEST ), "w" ) as f:
+            json.dump( self.manifest, f, indent=2, default=str )
+
+
+class Dataset:
+    """Lazy view of a stored dataset; indexing loads only the chunks that contain the selected rows."""
+    
+    def __init__( self, dir, name, description ):
+        self.dir = dir
+        self.name = name
+        self.shape = tuple( description[ "shape" ] )
+        self.dtype = np.dtype( description[ "dtype" ] )
+        self.chunk_rows = description[ "chunk_rows" ]
+        self.chunks = description[ "chunks" ]
+        self.columns = description[ "columns" ]
+    
+    def __len__( self ):
+        return self.shape[ 0 ]
+    
+    def _chunk( self, i ):
+        with np.load( os.path.join( self.dir, self.name, f"{i:05d}.npz" ) ) as f:
+            return f[ "data" ]
+    
+    def _rows( self, start, stop, step ):
+        if start >= stop:
+            return np.zeros( (0,) + self.shape[ 1: ], dtype=self.dtype )
+        parts = [ ]
+        for i in range( start // self.chunk_rows, (stop - 1) // self.chunk_rows + 1 ):
+            offset = i * self.chunk_rows
+            # first row of this chunk that is on the stride
+            first = max( start, offset )
+            first += (start - first) % step
+            parts.append( self._chunk( i )[ first - offset:stop - offset:step ] )
+        
+        return np.concatenate( parts )
+    
+    def __getitem__( self, key ):
+        key = key if isinstance( key, tuple ) else (key,)
+        rows, rest = key[ 0 ], key[ 1: ]
+        
+        if isinstance( rows, (int, np.integer) ):
+            row = rows + len( self ) if rows < 0 else rows
+            if not 0 <= row < len( self ):
+                raise IndexError( f"Row {rows} is out of range for dataset {self.name} of length {len( self )}" )
+            
+            return self._chunk( row // self.chunk_rows )[ (row % self.chunk_rows,) + rest ]
+        
+        if isinstance( rows, slice ) and (rows.step is None or rows.step > 0):
+            data = self._rows( *rows.indices( len( self ) ) )
+        else:
+            # arbitrary row indices: only load the chunks they fall in
+            rows = np.arange( len( self ) )[ rows ]
+            data = np.zeros( (len( rows ),) + self.shape[ 1: ], dtype=self.dtype )
+            for i in np.unique( rows // self.chunk_rows ):
+                selected = rows // self.chunk_rows == i
+                data[ selected ] = self._chunk( i )[ rows[ selected ] % self.chunk_rows ]
+        
+        return data[ (slice( None ),) + rest ]
+    
+    def __array__( self, dtype=None ):
+        return np.asarray( self[ : ], dtype=dtype )
+
+
+class ResultsReader:
+    def __init__( self, dir ):
+        self.dir = dir
+        with open( os.path.join( dir, MANIFEST ) ) as f:
+            self.manifest = json.load( f )
+    
+    @property
+    def metadata( self ):
+        return self.manifest[ "metadata" ]
+    
+    @property
+    def names( self ):
+        return list( self.manifest[ "datasets" ] )
+    
+    def __contains__( self, name ):
+        return name in self.manifest[ "datasets" ]
+    
+    def __getitem__( self, name ):
+        return Dataset( self.dir, name, self.manifest[ "datasets" ][ name ] )
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+# Closed-form evolution of the power-law memristors: after n pulses a device has resistance
+#   R(n) = r_min + r_max * n**exponent
+# so a device at resistance R sits at pulse number n = ((R - r_min) / r_max)**(1 / exponent) and k further pulses
+# take it to R(n + k).  All functions broadcast over arbitrary populations of devices.
+
+def pulse_number( R, r_min, r_max, exponent ):
+    return np.power( (R - r_min) / r_max, 1 / exponent )
+
+
+def resistance( n, r_min, r_max, exponent ):
+    return r_min + r_max * np.power( n, exponent )
+
+
+def clip( R, r_min, r_max ):
+    # same order as in the learning rule: first cap at r_max, then floor at r_min
+    return np.maximum( np.minimum( R, r_max ), r_min )
+
+
+def apply_pulses( R, pulses, r_min, r_max, exponent ):
+    # resistance after `pulses` (can be different for each device) further pulses, devices outside [r_min, r_max] are
+    # clipped before being pulsed, devices receiving no pulses are left untouched
+    n = pulse_number( clip( R, r_min, r_max ), r_min, r_max, exponent )
+
+    return np.where( pulses > 0, resistance( n + pulses, r_min, r_max, exponent ), R )
+
+
+def resistance2conductance( R, r_min, r_max, gain=1 ):
+    g_min = 1.0 / r_max
+    g_max = 1.0 / r_min
+    g_curr = 1.0 / R
+
+    g_norm = (g_curr - g_min) / (g_max - g_min)
+
+    return g_norm * gain
+
+
+def pulse_trajectory( r_init, n_pulses, r_min=200, r_max=2.3e8, exponent=-0.146 ):
+    # resistances after 0, 1, ..., n_pulses consecutive pulses, with shape (n_pulses + 1, *devices)
+    r_init = np.asarray( r_init, dtype=float )
+    k = np.arange( n_pulses + 1 ).reshape( (-1,) + (1,) * r_init.ndim )
+
+    return apply_pulses( r_init, k, r_min, r_max, exponent )
+
+
+def sequence_trajectory( pulses, pos_init, neg_init, r_min=200, r_max=2.3e8, exponent=-0.146 ):
+    # resistances of differential pairs driven by a sequence of signed pulses with shape (timesteps, *devices): a
+    # positive entry applies that many pulses to the positive memristor, a negative one to the negative memristor
+    pulses = np.asarray( pulses )
+    pos_pulses = np.cumsum( np.maximum( pulses, 0 ), axis=0 )
+    neg_pulses = np.cumsum( np.maximum( -pulses, 0 ), axis=0 )
+
+    pos = apply_pulses( np.asarray( pos_init, dtype=float ), pos_pulses, r_min, r_max, exponent )
+    neg = apply_pulses( np.asarray( neg_init, dtype=float ), neg_pulses, r_min, r_max, exponent )
+
+    return pos, neg
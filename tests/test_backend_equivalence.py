@@ -0,0 +1,104 @@
+import argparse
+import time
+
+import nengo
+import nengo_dl
+import numpy as np
+
+from memristor_nengo.extras import Sines
+from memristor_nengo.learning_rules import mPES
+import memristor_nengo.learning_rules_dl
+
+# Runs the real SimmPES (Nengo Core) and SimmPESBuilder (NengoDL) on the same network, device population and inputs,
+# checks that memristors and weights agree at every step and reports the throughput of each backend
+
+parser = argparse.ArgumentParser()
+parser.add_argument( "-N", "--neurons", nargs="*", default=[ 10, 100 ], type=int )
+parser.add_argument( "-D", "--dimensions", default=3, type=int )
+parser.add_argument( "-s", "--steps", default=1000, type=int )
+parser.add_argument( "-n", "--noise", default=0.15, type=float )
+parser.add_argument( "-pl", "--pulse_levels", default=1, type=int )
+parser.add_argument( "-pp", "--pulse_period", default=1, type=int )
+parser.add_argument( "--dtype", default="float64", choices=[ "float32", "float64" ],
+                     help="NengoDL precision, with float64 the two backends should match to rounding" )
+parser.add_argument( "--rtol", default=1e-6, type=float )
+args = parser.parse_args()
+
+
+def build_network( neurons, dimensions, seed=0 ):
+    network = nengo.Network( seed=seed )
+    with network:
+        nengo_dl.configure_settings( dtype=args.dtype )
+        
+        input_node = nengo.Node( Sines( period=4 ), size_out=dimensions )
+        pre = nengo.Ensemble( neurons, dimensions=dimensions, seed=seed )
+        post = nengo.Ensemble( neurons, dimensions=dimensions, seed=seed )
+        error = nengo.Ensemble( neurons, dimensions=dimensions, radius=2, seed=seed )
+        
+        conn = nengo.Connection( pre.neurons, post.neurons, transform=np.zeros( (post.n_neurons, pre.n_neurons) ) )
+        conn.learning_rule_type = mPES( noisy=[ args.noise ] * 4, gain=1e4, seed=seed,
+                                        pulse_levels=args.pulse_levels, pulse_period=args.pulse_period )
+        
+        nengo.Connection( input_node, pre )
+        nengo.Connection( error, conn.learning_rule )
+        nengo.Connection( post, error )
+        nengo.Connection( pre, error, transform=-1 )
+        
+        probes = {
+                "pos_memristors": nengo.Probe( conn.learning_rule, "pos_memristors", synapse=None ),
+                "neg_memristors": nengo.Probe( conn.learning_rule, "neg_memristors", synapse=None ),
+                "weights"       : nengo.Probe( conn, "weights", synapse=None ),
+                }
+    
+    return network, probes
+
+
+def run( simulator, network, steps ):
+    with simulator( network ) as sim:
+        # the first step also includes graph construction on NengoDL
+        sim.run_steps( 1 )
+        start = time.perf_counter()
+        sim.run_steps( steps - 1 )
+        elapsed = time.perf_counter() - start
+        
+        return sim, (steps - 1) / elapsed
+
+
+def compare( core_data, dl_data, rtol ):
+    # first step at which any value differs, and largest relative difference over the whole run
+    first_divergence = None
+    max_difference = 0
+    for step, (a, b) in enumerate( zip( core_data, dl_data ) ):
+        # relative to the largest value at that step, as single weights can legitimately be close to zero
+        difference = np.max( np.abs( a - b ) ) / max( np.max( np.abs( a ) ), 1e-12 )
+        max_difference = max( max_difference, difference )
+        if first_divergence is None and difference > rtol:
+            first_divergence = step
+    
+    return first_divergence, max_difference
+
+
+failed = False
+for neurons in args.neurons:
+    print( f"\n{neurons} neurons, {args.dimensions} dimensions, {args.steps} steps" )
+    
+    # identical but separate networks, so that the device populations are sampled the same way for each backend
+    core_network, core_probes = build_network( neurons, args.dimensions )
+    core_sim, core_speed = run( lambda net: nengo.Simulator( net, progress_bar=False ), core_network, args.steps )
+    dl_network, dl_probes = build_network( neurons, args.dimensions )
+    dl_sim, dl_speed = run( lambda net: nengo_dl.Simulator( net, progress_bar=False, device="/cpu:0" ),
+                            dl_network, args.steps )
+    
+    print( f"Nengo Core {core_speed:.1f} steps/s, NengoDL {dl_speed:.1f} steps/s" )
+    for name in core_probes:
+        core_data = core_sim.data[ core_probes[ name ] ]
+        dl_data = dl_sim.data[ dl_probes[ name ] ].reshape( core_data.shape )
+        first_divergence, max_difference = compare( core_data, dl_data, args.rtol )
+        if first_divergence is None:
+            print( f"\t{name}: equivalent, max relative difference {max_difference:.2e}" )
+        else:
+            failed = True
+            print( f"\t{name}: DIVERGED at step {first_divergence}, max relative difference {max_difference:.2e}" )
+
+print( "\nFAILED" if failed else "\nPASSED" )
+exit( 1 if failed else 0 )
@@ -0,0 +1,72 @@
+import argparse
+
+import nengo
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+from memristor_nengo.extras import Sines
+from memristor_nengo.learning_rules import mPES
+
+# Learns through a sparse mPES connection on Nengo Core and checks that only the synapses in the connectivity ever
+# carry a weight, and that a transform with weights outside the connectivity is refused
+
+parser = argparse.ArgumentParser()
+parser.add_argument( "-N", "--neurons", default=50, type=int )
+parser.add_argument( "-d", "--density", default=0.2, type=float )
+parser.add_argument( "-s", "--steps", default=1000, type=int )
+args = parser.parse_args()
+
+rng = np.random.RandomState( 0 )
+connectivity = sparse_random( args.neurons, args.neurons, density=args.density, random_state=rng,
+                              data_rvs=np.ones ).toarray().astype( bool )
+
+
+def build_network( transform, seed=0 ):
+    network = nengo.Network( seed=seed )
+    with network:
+        input_node = nengo.Node( Sines( period=4 ), size_out=1 )
+        pre = nengo.Ensemble( args.neurons, dimensions=1, seed=seed )
+        post = nengo.Ensemble( args.neurons, dimensions=1, seed=seed )
+        error = nengo.Ensemble( args.neurons, dimensions=1, radius=2, seed=seed )
+        
+        conn = nengo.Connection( pre.neurons, post.neurons, transform=transform )
+        conn.learning_rule_type = mPES( noisy=[ 0.15 ] * 4, gain=1e4, seed=seed, connectivity=connectivity )
+        
+        nengo.Connection( input_node, pre )
+        nengo.Connection( error, conn.learning_rule )
+        nengo.Connection( post, error )
+        nengo.Connection( pre, error, transform=-1 )
+        
+        weight_probe = nengo.Probe( conn, "weights", synapse=None )
+    
+    return network, weight_probe
+
+
+failed = False
+
+transform = rng.random_sample( connectivity.shape )
+network, _ = build_network( transform )
+try:
+    nengo.Simulator( network, progress_bar=False ).close()
+    failed = True
+    print( "Transform with weights outside the connectivity: BUILT, expected a ValueError" )
+except ValueError as e:
+    print( f"Transform with weights outside the connectivity: refused ({e})" )
+
+network, weight_probe = build_network( transform * connectivity )
+with nengo.Simulator( network, progress_bar=False ) as sim:
+    sim.run_steps( args.steps )
+weights = sim.data[ weight_probe ]
+absent = np.count_nonzero( weights[ :, ~connectivity ] )
+present = np.count_nonzero( weights[ -1 ][ connectivity ] != (transform * connectivity)[ connectivity ] )
+if absent > 0:
+    failed = True
+    print( f"Synapses outside the connectivity: {absent} non-zero weights" )
+else:
+    print( "Synapses outside the connectivity: all weights zero" )
+print( f"Synapses in the connectivity: {present} of {np.count_nonzero( connectivity )} changed by learning" )
+if present == 0:
+    failed = True
+
+print( "\nFAILED" if failed else "\nPASSED" )
+exit( 1 if failed else 0 )
@@ -0,0 +1,69 @@
+import argparse
+
+import numpy as np
+from nengo.builder import Signal
+
+from memristor_nengo.device_models import PowerLaw
+from memristor_nengo.learning_rules import SimmPES
+from memristor_nengo.trajectories import pulse_trajectory
+
+# Pulses a small crossbar through the real SimmPES operator (Nengo Core) and checks that every memristor follows the
+# closed-form trajectory in memristor_nengo.trajectories; NengoDL is checked against Nengo Core by
+# test_backend_equivalence.py
+
+parser = argparse.ArgumentParser()
+parser.add_argument( "-p", "--pulses", default=100, type=int )
+parser.add_argument( "--post", default=2, type=int )
+parser.add_argument( "--pre", default=3, type=int )
+parser.add_argument( "--rtol", default=1e-9, type=float )
+args = parser.parse_args()
+
+shape = (args.post, args.pre)
+rng = np.random.RandomState( 0 )
+r_min = rng.normal( 200, 20, shape )
+r_max = rng.normal( 2.3e8, 2.3e7, shape )
+exponent = rng.normal( -0.146, 0.0146, shape )
+pos_init = rng.normal( 1e8, 1e7, shape )
+neg_init = rng.normal( 1e8, 1e7, shape )
+
+# every pre neuron spikes at every step, even post neurons get a negative local error so their positive memristors
+# are pulsed and odd ones a positive error so their negative memristors are
+pre_filtered = Signal( np.ones( args.pre ), name="pre_filtered" )
+error = Signal( np.where( np.arange( args.post ) % 2 == 0, -1.0, 1.0 ), name="error" )
+time = Signal( np.zeros( () ), name="time" )
+step = Signal( np.zeros( (), dtype=np.int64 ), name="step" )
+pos_memristors = Signal( pos_init.copy(), name="pos_memristors" )
+neg_memristors = Signal( neg_init.copy(), name="neg_memristors" )
+weights = Signal( np.zeros( shape ), name="weights" )
+
+op = SimmPES( pre_filtered, error, 1e-4, pos_memristors, neg_memristors, weights, [ 0 ] * 4, 1e4,
+              r_min, r_max, exponent, PowerLaw(), time, None, step, 1 )
+signals = { sig: sig.initial_value.copy() for sig in op.all_signals }
+step_simmpes = op.make_step( signals, 0.001, rng )
+
+pos_data = [ signals[ pos_memristors ].copy() ]
+neg_data = [ signals[ neg_memristors ].copy() ]
+for i in range( args.pulses ):
+    signals[ step ][ ... ] = i + 1
+    signals[ time ][ ... ] = (i + 1) * 0.001
+    step_simmpes()
+    pos_data.append( signals[ pos_memristors ].copy() )
+    neg_data.append( signals[ neg_memristors ].copy() )
+pos_data = np.array( pos_data )
+neg_data = np.array( neg_data )
+
+pulsed_pos = (np.arange( args.post ) % 2 == 0)[ :, None ] * np.ones( shape, dtype=bool )
+expected_pos = np.where( pulsed_pos, pulse_trajectory( pos_init, args.pulses, r_min, r_max, exponent ), pos_init )
+expected_neg = np.where( ~pulsed_pos, pulse_trajectory( neg_init, args.pulses, r_min, r_max, exponent ), neg_init )
+
+failed = False
+for name, data, expected in (("pos_memristors", pos_data, expected_pos), ("neg_memristors", neg_data, expected_neg)):
+    difference = np.max( np.abs( data - expected ) / np.abs( expected ) )
+    if difference > args.rtol:
+        failed = True
+        print( f"{name}: DIFFERS from the closed form, max relative difference {difference:.2e}" )
+    else:
+        print( f"{name}: matches the closed form, max relative difference {difference:.2e}" )
+
+print( "\nFAILED" if failed else "\nPASSED" )
+exit( 1 if failed else 0 )